@@ -0,0 +1,101 @@
+"""Measure the encode/decode cost and payload size of the codecs for workflow payloads.
+
+Encodes and decodes order-processor's `Order` and result dataclasses with the standard
+library's json module, orjson and MessagePack, with the dataclasses as shipped (`slots=True`)
+and as plain dataclasses with a `__dict__`:
+
+    python3 benchmarks/codec_microbench.py --iterations 100000 --output codecs.json
+"""
+import argparse
+import dataclasses
+import json
+import sys
+import time
+import tracemalloc
+
+from dapr_standin import load_service
+
+
+def without_slots(cls):
+    """The same dataclass without `__slots__`, as it was declared before."""
+    return dataclasses.make_dataclass(cls.__name__, [(field.name, field.type) for field in dataclasses.fields(cls)])
+
+
+def samples(app, slots, items):
+    classes = {name: getattr(app, name) for name in ("Order", "OrderResult", "InventoryResult", "PaymentResult")}
+    if not slots:
+        classes = {name: without_slots(cls) for name, cls in classes.items()}
+    return {
+        "Order": classes["Order"]("order_0000001234", "customer-42",
+                                  [{"item": f"sku-{i:07d}", "quantity": i % 5 + 1} for i in range(items)], 1234.5),
+        "OrderResult": classes["OrderResult"]("order_0000001234", True, "Order processed successfully"),
+        "InventoryResult": classes["InventoryResult"]("order_0000001234", True, "Reserved 3 items"),
+        "PaymentResult": classes["PaymentResult"]("order_0000001234", True, "Payment processed"),
+    }
+
+
+def instance_bytes(cls, count=10000):
+    """Average memory allocated per instance, including its __dict__ if it has one."""
+    fields = [field.name for field in dataclasses.fields(cls)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    instances = [cls(*(f"{name}-{i}" for name in fields)) for i in range(count)]
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    # Every instance holds the same number of strings of similar length, so subtract them
+    strings = sum(sys.getsizeof(value) for value in vars_of(instances[0]).values()) * count
+    return round((allocated - strings - sys.getsizeof(instances)) / count, 1)
+
+
+def vars_of(obj):
+    return {field.name: getattr(obj, field.name) for field in dataclasses.fields(obj)}
+
+
+def per_op_us(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return round((time.perf_counter() - start) / iterations * 1e6, 3)
+
+
+def run(app, codec, iterations, items):
+    # The standard library's json module can only encode dataclasses through their __dict__,
+    # which is how order-processor encoded them before the codec layer
+    encoders = {
+        "json": (lambda obj: json.dumps(vars_of(obj)).encode("utf-8"), json.loads),
+        "orjson": (codec.CODECS[codec.JSON].encode, codec.CODECS[codec.JSON].decode),
+        "msgpack": (codec.CODECS[codec.MSGPACK].encode, codec.CODECS[codec.MSGPACK].decode),
+    }
+    report = {}
+    for slots in (False, True):
+        layout = "slots" if slots else "dict"
+        for name, obj in samples(app, slots, items).items():
+            for encoding, (encode, decode) in encoders.items():
+                payload = encode(obj)
+                report.setdefault(name, {}).setdefault(encoding, {})[layout] = {
+                    "bytes": len(payload),
+                    "encode_us": per_op_us(lambda: encode(obj), iterations),
+                    "decode_us": per_op_us(lambda: decode(payload), iterations),
+                    "instance_bytes": instance_bytes(type(obj)),
+                }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=100000, help="encodes and decodes per measurement")
+    parser.add_argument("--items", type=int, default=3, help="line items per order")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    app = load_service("order-processor")
+    report = json.dumps(run(app, app.service_modules["codec"], args.iterations, args.items), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""Compare per-activity latency of a fresh DaprClient per call against the pooled client.
+
+Run next to a Dapr sidecar, e.g.:
+
+    dapr run --app-id bench --resources-path ./resources -- python3 benchmarks/dapr_client_pool.py
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "order-processor"))
+
+from dapr.clients import DaprClient  # noqa: E402
+from dapr_pool import DaprClientPool  # noqa: E402
+
+PUBSUB_NAME = os.getenv("PUBSUB_NAME", "pubsub")
+TOPIC_NAME = os.getenv("TOPIC_NAME", "notifications")
+
+
+def publish(d, i):
+    d.publish_event(PUBSUB_NAME, TOPIC_NAME, json.dumps({"order_id": "bench", "message": f"message {i}"}))
+
+
+def run_fresh(iterations):
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        with DaprClient() as d:
+            publish(d, i)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run_pooled(iterations):
+    pool = DaprClientPool(size=1)
+    timings = []
+    try:
+        for i in range(iterations):
+            start = time.perf_counter()
+            with pool.client() as d:
+                publish(d, i)
+            timings.append(time.perf_counter() - start)
+    finally:
+        pool.close()
+    return timings
+
+
+def summarize(timings):
+    ordered = sorted(timings)
+    return {
+        "calls": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 3),
+        "p95_ms": round(ordered[int(len(ordered) * 0.95) - 1] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    print(json.dumps({
+        "fresh_client": summarize(run_fresh(args.iterations)),
+        "pooled_client": summarize(run_pooled(args.iterations)),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""In-process stand-in for the parts of the Dapr sidecar the services use.
+
+Lets the services be exercised without a sidecar or Catalyst project by swapping their
+`DaprClient` for `StandInDaprClient`. A `StandInSidecar` provides an in-memory state store,
+an in-memory pub/sub broker and service invocation routed to the services' Flask apps.
+"""
+import importlib.util
+import json
+import os
+import sys
+import threading
+import uuid
+
+import grpc
+from dapr.clients.grpc._state import Concurrency
+from dapr.proto import api_v1
+
+
+class StandInRpcError(grpc.RpcError):
+    def __init__(self, code, details):
+        super().__init__(details)
+        self._code = code
+        self._details = details
+
+    def code(self):
+        return self._code
+
+    def details(self):
+        return self._details
+
+
+class StateResponse:
+    def __init__(self, data=b"", etag=""):
+        self.data = data
+        self.etag = etag
+
+
+class BulkStateItem:
+    def __init__(self, key, data=b"", etag="", error=""):
+        self.key = key
+        self.data = data
+        self.etag = etag
+        self.error = error
+
+
+class BulkStatesResponse:
+    def __init__(self, items):
+        self.items = items
+
+
+class InMemoryStateStore:
+    """A thread-safe key/value store with ETag concurrency, like a Dapr state component."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def get(self, key):
+        with self._lock:
+            return self._items.get(key, (b"", ""))
+
+    def set(self, key, value, etag=None, first_write=False):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        with self._lock:
+            current = self._items.get(key)
+            if first_write and not etag and current is not None:
+                # First-write-wins without an ETag only creates keys that do not exist yet
+                raise StandInRpcError(grpc.StatusCode.ABORTED, f"possible etag mismatch for key {key}")
+            if etag:
+                if current is None or current[1] != etag:
+                    raise StandInRpcError(grpc.StatusCode.ABORTED, f"possible etag mismatch for key {key}")
+            new_etag = uuid.uuid4().hex
+            self._items[key] = (value, new_etag)
+            return new_etag
+
+    def delete(self, key, etag=None):
+        with self._lock:
+            current = self._items.get(key)
+            if etag and (current is None or current[1] != etag):
+                raise StandInRpcError(grpc.StatusCode.ABORTED, f"possible etag mismatch for key {key}")
+            self._items.pop(key, None)
+
+    def transact(self, operations):
+        """Apply upserts and deletes atomically, failing all of them if any ETag does not match."""
+        with self._lock:
+            for op in operations:
+                current = self._items.get(op.key)
+                if op.etag and (current is None or current[1] != op.etag):
+                    # The sidecar wraps any failed transaction as INTERNAL, whatever the state store reported
+                    raise StandInRpcError(grpc.StatusCode.INTERNAL,
+                                          "error while executing state transaction: possible etag mismatch. "
+                                          f"error from state store: key {op.key}")
+            for op in operations:
+                if op.operation_type.value == "delete":
+                    self._items.pop(op.key, None)
+                else:
+                    data = op.data.encode("utf-8") if isinstance(op.data, str) else op.data
+                    self._items[op.key] = (data, uuid.uuid4().hex)
+
+
+class InMemoryPubSub:
+    """Delivers published messages to in-process subscribers and counts them per topic."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self.published = {}
+
+    def subscribe(self, topic, callback):
+        with self._lock:
+            self._subscribers.setdefault(topic, []).append(callback)
+
+    def unsubscribe(self, topic, callback):
+        with self._lock:
+            self._subscribers.get(topic, []).remove(callback)
+
+    def publish(self, topic, data):
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        with self._lock:
+            self.published[topic] = self.published.get(topic, 0) + 1
+            subscribers = list(self._subscribers.get(topic, []))
+        for callback in subscribers:
+            callback(data)
+
+
+class SubscriptionMessage:
+    """The parts of a streaming subscription's message that the services read."""
+
+    def __init__(self, data):
+        self._raw_data = data.encode("utf-8")
+
+    def raw_data(self):
+        return self._raw_data
+
+    def data(self):
+        return json.loads(self._raw_data)
+
+
+class InvokeMethodResponse:
+    def __init__(self, status_code, data, headers):
+        self._status_code = status_code
+        self.data = data
+        self.headers = headers
+
+    @property
+    def status_code(self):
+        return self._status_code
+
+    @property
+    def content_type(self):
+        return self.headers.get("Content-Type")
+
+    def text(self):
+        return self.data.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.data)
+
+
+class StandInSidecar:
+    """Shared state behind every `StandInDaprClient` of a simulated deployment."""
+
+    def __init__(self):
+        self.store = InMemoryStateStore()
+        self.pubsub = InMemoryPubSub()
+        self._apps = {}
+
+    def register_app(self, app_id, flask_app):
+        self._apps[app_id] = flask_app
+
+    def invoke(self, app_id, method_name, data, content_type, http_verb, http_querystring, metadata=None):
+        flask_app = self._apps.get(app_id)
+        if not flask_app:
+            raise StandInRpcError(grpc.StatusCode.UNAVAILABLE, f"app {app_id} is not registered")
+        with flask_app.test_client() as client:
+            resp = client.open(f"/{method_name}", method=http_verb or "GET", data=data,
+                               content_type=content_type or "application/json",
+                               query_string=dict(http_querystring or ()),
+                               # Like the sidecar, pass the call's metadata on as headers
+                               headers=list(metadata or ()))
+            return InvokeMethodResponse(resp.status_code, resp.get_data(), dict(resp.headers))
+
+    def client(self):
+        return StandInDaprClient(self)
+
+
+class _StandInStub:
+    """The raw gRPC stub calls the services make that the SDK does not wrap."""
+
+    def __init__(self, sidecar):
+        self._sidecar = sidecar
+
+    def BulkPublishEventAlpha1(self, req):
+        for entry in req.entries:
+            self._sidecar.pubsub.publish(req.topic, entry.event)
+        return api_v1.BulkPublishResponse()
+
+
+class StandInDaprClient:
+    """Implements the subset of the DaprClient API used by the services."""
+
+    def __init__(self, sidecar: StandInSidecar):
+        self._sidecar = sidecar
+        self._store = sidecar.store
+        self._stub = _StandInStub(sidecar)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def get_metadata(self):
+        return {}
+
+    def get_state(self, store_name, key, state_metadata=None):
+        data, etag = self._store.get(key)
+        return StateResponse(data, etag)
+
+    def get_bulk_state(self, store_name, keys, parallelism=1, states_metadata=None):
+        return BulkStatesResponse([BulkStateItem(key, *self._store.get(key)) for key in keys])
+
+    def save_state(self, store_name, key, value, etag=None, options=None, state_metadata=None):
+        first_write = options is not None and options.concurrency == Concurrency.first_write
+        self._store.set(key, value, etag, first_write)
+
+    def save_bulk_state(self, store_name, states, metadata=None):
+        for state in states:
+            first_write = state.options is not None and state.options.concurrency == Concurrency.first_write
+            self._store.set(state.key, state.value, state.etag, first_write)
+
+    def delete_state(self, store_name, key, etag=None, options=None, state_metadata=None):
+        self._store.delete(key, etag)
+
+    def execute_state_transaction(self, store_name, operations, transactional_metadata=None, metadata=None):
+        self._store.transact(operations)
+
+    def publish_event(self, pubsub_name, topic_name, data, publish_metadata=None, data_content_type=None):
+        self._sidecar.pubsub.publish(topic_name, data)
+
+    def subscribe_with_handler(self, pubsub_name, topic, handler_fn, metadata=None, dead_letter_topic=None):
+        def deliver(data):
+            handler_fn(SubscriptionMessage(data))
+
+        self._sidecar.pubsub.subscribe(topic, deliver)
+        return lambda: self._sidecar.pubsub.unsubscribe(topic, deliver)
+
+    def invoke_method(self, app_id, method_name, data="", content_type=None, metadata=None, http_verb=None,
+                      http_querystring=None, timeout=None):
+        return self._sidecar.invoke(app_id, method_name, data, content_type, http_verb, http_querystring, metadata)
+
+
+SERVICES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "services")
+
+
+def load_service(name, client_factory=None):
+    """Import `services/<name>/app.py` as `<name>_app`, optionally swapping its DaprClient.
+
+    Services ship sibling modules with the same names (e.g. `serving.py`), so each service's
+    modules are dropped from the import cache once it has loaded. They stay reachable through
+    the returned module's `service_modules` dict.
+    """
+    service_dir = os.path.abspath(os.path.join(SERVICES_DIR, name))
+    sys.path.insert(0, service_dir)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{name.replace('-', '_')}_app",
+                                                      os.path.join(service_dir, "app.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(service_dir)
+        service_modules = {}
+        for module_name, loaded in list(sys.modules.items()):
+            if os.path.dirname(os.path.abspath(getattr(loaded, "__file__", None) or "")) == service_dir:
+                service_modules[module_name] = sys.modules.pop(module_name)
+    module.service_modules = service_modules
+    if client_factory:
+        module.DaprClient = client_factory
+    return module
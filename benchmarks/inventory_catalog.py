@@ -0,0 +1,96 @@
+"""Measure restocking, listing, streaming and deleting a large product catalog.
+
+Runs the inventory Flask app in-process against the in-memory state store stand-in, once
+for each catalog size:
+
+    python3 benchmarks/inventory_catalog.py --skus 10000 100000 --output catalog.json
+"""
+import argparse
+import json
+import sys
+import time
+
+from dapr_standin import StandInSidecar, load_service
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def rate(count, seconds):
+    return round(count / max(seconds, 1e-9), 1)
+
+
+def run(skus, page_size):
+    sidecar = StandInSidecar()
+    inventory = load_service("inventory", client_factory=sidecar.client)
+    client = inventory.app.test_client()
+    items = [{"item": f"sku-{i:07d}", "quantity": i % 500} for i in range(skus)]
+
+    resp, restock_seconds = timed(lambda: client.post("/api/v1/inventory/restock", json={"items": items}))
+    assert resp.status_code == 200, resp.get_data(as_text=True)
+
+    def page_through():
+        listed, pages = 0, 0
+        url = f"/api/v1/inventory?limit={page_size}"
+        while url:
+            resp = client.get(url)
+            assert resp.status_code == 200, resp.get_data(as_text=True)
+            listed += len(resp.get_json())
+            pages += 1
+            link = resp.headers.get("Link")
+            url = link[link.index("/api/"):link.index(">")] if link else None
+        return listed, pages
+
+    # The first pass also loads the catalog index, later passes are served from its cache
+    (listed, pages), list_seconds = timed(page_through)
+    (_, _), cached_list_seconds = timed(page_through)
+
+    def stream():
+        resp = client.get("/api/v1/inventory/stream")
+        return sum(1 for line in resp.get_data(as_text=True).splitlines() if line)
+
+    streamed, stream_seconds = timed(stream)
+
+    reserve, reserve_seconds = timed(lambda: client.post("/api/v1/inventory/reserve",
+                                                         json={"id": "order_1", "item": items[-1]["item"]}))
+
+    resp, delete_seconds = timed(lambda: client.delete("/api/v1/inventory"))
+    assert resp.status_code == 200, resp.get_data(as_text=True)
+
+    return {
+        "skus": skus,
+        "restock": {"seconds": round(restock_seconds, 3), "skus_per_sec": rate(skus, restock_seconds)},
+        "list": {"pages": pages, "listed": listed, "seconds": round(list_seconds, 3),
+                 "skus_per_sec": rate(listed, list_seconds)},
+        "list_cached_index": {"seconds": round(cached_list_seconds, 3),
+                              "skus_per_sec": rate(listed, cached_list_seconds)},
+        "stream": {"streamed": streamed, "seconds": round(stream_seconds, 3),
+                   "skus_per_sec": rate(streamed, stream_seconds)},
+        "reserve_ms": round(reserve_seconds * 1000, 3),
+        "reserve_succeeded": reserve.get_json()["success"],
+        "delete_all": {"deleted": resp.get_json()["deleted"], "seconds": round(delete_seconds, 3),
+                       "skus_per_sec": rate(skus, delete_seconds)},
+        "left_in_store": len(sidecar.store._items),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--skus", type=int, nargs="+", default=[10000, 100000], help="catalog sizes to measure")
+    parser.add_argument("--page-size", type=int, default=1000, help="items per listing page")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = json.dumps([run(skus, args.page_size) for skus in args.skus], indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""Fire many parallel reservations at one SKU and check that inventory is never oversold.
+
+Runs the inventory Flask app in-process against the in-memory state store stand-in:
+
+    python3 benchmarks/inventory_reservation_contention.py --stock 500 --requests 5000
+"""
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dapr_standin import StandInSidecar, load_service
+
+
+def run(item="orange", stock=500, requests=5000, workers=64) -> dict:
+    """Reserve one unit of `item` per request from `workers` threads and report the outcome."""
+    sidecar = StandInSidecar()
+    store = sidecar.store
+    store.set(item, str(stock))
+    inventory = load_service("inventory", client_factory=sidecar.client)
+    client = inventory.app.test_client()
+
+    def reserve(i):
+        resp = client.post("/api/v1/inventory/reserve", json={"id": f"order_{i}", "item": item})
+        return resp.status_code, resp.get_json()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(reserve, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    reserved = sum(1 for status, body in results if status == 200 and body["success"])
+    gave_up = sum(1 for status, _ in results if status == 409)
+    failed = sum(1 for status, _ in results if status >= 500)
+    remaining = int(store.get(item)[0].decode("utf-8"))
+
+    return {
+        "requests": requests,
+        "stock": stock,
+        "reserved": reserved,
+        "gave_up_on_contention": gave_up,
+        "failed": failed,
+        "remaining": remaining,
+        "oversold": reserved + remaining != stock or remaining < 0,
+        "reservations_per_sec": round(requests / elapsed, 1),
+        "stats": inventory.reservation_stats.to_dict(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--item", default="orange")
+    parser.add_argument("--stock", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=64)
+    args = parser.parse_args()
+
+    report = run(args.item, args.stock, args.requests, args.workers)
+    print(json.dumps(report, indent=2))
+
+    sys.exit(1 if report["oversold"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""Drive POST /orders at a target rate against an in-process deployment and report latencies.
+
+All five services run in this process: the Python services' Flask apps, a stand-in sidecar
+(state store, pub/sub, service invocation) and a stand-in workflow engine. No Dapr or Catalyst
+project is needed, so results can be compared across commits:
+
+    python3 benchmarks/load_test.py --rate 50 --orders 1000 --approval-ratio 0.1 --output before.json
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from dapr_standin import StandInSidecar, load_service
+from workflow_standin import StandInWorkflowClient, WorkflowEngine, workflow_module
+
+
+def percentiles(values):
+    ordered = sorted(values)
+    if not ordered:
+        return {"count": 0}
+
+    def rank(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": rank(50),
+        "p95_ms": rank(95),
+        "p99_ms": rank(99),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Deployment:
+    """Wires the services to a stand-in sidecar and workflow engine."""
+
+    def __init__(self, activity_workers, stock, faults=None, trace_file=None, trace_sample_ratio=1.0):
+        if faults:
+            os.environ["FAULT_INJECTION_ENABLED"] = "true"
+        if trace_file:
+            os.environ.update(TRACE_EXPORTER="file", TRACE_FILE=trace_file, TRACE_SAMPLE_RATIO=str(trace_sample_ratio))
+        self.sidecar = StandInSidecar()
+        self.engine = WorkflowEngine(max_activity_workers=activity_workers)
+
+        for name in ("inventory", "payments", "shipping", "order-processor"):
+            # Every service would otherwise be named after this process
+            os.environ["TRACE_SERVICE_NAME"] = name
+            setattr(self, name.replace("-", "_"), load_service(name, client_factory=self.sidecar.client))
+        os.environ.pop("TRACE_SERVICE_NAME")
+
+        self.sidecar.register_app("inventory", self.inventory.app)
+        self.sidecar.register_app("payments", self.payments.app)
+        self.sidecar.register_app("shipping", self.shipping.app)
+        self.sidecar.register_app("order-processor", self.order_processor.app)
+
+        op = self.order_processor
+        op.wf = workflow_module(self.engine)
+        op.get_workflow_client = lambda: StandInWorkflowClient(self.engine)
+        op.service_modules["dapr_pool"].DaprClient = self.sidecar.client
+        op.service_modules["order_events"].DaprClient = self.sidecar.client
+
+        with self.inventory.app.test_client() as client:
+            client.post("/api/v1/inventory/restock", json={
+                "items": [{"item": item, "quantity": stock} for item in self.inventory.INVENTORY_ITEMS]})
+
+        for name, rules in (faults or {}).items():
+            with getattr(self, name).app.test_client() as client:
+                resp = client.put("/admin/faults", json=rules)
+            if resp.status_code != 200:
+                raise ValueError(f"Invalid faults for {name}: {resp.get_data(as_text=True)}")
+
+        op.order_events.start()
+        op.start_workflow_runtime()
+
+    def shutdown(self):
+        self.order_processor.order_events.close()
+        self.order_processor.stop_workflow_runtime()
+        self.engine.shutdown()
+        self.shipping.wave_scheduler.close()
+        for name in ("inventory", "payments", "shipping", "order_processor"):
+            getattr(self, name).service_modules["tracing"].tracer.close()
+
+
+def run(args):
+    random.seed(args.seed)
+    faults = None
+    if args.faults:
+        with open(args.faults) as f:
+            faults = json.load(f)
+    deployment = Deployment(args.activity_workers, args.stock, faults, args.trace_file, args.trace_sample_ratio)
+    op = deployment.order_processor
+    engine = deployment.engine
+    items = deployment.inventory.INVENTORY_ITEMS
+
+    submitted = {}
+    approval_pending = set()
+    submit_errors = []
+    http_timings = []
+    lock = threading.Lock()
+
+    def submit(i):
+        needs_approval = random.random() < args.approval_ratio
+        total = round(random.uniform(op.APPROVAL_THRESHOLD, op.APPROVAL_THRESHOLD * 2), 2) if needs_approval \
+            else round(random.uniform(1, op.APPROVAL_THRESHOLD - 1), 2)
+        lines = random.sample(items, random.randint(1, min(args.max_line_items, len(items))))
+        order = {"customer": f"customer{i % args.customers}",
+                 "items": [{"item": item, "quantity": random.randint(1, 3)} for item in lines], "total": total}
+
+        start = time.monotonic()
+        with op.app.test_client() as client:
+            resp = client.post("/orders", json=order)
+        elapsed = time.monotonic() - start
+
+        with lock:
+            http_timings.append(elapsed)
+            if resp.status_code != 202:
+                submit_errors.append(resp.status_code)
+                return
+            instance_id = resp.get_json()["instance_id"]
+            submitted[instance_id] = (start, needs_approval)
+            if needs_approval:
+                approval_pending.add(instance_id)
+
+    stop_approving = threading.Event()
+
+    def approve():
+        # Plays the part of an approver who clears each high-value order as soon as it waits
+        while not stop_approving.is_set():
+            with lock:
+                waiting = [i for i in approval_pending if engine.is_waiting_for_event(i, "approval")]
+                approval_pending.difference_update(waiting)
+            for instance_id in waiting:
+                with op.app.test_client() as client:
+                    client.post(f"/orders/{instance_id}/approve", json={"approver": "loadtest", "approved": True})
+            time.sleep(0.005)
+
+    approver = threading.Thread(target=approve, name="approver", daemon=True)
+    approver.start()
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        for i in range(args.orders):
+            # Open loop: keep to the target rate regardless of how slow responses get
+            delay = started + i / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(submit, i)
+
+    deadline = time.monotonic() + args.timeout
+    for instance_id in list(submitted):
+        engine.get(instance_id).done.wait(max(0.0, deadline - time.monotonic()))
+    stop_approving.set()
+    approver.join()
+
+    instances = [engine.get(i) for i in submitted]
+    finished = [inst for inst in instances if inst.done.is_set()]
+    end_to_end = {"all": [], "standard": [], "approval": []}
+    for inst in finished:
+        submitted_at, needs_approval = submitted[inst.instance_id]
+        elapsed = inst.completed_monotonic - submitted_at
+        end_to_end["all"].append(elapsed)
+        end_to_end["approval" if needs_approval else "standard"].append(elapsed)
+
+    last_completion = max((inst.completed_monotonic for inst in finished), default=started)
+    outcomes = {}
+    for inst in instances:
+        outcomes[inst.runtime_status.name] = outcomes.get(inst.runtime_status.name, 0) + 1
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": vars(args),
+        "orders": {
+            "submitted": len(submitted),
+            "rejected": len(submit_errors),
+            # Refused by admission control rather than failed
+            "rate_limited": submit_errors.count(429),
+            "finished": len(finished),
+            "outcomes": outcomes,
+        },
+        "throughput_orders_per_sec": round(len(finished) / max(last_completion - started, 1e-9), 2),
+        "submit_latency": percentiles(http_timings),
+        "end_to_end_latency": {name: percentiles(values) for name, values in end_to_end.items()},
+        "activity_latency": {name: percentiles(values) for name, values in sorted(engine.activity_timings.items())},
+        "history_events_per_order": round(sum(i.history_events for i in instances) / max(len(instances), 1), 2),
+        "replays_per_order": round(sum(i.replays for i in instances) / max(len(instances), 1), 2),
+        "notifications_published": deployment.sidecar.pubsub.published.get(op.notification_publisher._topic_name, 0),
+    }
+
+    deployment.shutdown()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=50.0, help="orders submitted per second")
+    parser.add_argument("--orders", type=int, default=500, help="total orders to submit")
+    parser.add_argument("--approval-ratio", type=float, default=0.1,
+                        help="fraction of orders at or above APPROVAL_THRESHOLD")
+    parser.add_argument("--max-line-items", type=int, default=1,
+                        help="each order has between 1 and this many line items, reserved in parallel")
+    parser.add_argument("--customers", type=int, default=50, help="number of distinct customers")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent HTTP clients")
+    parser.add_argument("--activity-workers", type=int, default=64, help="threads executing workflow activities")
+    parser.add_argument("--stock", type=int, default=1_000_000, help="initial stock of every item")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for orders to finish")
+    parser.add_argument("--faults", help="JSON file of fault rules by service, e.g. "
+                                         "{\"shipping\": {\"/shipping/ship\": {\"error_rate\": 0.1}}}")
+    parser.add_argument("--trace-file", help="append the spans of sampled orders to this file as JSON lines")
+    parser.add_argument("--trace-sample-ratio", type=float, default=1.0, help="share of orders traced")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
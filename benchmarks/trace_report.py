@@ -0,0 +1,115 @@
+"""Print the spans of one order as a waterfall and mark its critical path.
+
+Reads the JSON lines the services write with TRACE_EXPORTER=file, for example after a load
+test run with --trace-file, and finds the trace of an order by its instance ID:
+
+    python3 benchmarks/load_test.py --orders 50 --trace-file traces.jsonl
+    python3 benchmarks/trace_report.py traces.jsonl --order order_01jb3k5m8f9w2x7r4t6y0z1c2d
+
+Without --order it reports the slowest traced order.
+"""
+import argparse
+import json
+import sys
+
+
+def load_spans(paths):
+    spans = []
+    for path in paths:
+        with open(path) as f:
+            spans.extend(json.loads(line) for line in f if line.strip())
+    return spans
+
+
+def workflow_spans(spans):
+    return [span for span in spans if span["name"].startswith("workflow ")]
+
+
+def build_tree(spans):
+    """Return the root spans of a trace and the children of every span, oldest first.
+
+    A span whose parent was not recorded, such as one whose caller's sidecar traced the hop
+    itself, hangs off the shortest recorded span that encloses it.
+    """
+    by_id = {span["span_id"]: span for span in spans}
+    children = {span["span_id"]: [] for span in spans}
+    roots = []
+    for span in sorted(spans, key=lambda s: s["start_time_unix_nano"]):
+        parent_id = span["parent_span_id"]
+        if parent_id not in by_id:
+            enclosing = [other for other in spans if other is not span
+                         and other["start_time_unix_nano"] <= span["start_time_unix_nano"]
+                         and other["end_time_unix_nano"] >= span["end_time_unix_nano"]]
+            parent_id = min(enclosing, key=lambda s: s["duration_ms"])["span_id"] if enclosing else None
+        if parent_id:
+            children[parent_id].append(span)
+        else:
+            roots.append(span)
+    return roots, children
+
+
+def critical_path(roots, children):
+    """The chain of spans that finished last at every level, which decided when the order finished."""
+    path = set()
+    level = roots
+    while level:
+        last = max(level, key=lambda s: s["end_time_unix_nano"])
+        path.add(last["span_id"])
+        level = children[last["span_id"]]
+    return path
+
+
+def waiting_ms(workflow, children):
+    """Time within the workflow span when none of its activities was running, so it was being scheduled."""
+    busy, cursor = 0, workflow["start_time_unix_nano"]
+    activities = [span for span in children[workflow["span_id"]] if span["name"].startswith("activity ")]
+    for span in sorted(activities, key=lambda s: s["start_time_unix_nano"]):
+        start = max(span["start_time_unix_nano"], cursor)
+        end = min(span["end_time_unix_nano"], workflow["end_time_unix_nano"])
+        if end > start:
+            busy += end - start
+            cursor = end
+    return round((workflow["end_time_unix_nano"] - workflow["start_time_unix_nano"] - busy) / 1e6, 3)
+
+
+def report(spans, order_id=None):
+    workflows = workflow_spans(spans)
+    if order_id:
+        workflows = [span for span in workflows if span["attributes"].get("workflow.instance_id") == order_id]
+    if not workflows:
+        return f"No traced workflow{' for ' + order_id if order_id else ''}"
+    workflow = max(workflows, key=lambda s: s["duration_ms"])
+    trace = [span for span in spans if span["trace_id"] == workflow["trace_id"]]
+
+    roots, children = build_tree(trace)
+    path = critical_path(roots, children)
+    origin = min(span["start_time_unix_nano"] for span in trace)
+    lines = [f"Order {workflow['attributes'].get('workflow.instance_id')} "
+             f"({workflow['attributes'].get('workflow.status')}), trace {workflow['trace_id']}",
+             f"{'':2}{'start ms':>10}{'duration ms':>13}  {'service':<16}span"]
+
+    def walk(span, depth):
+        marker = "*" if span["span_id"] in path else " "
+        error = f"  error: {span['error']}" if span["error"] else ""
+        lines.append(f"{marker:2}{(span['start_time_unix_nano'] - origin) / 1e6:>10.3f}{span['duration_ms']:>13.3f}  "
+                     f"{span['service']:<16}{'  ' * depth}{span['name']}{error}")
+        for child in children[span["span_id"]]:
+            walk(child, depth + 1)
+
+    for root in roots:
+        walk(root, 0)
+    lines.append(f"Workflow {workflow['duration_ms']:.3f} ms, of which {waiting_ms(workflow, children):.3f} ms "
+                 f"between activities. * marks the critical path.")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="span files written by the services")
+    parser.add_argument("--order", help="instance ID of the order, the slowest traced order if omitted")
+    args = parser.parse_args()
+    print(report(load_spans(args.files), args.order))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,476 @@
+"""In-process stand-in for the Dapr workflow engine.
+
+Workflows run the same way the durable task engine runs them: every time something new
+happens to an instance (an activity finishes, a timer fires, an event arrives) the workflow
+generator is replayed from the start against the recorded history until it yields a task that
+has not completed yet. Inputs and outputs cross the same JSON boundary as in the real SDK.
+"""
+import heapq
+import inspect
+import itertools
+import json
+import threading
+import time
+import traceback
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import dapr.ext.workflow as wf
+from durabletask.internal.shared import InternalJSONDecoder, InternalJSONEncoder
+
+TERMINAL_STATUSES = (wf.WorkflowStatus.COMPLETED, wf.WorkflowStatus.FAILED, wf.WorkflowStatus.TERMINATED)
+
+
+def serialize(value):
+    return None if value is None else json.dumps(value, cls=InternalJSONEncoder)
+
+
+def deserialize(data):
+    return None if data is None else json.loads(data, cls=InternalJSONDecoder)
+
+
+def call_registered(fn, ctx, input):
+    """Call a workflow or activity the way dapr-ext-workflow's wrappers do, without an input if it is None."""
+    return fn(ctx) if input is None else fn(ctx, input)
+
+
+class TaskFailedError(Exception):
+    def __init__(self, message, details):
+        super().__init__(message)
+        self.details = details
+
+
+class FailureDetails:
+    def __init__(self, message, error_type, stack_trace):
+        self.message = message
+        self.error_type = error_type
+        self.stack_trace = stack_trace
+
+
+class Task:
+    def __init__(self):
+        self.is_complete = False
+        self.result = None
+        self.exception = None
+        self.completed_at = None
+        self.ordinal = None
+
+    def complete(self, result, exception, completed_at, ordinal):
+        self.is_complete = True
+        self.result = result
+        self.exception = exception
+        self.completed_at = completed_at
+        self.ordinal = ordinal
+
+    def get_result(self):
+        return self.result
+
+    def primitives(self):
+        return [self]
+
+
+class ActivityTask(Task):
+    def __init__(self, seq, activity, activity_input, retry_policy):
+        super().__init__()
+        self.seq = seq
+        self.activity = activity
+        self.input = activity_input
+        self.retry_policy = retry_policy
+
+
+class TimerTask(Task):
+    def __init__(self, seq, fire_at):
+        super().__init__()
+        self.seq = seq
+        self.fire_at = fire_at
+
+
+class EventTask(Task):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+
+class CompositeTask(Task):
+    def __init__(self, children):
+        super().__init__()
+        self.children = list(children)
+
+    def primitives(self):
+        return [p for child in self.children if not child.is_complete for p in child.primitives()]
+
+
+class WhenAnyTask(CompositeTask):
+    def __init__(self, children):
+        super().__init__(children)
+        done = [child for child in self.children if child.is_complete]
+        if done:
+            winner = min(done, key=lambda child: child.ordinal)
+            self.complete(winner, None, winner.completed_at, winner.ordinal)
+
+
+class WhenAllTask(CompositeTask):
+    def __init__(self, children):
+        super().__init__(children)
+        failed = [child for child in self.children if child.is_complete and child.exception]
+        if failed:
+            first = min(failed, key=lambda child: child.ordinal)
+            self.complete(None, first.exception, first.completed_at, first.ordinal)
+        elif all(child.is_complete for child in self.children):
+            last = max(self.children, key=lambda child: child.ordinal or 0, default=None)
+            self.complete([child.result for child in self.children], None,
+                          last.completed_at if last else None, last.ordinal if last else 0)
+
+
+def when_any(tasks):
+    return WhenAnyTask(tasks)
+
+
+def when_all(tasks):
+    return WhenAllTask(tasks)
+
+
+class ActivityContext:
+    def __init__(self, workflow_id, task_id):
+        self._workflow_id = workflow_id
+        self._task_id = task_id
+
+    @property
+    def workflow_id(self):
+        return self._workflow_id
+
+    @property
+    def task_id(self):
+        return self._task_id
+
+
+class Instance:
+    def __init__(self, instance_id, name, serialized_input):
+        self.instance_id = instance_id
+        self.name = name
+        self.serialized_input = serialized_input
+        self.serialized_output = None
+        self.serialized_custom_status = None
+        self.failure_details = None
+        self.runtime_status = wf.WorkflowStatus.RUNNING
+        self.created_at = datetime.now(timezone.utc)
+        self.last_updated_at = self.created_at
+        self.completed_monotonic = None
+        self.started_monotonic = time.monotonic()
+        # seq -> (result, exception, completed_at, ordinal) for activities and timers
+        self.results = {}
+        # event name -> [(payload, received_at, ordinal)]
+        self.events = {}
+        self.scheduled = set()
+        self.waiting_for = set()
+        self.history_events = 1  # ExecutionStarted
+        self.replays = 0
+        self.ordinals = itertools.count(1)
+        self.lock = threading.RLock()
+        self.done = threading.Event()
+
+
+class ReplayContext:
+    """The `DaprWorkflowContext` handed to a workflow during one replay."""
+
+    def __init__(self, instance: Instance):
+        self._instance = instance
+        self._seq = itertools.count()
+        self._event_counts = {}
+        self._now = instance.created_at
+        # Ordinal of the newest history event, the workflow is replaying until it has consumed it
+        self._latest = max([r[3] for r in instance.results.values()] +
+                           [e[2] for events in instance.events.values() for e in events], default=0)
+        self._position = 0
+        # Tasks created but not completed yet; like the real runtime, they are scheduled whether or not they are yielded
+        self.pending = []
+
+    @property
+    def instance_id(self):
+        return self._instance.instance_id
+
+    @property
+    def current_utc_datetime(self):
+        return self._now
+
+    @property
+    def is_replaying(self):
+        return self._position < self._latest
+
+    def set_custom_status(self, custom_status):
+        # Like durabletask, strings are stored as they are and only other values as JSON
+        self._instance.serialized_custom_status = custom_status if isinstance(custom_status, str) \
+            else serialize(custom_status)
+
+    def call_activity(self, activity, *, input=None, retry_policy=None):
+        task = ActivityTask(next(self._seq), activity, input, retry_policy)
+        self._resolve(task, self._instance.results.get(task.seq))
+        return task
+
+    def create_timer(self, fire_at):
+        if not isinstance(fire_at, datetime):
+            fire_at = self._now + fire_at
+        task = TimerTask(next(self._seq), fire_at)
+        self._resolve(task, self._instance.results.get(task.seq))
+        return task
+
+    def wait_for_external_event(self, name):
+        name = name.lower()
+        task = EventTask(name)
+        index = self._event_counts.get(name, 0)
+        self._event_counts[name] = index + 1
+        received = self._instance.events.get(name, [])
+        if index < len(received):
+            payload, received_at, ordinal = received[index]
+            task.complete(payload, None, received_at, ordinal)
+        return task
+
+    def consumed(self, task):
+        # Time only moves forward as the workflow consumes completed history, which keeps replays deterministic
+        self._position = max(self._position, task.ordinal or 0)
+        if task.completed_at and task.completed_at > self._now:
+            self._now = task.completed_at
+
+    def _resolve(self, task, recorded):
+        if recorded:
+            task.complete(*recorded)
+        else:
+            self.pending.append(task)
+
+
+class WorkflowEngine:
+    """Runs registered workflows and activities in-process."""
+
+    def __init__(self, max_activity_workers=64):
+        self._workflows = {}
+        self._activities = {}
+        self._instances = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_activity_workers, thread_name_prefix="standin-activity")
+        self._timers = []
+        self._timer_cond = threading.Condition()
+        self._stopped = False
+        self._timer_thread = threading.Thread(target=self._run_timers, name="standin-timers", daemon=True)
+        self._timer_thread.start()
+        self.activity_timings = {}
+        self._timings_lock = threading.Lock()
+
+    # Registration, as done by WorkflowRuntime
+
+    def register_workflow(self, fn, *, name=None):
+        self._workflows[name or fn.__name__] = fn
+
+    def register_activity(self, fn, *, name=None):
+        self._activities[name or fn.__name__] = fn
+
+    def shutdown(self):
+        self._stopped = True
+        with self._timer_cond:
+            self._timer_cond.notify()
+        self._executor.shutdown(wait=True)
+
+    # Client operations, as done by DaprWorkflowClient
+
+    def schedule(self, workflow, workflow_input=None, instance_id=None):
+        name = workflow if isinstance(workflow, str) else workflow.__name__
+        if name not in self._workflows:
+            raise ValueError(f"Workflow {name} is not registered")
+        instance = Instance(instance_id or f"standin-{time.monotonic_ns()}", name, serialize(workflow_input))
+        with self._lock:
+            existing = self._instances.get(instance.instance_id)
+            if existing and existing.runtime_status not in TERMINAL_STATUSES:
+                raise RuntimeError(f"An active workflow with ID {instance.instance_id} already exists")
+            self._instances[instance.instance_id] = instance
+        self._executor.submit(self._replay, instance)
+        return instance.instance_id
+
+    def get(self, instance_id):
+        return self._instances.get(instance_id)
+
+    def instances(self):
+        return list(self._instances.values())
+
+    def raise_event(self, instance_id, name, data=None):
+        instance = self._instances.get(instance_id)
+        if not instance:
+            raise RuntimeError(f"No workflow with ID {instance_id}")
+        with instance.lock:
+            instance.events.setdefault(name.lower(), []).append(
+                (deserialize(serialize(data)), datetime.now(timezone.utc), next(instance.ordinals)))
+            instance.history_events += 1  # EventRaised
+        self._executor.submit(self._replay, instance)
+
+    def terminate(self, instance_id, output=None):
+        instance = self._instances.get(instance_id)
+        if instance:
+            with instance.lock:
+                self._finish(instance, wf.WorkflowStatus.TERMINATED, output=output)
+
+    def is_waiting_for_event(self, instance_id, name):
+        instance = self._instances.get(instance_id)
+        return bool(instance) and name.lower() in instance.waiting_for
+
+    # Execution
+
+    def _replay(self, instance: Instance):
+        with instance.lock:
+            if instance.runtime_status in TERMINAL_STATUSES:
+                return
+            instance.replays += 1
+            ctx = ReplayContext(instance)
+            instance.waiting_for = set()
+            gen = call_registered(self._workflows[instance.name], ctx, deserialize(instance.serialized_input))
+            if not inspect.isgenerator(gen):
+                self._finish(instance, wf.WorkflowStatus.COMPLETED, output=gen)
+                return
+
+            send_value, throw = None, None
+            try:
+                while True:
+                    task = gen.throw(throw) if throw else gen.send(send_value)
+                    send_value, throw = None, None
+                    if task.is_complete:
+                        ctx.consumed(task)
+                        if task.exception:
+                            throw = task.exception
+                        else:
+                            send_value = task.result
+                        continue
+                    for pending in ctx.pending + [task]:
+                        self._schedule(instance, pending)
+                    instance.last_updated_at = datetime.now(timezone.utc)
+                    return
+            except StopIteration as done:
+                self._finish(instance, wf.WorkflowStatus.COMPLETED, output=done.value)
+            except Exception as e:
+                self._finish(instance, wf.WorkflowStatus.FAILED, error=e)
+
+    def _schedule(self, instance, task):
+        for primitive in task.primitives():
+            if isinstance(primitive, EventTask):
+                instance.waiting_for.add(primitive.name)
+                continue
+            if primitive.seq in instance.scheduled:
+                continue
+            instance.scheduled.add(primitive.seq)
+            instance.history_events += 1  # TaskScheduled / TimerCreated
+            if isinstance(primitive, ActivityTask):
+                self._executor.submit(self._run_activity, instance, primitive.seq, primitive.activity,
+                                      serialize(primitive.input), primitive.retry_policy)
+            else:
+                with self._timer_cond:
+                    heapq.heappush(self._timers, (primitive.fire_at, instance.instance_id, primitive.seq))
+                    self._timer_cond.notify()
+
+    def _run_activity(self, instance, seq, activity, serialized_input, retry_policy):
+        name = activity.__name__
+        attempts = retry_policy.max_number_of_attempts if retry_policy else 1
+        delay = retry_policy.first_retry_interval.total_seconds() if retry_policy else 0
+        start = time.perf_counter()
+        for attempt in range(1, attempts + 1):
+            try:
+                result = call_registered(activity, ActivityContext(instance.instance_id, seq),
+                                         deserialize(serialized_input))
+                result, error = deserialize(serialize(result)), None
+                break
+            except Exception as e:
+                result, error = None, e
+                if attempt < attempts:
+                    time.sleep(delay)
+                    delay *= retry_policy.backoff_coefficient
+                    if retry_policy.max_retry_interval:
+                        delay = min(delay, retry_policy.max_retry_interval.total_seconds())
+        elapsed = time.perf_counter() - start
+
+        with self._timings_lock:
+            self.activity_timings.setdefault(name, []).append(elapsed)
+
+        if error:
+            details = FailureDetails(str(error), type(error).__name__, traceback.format_exc())
+            error = TaskFailedError(f"Activity task #{seq} failed: {error}", details)
+        with instance.lock:
+            instance.results[seq] = (result, error, datetime.now(timezone.utc), next(instance.ordinals))
+            instance.history_events += 1  # TaskCompleted / TaskFailed
+        self._replay(instance)
+
+    def _run_timers(self):
+        while not self._stopped:
+            with self._timer_cond:
+                now = datetime.now(timezone.utc)
+                if not self._timers or self._timers[0][0] > now:
+                    timeout = (self._timers[0][0] - now).total_seconds() if self._timers else None
+                    self._timer_cond.wait(timeout)
+                    continue
+                _, instance_id, seq = heapq.heappop(self._timers)
+            instance = self._instances.get(instance_id)
+            if not instance or instance.runtime_status in TERMINAL_STATUSES:
+                continue
+            with instance.lock:
+                instance.results[seq] = (None, None, datetime.now(timezone.utc), next(instance.ordinals))
+                instance.history_events += 1  # TimerFired
+            self._executor.submit(self._replay, instance)
+
+    def _finish(self, instance, status, output=None, error=None):
+        instance.runtime_status = status
+        instance.serialized_output = serialize(output)
+        if error:
+            details = getattr(error, "details", None)
+            instance.failure_details = FailureDetails(
+                details.message if details else str(error),
+                details.error_type if details else type(error).__name__,
+                details.stack_trace if details else traceback.format_exc())
+        instance.history_events += 1  # ExecutionCompleted
+        instance.last_updated_at = datetime.now(timezone.utc)
+        instance.completed_monotonic = time.monotonic()
+        instance.done.set()
+
+
+class StandInWorkflowRuntime:
+    def __init__(self, engine: WorkflowEngine):
+        self._engine = engine
+
+    def register_workflow(self, fn, *, name=None):
+        self._engine.register_workflow(fn, name=name)
+
+    def register_activity(self, fn, *, name=None):
+        self._engine.register_activity(fn, name=name)
+
+    def start(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class StandInWorkflowClient:
+    def __init__(self, engine: WorkflowEngine):
+        self._engine = engine
+
+    def schedule_new_workflow(self, workflow, *, input=None, instance_id=None, start_at=None, reuse_id_policy=None):
+        return self._engine.schedule(workflow, input, instance_id)
+
+    def get_workflow_state(self, instance_id, *, fetch_payloads=True):
+        return self._engine.get(instance_id)
+
+    def raise_workflow_event(self, instance_id, event_name, *, data=None):
+        self._engine.raise_event(instance_id, event_name, data)
+
+    def terminate_workflow(self, instance_id, *, output=None):
+        self._engine.terminate(instance_id, output)
+
+    def wait_for_workflow_completion(self, instance_id, *, fetch_payloads=True, timeout_in_seconds=60):
+        instance = self._engine.get(instance_id)
+        if instance and instance.done.wait(timeout_in_seconds):
+            return instance
+        raise TimeoutError(f"Workflow {instance_id} did not complete in {timeout_in_seconds}s")
+
+
+def workflow_module(engine: WorkflowEngine):
+    """A drop-in replacement for the `dapr.ext.workflow` module bound to `engine`."""
+    module = types.SimpleNamespace(**{name: getattr(wf, name) for name in dir(wf) if not name.startswith("_")})
+    module.when_any = when_any
+    module.when_all = when_all
+    module.WorkflowRuntime = lambda *args, **kwargs: StandInWorkflowRuntime(engine)
+    module.DaprWorkflowClient = lambda *args, **kwargs: StandInWorkflowClient(engine)
+    return module
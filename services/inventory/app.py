@@ -1,21 +1,159 @@
 from typing import List
+import json
 import logging
 import os
+import random
+import threading
+import time
 import grpc
 from dapr.clients import DaprClient
+from dapr.clients.grpc._request import TransactionalStateOperation, TransactionOperationType
 from dapr.clients.grpc._state import StateItem
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, Response, request, jsonify, make_response, url_for
+from catalog import Catalog, CatalogConflictError
+from codec import decode_request, encode_response
+from faults import install_faults
+from holds import COMMITTED, HELD, HoldIndex, HoldIndexConflictError, HoldSweeper, hold_key
+from metrics import Counter, InstrumentedDaprClient, instrument_app, registry
+from serving import serve
+from tracing import TracedDaprClient, install_tracing, tracer
 
 APP_PORT = int(os.getenv("APP_PORT", 3002))
 STATESTORE_NAME = os.getenv("STATESTORE_NAME", "statestore")
+RESERVE_MAX_RETRIES = int(os.getenv("RESERVE_MAX_RETRIES", 10))
+RESERVE_BACKOFF_BASE_MS = float(os.getenv("RESERVE_BACKOFF_BASE_MS", 5))
+RESERVE_BACKOFF_MAX_MS = float(os.getenv("RESERVE_BACKOFF_MAX_MS", 200))
+INVENTORY_CACHE_TTL_SECONDS = float(os.getenv("INVENTORY_CACHE_TTL_SECONDS", 2.0))
+INVENTORY_BULK_PARALLELISM = int(os.getenv("INVENTORY_BULK_PARALLELISM", 4))
+RESERVE_BATCH_MAX_ITEMS = int(os.getenv("RESERVE_BATCH_MAX_ITEMS", 100))
+INVENTORY_PAGE_SIZE = int(os.getenv("INVENTORY_PAGE_SIZE", 100))
+INVENTORY_MAX_PAGE_SIZE = int(os.getenv("INVENTORY_MAX_PAGE_SIZE", 1000))
+# SKUs read, written or deleted per sidecar call by listings and bulk operations
+INVENTORY_BULK_CHUNK_SIZE = int(os.getenv("INVENTORY_BULK_CHUNK_SIZE", 500))
+RESTOCK_DEFAULT_QUANTITY = int(os.getenv("RESTOCK_DEFAULT_QUANTITY", 100))
+RESTOCK_MAX_ITEMS = int(os.getenv("RESTOCK_MAX_ITEMS", 100000))
+# Reserved stock goes back on sale unless the order is committed within this time
+HOLD_TTL_SECONDS = float(os.getenv("HOLD_TTL_SECONDS", 15 * 60))
+# How long a committed hold is kept, so the stock can still be released if shipping fails
+HOLD_COMMITTED_RETENTION_SECONDS = float(os.getenv("HOLD_COMMITTED_RETENTION_SECONDS", 7 * 24 * 60 * 60))
+HOLD_SWEEP_MAX_BUCKETS = int(os.getenv("HOLD_SWEEP_MAX_BUCKETS", 60))
 
 app = Flask(__name__)
+instrument_app(app)
+install_tracing(app)
+install_faults(app)
 
 logger = logging.getLogger("inventory_service")
 
+# Stocked by a restock without a body while the catalog is still empty
 INVENTORY_ITEMS = ["orange", "apple", "pear", "kiwi"]
 
 
+# gRPC codes returned by the sidecar when an ETag no longer matches
+ETAG_CONFLICT_CODES = (grpc.StatusCode.ABORTED, grpc.StatusCode.FAILED_PRECONDITION)
+# A state transaction that fails on an ETag comes back as INTERNAL, with the state store's error in the message
+ETAG_MISMATCH_MESSAGE = "etag mismatch"
+
+
+class ReservationStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reservations = 0
+        self.conflicts = 0
+        self.retries_exhausted = 0
+        self.reserved = 0
+
+    def record(self, reservations=0, conflicts=0, retries_exhausted=0, reserved=0):
+        with self._lock:
+            self.reservations += reservations
+            self.conflicts += conflicts
+            self.retries_exhausted += retries_exhausted
+            self.reserved += reserved
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "reservations": self.reservations,
+                "conflicts": self.conflicts,
+                "conflict_rate": self.conflicts / self.reservations if self.reservations else 0.0,
+                "retries_exhausted": self.retries_exhausted,
+                "reserved": self.reserved,
+            }
+
+
+reservation_stats = ReservationStats()
+
+
+class ReservationConflictError(Exception):
+    pass
+
+
+def is_etag_conflict(err: grpc.RpcError) -> bool:
+    """Whether a write or state transaction failed because another writer changed a key first."""
+    if err.code() in ETAG_CONFLICT_CODES:
+        return True
+    return err.code() == grpc.StatusCode.INTERNAL and ETAG_MISMATCH_MESSAGE in (err.details() or "").lower()
+
+
+def dapr_client():
+    return InstrumentedDaprClient(TracedDaprClient(DaprClient()))
+
+
+class InventoryCache:
+    """A read-through cache for the inventory listing with a time-to-live.
+
+    Only one request reloads an expired listing at a time, the others wait for its result.
+    Every write bumps a generation counter, so a load that started before an invalidation
+    is returned to its caller but never cached.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self._ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._value = None
+        self._expires_at = 0.0
+        self._generation = 0
+
+    def get(self, loader):
+        if self._ttl <= 0:
+            return loader()
+
+        with self._lock:
+            if self._value is not None and time.monotonic() < self._expires_at:
+                return self._value
+
+        with self._load_lock:
+            with self._lock:
+                if self._value is not None and time.monotonic() < self._expires_at:
+                    return self._value
+                generation = self._generation
+
+            value = loader()
+
+            with self._lock:
+                if generation == self._generation:
+                    self._value = value
+                    self._expires_at = time.monotonic() + self._ttl
+            return value
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._value = None
+
+
+inventory_cache = InventoryCache(INVENTORY_CACHE_TTL_SECONDS)
+
+catalog = Catalog(dapr_client)
+
+hold_index = HoldIndex(dapr_client)
+
+HOLDS_EXPIRED = Counter(registry, "inventory_holds_expired_total", "Holds released because they expired.")
+HOLDS_FORGOTTEN = Counter(registry, "inventory_holds_forgotten_total",
+                          "Committed holds deleted once their retention ended.")
+
+
 class InventoryItem:
     def __init__(self, item: str, quantity: int):
         self.item = item
@@ -25,92 +163,245 @@ class InventoryItem:
         return {"name": self.item, "quantity": self.quantity}
 
 
-@app.route('/api/v1/inventory', methods=['GET'])
-def get_inventory():
+def chunks(values, size=INVENTORY_BULK_CHUNK_SIZE):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
 
+def load_items(d, skus):
+    """Read the stock of some SKUs in one round trip. SKUs without stock are left out."""
+    # The sidecar fans the reads out in parallel
+    resp = d.get_bulk_state(STATESTORE_NAME, skus, parallelism=INVENTORY_BULK_PARALLELISM)
+
+    states = {state.key: state for state in resp.items}
     inventory = []
+    for sku in skus:
+        state = states.get(sku)
+        if not state:
+            continue
+        if state.error:
+            logger.warning(f'Error retrieving inventory item {sku}: {state.error}')
+            continue
+        if state.data:
+            value = int(state.data.decode('utf-8'))
+            inventory.append(InventoryItem(item=sku, quantity=value).to_dict())
+    return inventory
+
+
+def load_inventory(cursor=None, limit=INVENTORY_PAGE_SIZE):
+    """Return a page of the inventory and the cursor of the next page, or None on the last page."""
+    skus, next_cursor = catalog.page(cursor, limit)
+    if not skus:
+        return [], None
+    with dapr_client() as d:
+        return load_items(d, skus), next_cursor
 
-    with DaprClient() as d:
+
+@app.route('/api/v1/inventory', methods=['GET'])
+def get_inventory():
+    limit = request.args.get('limit', INVENTORY_PAGE_SIZE, type=int)
+    cursor = request.args.get('cursor') or None
+    if not 1 <= limit <= INVENTORY_MAX_PAGE_SIZE:
+        return make_response(
+            jsonify({"error": "Bad Request", "message": f"limit must be between 1 and {INVENTORY_MAX_PAGE_SIZE}"}),
+            400
+        )
+    if cursor:
         try:
-            for item_key in INVENTORY_ITEMS:
-                item = d.get_state(STATESTORE_NAME, item_key.lower())
+            catalog.parse_cursor(cursor)
+        except ValueError as err:
+            return make_response(jsonify({"error": "Bad Request", "message": str(err)}), 400)
+
+    try:
+        # Dashboards poll the first page, so that is the page worth caching
+        if cursor is None and limit == INVENTORY_PAGE_SIZE:
+            inventory, next_cursor = inventory_cache.get(load_inventory)
+        else:
+            inventory, next_cursor = load_inventory(cursor, limit)
+
+        if not inventory and cursor is None:
+            return jsonify({"message": "No inventory available."})
+
+        response = jsonify(inventory)
+        if next_cursor:
+            next_url = url_for('get_inventory', cursor=next_cursor, limit=limit, _external=True)
+            response.headers['Link'] = f'<{next_url}>; rel="next"'
+        return response
+
+    except grpc.RpcError as err:
+        logger.error(f'Error retrieving inventory: {err.details()}')
+        return make_response(
+            jsonify({"error": "Internal Server Error", "message": "Failed to retrieve inventory"}),
+            500
+        )
 
-                if item.data:
-                    value = item.data.decode('utf-8')
-                    inventory.append(InventoryItem(item=item_key, quantity=value).to_dict())
 
-            if not inventory:
-                return jsonify({"message": "No inventory available."})
-            
-            return jsonify(inventory)
+# Streams the whole inventory as one JSON object per line, without holding it all in memory
+@app.route('/api/v1/inventory/stream', methods=['GET'])
+def stream_inventory():
+    try:
+        skus = catalog.skus()
+    except grpc.RpcError as err:
+        logger.error(f'Error retrieving inventory: {err.details()}')
+        return make_response(
+            jsonify({"error": "Internal Server Error", "message": "Failed to retrieve inventory"}),
+            500
+        )
 
+    def generate():
+        try:
+            with dapr_client() as d:
+                for chunk in chunks(skus):
+                    yield "".join(json.dumps(item) + "\n" for item in load_items(d, chunk))
         except grpc.RpcError as err:
-            logger.error(f'Error retrieving inventory: {err.details()}')
-            return make_response(
-                jsonify({"error": "Internal Server Error", "message": "Failed to retrieve inventory"}),
-                500
-            )
+            # The status has already been sent, so a truncated stream is all the client sees
+            logger.error(f'Error streaming inventory: {err.details()}')
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+def delete_items(skus):
+    """Delete the stock of many SKUs in chunked transactions and drop them from the catalog."""
+    with dapr_client() as d:
+        for chunk in chunks(skus):
+            d.execute_state_transaction(STATESTORE_NAME, [
+                TransactionalStateOperation(key=sku, operation_type=TransactionOperationType.delete)
+                for sku in chunk])
+    catalog.remove(skus)
 
 
 @app.route('/api/v1/inventory', methods=['DELETE'])
 def clear_inventory():
-    with DaprClient() as d:
-        try:
-            for item_key in INVENTORY_ITEMS:
-                d.delete_state(STATESTORE_NAME, item_key.lower())
+    try:
+        # Read the index afresh, another process may have added SKUs since it was cached
+        catalog.invalidate()
+        skus = sorted(set(catalog.skus()) | set(INVENTORY_ITEMS))
+        delete_items(skus)
 
-            logger.info("Inventory cleared successfully")
-            return jsonify({"message": "Inventory has been cleared."})
+        logger.info(f"Inventory cleared successfully: {len(skus)} items")
+        return jsonify({"message": "Inventory has been cleared.", "deleted": len(skus)})
 
-        except grpc.RpcError as err:
-            logger.error(f'Error clearing inventory: {err.details()}')
-            return make_response(
-                jsonify({"error": "Internal Server Error", "message": "Failed to clear inventory"}),
-                500
-            )
+    except (grpc.RpcError, CatalogConflictError) as err:
+        logger.error(f'Error clearing inventory: {str(err)}')
+        return make_response(
+            jsonify({"error": "Internal Server Error", "message": "Failed to clear inventory"}),
+            500
+        )
+
+    finally:
+        # Some items may have been deleted even if a later delete failed
+        inventory_cache.invalidate()
+
+
+def parse_skus(items):
+    """Return the SKUs of a list of item names, and an error message if they are invalid."""
+    if not isinstance(items, list) or not items:
+        return None, "Missing items"
+    if len(items) > RESTOCK_MAX_ITEMS:
+        return None, f"Too many items: {len(items)} > {RESTOCK_MAX_ITEMS}"
+    if not all(isinstance(item, str) and item for item in items):
+        return None, "Every item needs a name"
+    return sorted({item.lower() for item in items}), None
+
+
+# Deletes the stock of some items and drops them from the catalog
+@app.route('/api/v1/inventory/delete', methods=['POST'])
+def delete_inventory():
+    body = decode_request()
+    skus, error = parse_skus(body.get('items') if isinstance(body, dict) else None)
+    if error:
+        return make_response(
+            jsonify({"error": "Bad Request", "message": error}),
+            400
+        )
+
+    try:
+        delete_items(skus)
+        logger.info(f"Deleted {len(skus)} inventory items")
+        return jsonify({"message": "Inventory items have been deleted.", "deleted": len(skus)})
+
+    except (grpc.RpcError, CatalogConflictError) as err:
+        logger.error(f'Error deleting inventory items: {str(err)}')
+        return make_response(
+            jsonify({"error": "Internal Server Error", "message": "Failed to delete inventory items"}),
+            500
+        )
+
+    finally:
+        inventory_cache.invalidate()
+
+
+def parse_restock(body):
+    """Return the quantity to stock per SKU, and an error message if the request is invalid.
+
+    Without a list of items every SKU in the catalog, or the default items if there are none
+    yet, is stocked with RESTOCK_DEFAULT_QUANTITY.
+    """
+    items = body.get('items') if isinstance(body, dict) else None
+    if items is None:
+        skus = catalog.skus() or INVENTORY_ITEMS
+        return {sku: RESTOCK_DEFAULT_QUANTITY for sku in skus}, None
+
+    if not isinstance(items, list) or not items:
+        return None, "Missing items"
+    if len(items) > RESTOCK_MAX_ITEMS:
+        return None, f"Too many items: {len(items)} > {RESTOCK_MAX_ITEMS}"
+
+    quantities = {}
+    for line in items:
+        if not isinstance(line, dict) or not isinstance(line.get('item'), str) or not line['item']:
+            return None, "Every item needs a name"
+        quantity = line.get('quantity', RESTOCK_DEFAULT_QUANTITY)
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 0:
+            return None, f"Invalid quantity for item {line['item']}"
+        quantities[line['item'].lower()] = quantity
+    return quantities, None
 
 
 @app.route('/api/v1/inventory/restock', methods=['POST'])
 def restock_inventory():
     try:
-        with DaprClient() as d:
-            state_items = []
-            
-            # Create a StateItem for each inventory item
-            for item_key in INVENTORY_ITEMS:
-                state_item = StateItem(
-                    key=item_key,
-                    value="100",  # Default quantity
-                    etag="",  # No etag since we're just overwriting
-                    metadata={},
-                    options=None
-                )
-                state_items.append(state_item)
-            
-            # Save all items in a single operation
-            d.save_bulk_state(store_name=STATESTORE_NAME, states=state_items)
-
-        logger.info("Inventory restocked successfully")
-        return jsonify({"message": "Inventory has been restocked."})
-    
-    except grpc.RpcError as err:
-        logger.error(f'Error restocking inventory: {err.details()}')
+        quantities, error = parse_restock(decode_request())
+        if error:
+            return make_response(
+                jsonify({"error": "Bad Request", "message": error}),
+                400
+            )
+
+        skus = sorted(quantities)
+        with dapr_client() as d:
+            # Overwrite the stock in chunks, so no single call grows with the catalog
+            for chunk in chunks(skus):
+                d.save_bulk_state(store_name=STATESTORE_NAME, states=[
+                    StateItem(key=sku, value=str(quantities[sku])) for sku in chunk])
+
+        # Listed once stocked, so the listing never shows an item before it can be reserved
+        catalog.add(skus)
+
+        logger.info(f"Inventory restocked successfully: {len(skus)} items")
+        return jsonify({"message": "Inventory has been restocked.", "restocked": len(skus)})
+
+    except (grpc.RpcError, CatalogConflictError) as err:
+        logger.error(f'Error restocking inventory: {str(err)}')
         return make_response(
             jsonify({"error": "Internal Server Error", "message": "Failed to restock inventory"}),
             500
         )
 
+    finally:
+        inventory_cache.invalidate()
+
 
 @app.route('/api/v1/inventory/reserve', methods=['POST'])
 def reserve_inventory():
-    if not request.is_json:
+    order = decode_request()
+    if order is None:
         return make_response(
-            jsonify({"error": "Bad Request", "message": "Request must be JSON"}),
+            jsonify({"error": "Bad Request", "message": "Request must be JSON or MessagePack"}),
             400
         )
-    
-    order = request.json
-    if not order or 'item' not in order or 'id' not in order:
+
+    if not isinstance(order, dict) or 'item' not in order or 'id' not in order:
         return make_response(
             jsonify({"error": "Bad Request", "message": "Invalid order format"}),
             400
@@ -118,49 +409,34 @@ def reserve_inventory():
     
     item = order['item']
     order_id = order['id']
-    
-    logger.info(f"Processing inventory reservation for order {order_id}: {item}")
+    quantity = order.get('quantity', 1)
+    if not is_valid_quantity(quantity):
+        return make_response(
+            jsonify({"error": "Bad Request", "message": f"Invalid quantity for item {item}"}),
+            400
+        )
+
+    logger.info(f"Processing inventory reservation for order {order_id}: {quantity} x {item}")
 
-    # Check if we have enough inventory to fulfill the order
     try:
-        with DaprClient() as d:
-            
-            # Get the state for this item
-            state_response = d.get_state(STATESTORE_NAME, item.lower())
-            
-            # Check if we got any data back
-            if not state_response.data:
-                return jsonify({
-                    "id": order_id,
-                    "success": False,
-                    "message": f"Item {item} not found in inventory"
-                })
-            
-            # Safely decode and convert the quantity
-            try:
-                quantity = int(state_response.data.decode('utf-8'))
-            except (AttributeError, ValueError) as e:
-                logger.error(f"Error processing item {item}: {e}")
-                return jsonify({
-                    "id": order_id,
-                    "success": False,
-                    "message": f"Error processing item {item}: {str(e)}"
-                })
-            
-            if not quantity or quantity <= 0:
-                return jsonify({
-                    "id": order_id,
-                    "success": False,
-                    "message": f"Item {item} is out of stock"
-                })
-        
-            # If we get here, the item is available
-            return make_response(jsonify({
-                "id": order_id,
-                "success": True,
-                "message": "Item reserved successfully"
-            }))
-    
+        with dapr_client() as d:
+            success, message = update_holds(d, order_id, {item: quantity}, RESERVE)
+
+        if success:
+            inventory_cache.invalidate()
+
+        return encode_response({
+            "id": order_id,
+            "success": success,
+            "message": message
+        })
+
+    except ReservationConflictError as err:
+        logger.warning(f'Reservation for order {order_id} gave up: {str(err)}')
+        return make_response(
+            jsonify({"error": "Conflict", "message": str(err)}),
+            409
+        )
     except grpc.RpcError as err:
         logger.error(f'Error reserving inventory: {err.details()}')
         return make_response(
@@ -175,6 +451,330 @@ def reserve_inventory():
         )
 
 
+def is_valid_quantity(quantity):
+    return isinstance(quantity, int) and not isinstance(quantity, bool) and quantity > 0
+
+
+def parse_line_items(lines):
+    """Return the total quantity per item of a cart's line items, and an error message if they are invalid."""
+    if not isinstance(lines, list) or not lines:
+        return None, "Missing items"
+    if len(lines) > RESERVE_BATCH_MAX_ITEMS:
+        return None, f"Too many line items: {len(lines)} > {RESERVE_BATCH_MAX_ITEMS}"
+
+    quantities = {}
+    for line in lines:
+        if not isinstance(line, dict) or not isinstance(line.get('item'), str) or not line['item']:
+            return None, "Every line item needs an item"
+        quantity = line.get('quantity', 1)
+        if not is_valid_quantity(quantity):
+            return None, f"Invalid quantity for item {line['item']}"
+        quantities[line['item']] = quantities.get(line['item'], 0) + quantity
+    return quantities, None
+
+
+RESERVE = "reservation"
+COMMIT = "commit"
+RELEASE = "release"
+
+
+def update_holds(d, order_id: str, quantities: dict, action: str):
+    """Reserve, commit or release the stock an order holds, for all of its items at once.
+
+    Reserving takes the stock and records a hold per item that expires after HOLD_TTL_SECONDS.
+    Committing keeps the stock for good, taking it again if the hold has expired meanwhile.
+    Releasing puts the held or committed stock back. Each action is idempotent, so retries are
+    safe. Stock and holds are read in one bulk call and written in a single state transaction
+    that carries their ETags, so either all items change or none do. When another writer got in
+    between, the whole transaction is retried with jittered exponential backoff.
+    """
+    totals = {}
+    for item, quantity in quantities.items():
+        totals[item.lower()] = totals.get(item.lower(), 0) + quantity
+    keys = {sku: hold_key(order_id, sku) for sku in totals}
+    now = time.time()
+    expires_at = now + (HOLD_TTL_SECONDS if action == RESERVE else HOLD_COMMITTED_RETENTION_SECONDS)
+    if action != RELEASE:
+        # Indexed before they exist, so the sweeper finds them whatever happens next
+        hold_index.add(d, order_id, list(keys.values()), expires_at)
+    conflicts = 0
+
+    for attempt in range(RESERVE_MAX_RETRIES + 1):
+        resp = d.get_bulk_state(STATESTORE_NAME, list(totals) + list(keys.values()),
+                                parallelism=INVENTORY_BULK_PARALLELISM)
+        states = {state.key: state for state in resp.items}
+        for state in resp.items:
+            if state.error:
+                raise Exception(f"Error retrieving {state.key}: {state.error}")
+
+        operations = []
+        for sku, quantity in totals.items():
+            stock, hold_state = states[sku], states[keys[sku]]
+            hold = json.loads(hold_state.data) if hold_state.data else None
+
+            if action == RELEASE:
+                if not hold:
+                    # Released before, or expired and swept
+                    continue
+                change = hold["quantity"]
+            elif hold and (action == RESERVE or hold["status"] == COMMITTED):
+                # A retry of a reservation or commit that already went through
+                continue
+            else:
+                # A commit of a live hold keeps its stock, anything else takes stock
+                change = 0 if hold else -quantity
+
+            if change:
+                if not stock.data and change < 0:
+                    record_reservation(action, conflicts=conflicts)
+                    return False, f"Item {sku} not found in inventory"
+                try:
+                    available = int(stock.data.decode('utf-8')) if stock.data else 0
+                except (AttributeError, ValueError) as e:
+                    logger.error(f"Error processing item {sku}: {e}")
+                    record_reservation(action, conflicts=conflicts)
+                    return False, f"Error processing item {sku}: {str(e)}"
+                if available + change < 0:
+                    record_reservation(action, conflicts=conflicts)
+                    return False, f"Item {sku} is out of stock"
+                operations.append(TransactionalStateOperation(key=sku, data=str(available + change),
+                                                              etag=stock.etag or None))
+
+            if action == RELEASE:
+                operations.append(TransactionalStateOperation(key=keys[sku], etag=hold_state.etag,
+                                                              operation_type=TransactionOperationType.delete))
+            else:
+                operations.append(TransactionalStateOperation(key=keys[sku], etag=hold_state.etag or None, data=json.dumps({
+                    "order_id": order_id,
+                    "item": sku,
+                    "quantity": hold["quantity"] if hold else quantity,
+                    "status": HELD if action == RESERVE else COMMITTED,
+                    "expires_at": expires_at,
+                })))
+
+        if operations:
+            try:
+                d.execute_state_transaction(STATESTORE_NAME, operations)
+            except grpc.RpcError as err:
+                if not is_etag_conflict(err):
+                    raise
+                conflicts += 1
+                backoff_ms = min(RESERVE_BACKOFF_MAX_MS, RESERVE_BACKOFF_BASE_MS * 2 ** attempt)
+                time.sleep(random.uniform(0, backoff_ms) / 1000.0)
+                continue
+
+        record_reservation(action, conflicts=conflicts, reserved=sum(totals.values()))
+        if action == RELEASE:
+            return True, "Items released successfully"
+        if action == COMMIT:
+            return True, "Items committed successfully"
+        return True, "Item reserved successfully" if len(totals) == 1 else "Items reserved successfully"
+
+    record_reservation(action, conflicts=conflicts, retries_exhausted=1)
+    raise ReservationConflictError(f"Items {', '.join(quantities)} are under heavy contention, "
+                                   f"gave up after {conflicts} conflicts")
+
+
+def record_reservation(action: str, conflicts=0, retries_exhausted=0, reserved=0):
+    if action == RESERVE:
+        reservation_stats.record(reservations=1, conflicts=conflicts, retries_exhausted=retries_exhausted,
+                                 reserved=reserved)
+
+
+def adjust_stock_for_order(action: str):
+    order = decode_request()
+    if order is None:
+        return make_response(
+            jsonify({"error": "Bad Request", "message": "Request must be JSON or MessagePack"}),
+            400
+        )
+
+    if not isinstance(order, dict) or 'id' not in order:
+        return make_response(
+            jsonify({"error": "Bad Request", "message": "Invalid order format"}),
+            400
+        )
+
+    order_id = order['id']
+    quantities, error = parse_line_items(order.get('items'))
+    if error:
+        return make_response(
+            jsonify({"error": "Bad Request", "message": error}),
+            400
+        )
+
+    logger.info(f"Processing inventory {action} for order {order_id}: {quantities}")
+
+    try:
+        with dapr_client() as d:
+            success, message = update_holds(d, order_id, quantities, action)
+
+        if success:
+            inventory_cache.invalidate()
+
+        return encode_response({
+            "id": order_id,
+            "success": success,
+            "message": message
+        })
+
+    except (ReservationConflictError, HoldIndexConflictError) as err:
+        logger.warning(f'Inventory {action} for order {order_id} gave up: {str(err)}')
+        return make_response(
+            jsonify({"error": "Conflict", "message": str(err)}),
+            409
+        )
+    except grpc.RpcError as err:
+        logger.error(f'Error in inventory {action}: {err.details()}')
+        return make_response(
+            jsonify({"error": "Internal Server Error", "message": f"Failed inventory {action}"}),
+            500
+        )
+    except Exception as e:
+        logger.error(f'Unexpected error in inventory {action}: {str(e)}')
+        return make_response(
+            jsonify({"error": "Internal Server Error", "message": f"Unexpected error: {str(e)}"}),
+            500
+        )
+
+
+# Reserves every line item of a cart, or none of them
+@app.route('/api/v1/inventory/reserve/batch', methods=['POST'])
+def reserve_inventory_batch():
+    return adjust_stock_for_order(RESERVE)
+
+
+# Keeps the reserved stock of an order that is going ahead, so its holds no longer expire
+@app.route('/api/v1/inventory/commit', methods=['POST'])
+def commit_inventory():
+    return adjust_stock_for_order(COMMIT)
+
+
+# Puts the reserved or committed stock of a failed order back
+@app.route('/api/v1/inventory/release', methods=['POST'])
+def release_inventory():
+    return adjust_stock_for_order(RELEASE)
+
+
+def expire_holds(d, keys, now: float):
+    """Release the expired holds among `keys` in one transaction and delete expired committed holds.
+
+    Returns the number of holds released and deleted.
+    """
+    for attempt in range(RESERVE_MAX_RETRIES + 1):
+        resp = d.get_bulk_state(STATESTORE_NAME, keys, parallelism=INVENTORY_BULK_PARALLELISM)
+        expired = []
+        for state in resp.items:
+            if state.error:
+                raise Exception(f"Error retrieving hold {state.key}: {state.error}")
+            if state.data:
+                hold = json.loads(state.data)
+                if hold["expires_at"] <= now:
+                    expired.append((state, hold))
+        if not expired:
+            return 0, 0
+
+        # Several orders may have held the same item
+        returned = {}
+        for _, hold in expired:
+            if hold["status"] == HELD:
+                returned[hold["item"]] = returned.get(hold["item"], 0) + hold["quantity"]
+        stock = d.get_bulk_state(STATESTORE_NAME, list(returned), parallelism=INVENTORY_BULK_PARALLELISM).items \
+            if returned else []
+
+        operations = [TransactionalStateOperation(key=state.key, etag=state.etag,
+                                                  operation_type=TransactionOperationType.delete)
+                      for state, _ in expired]
+        for state in stock:
+            if state.error:
+                raise Exception(f"Error retrieving item {state.key}: {state.error}")
+            available = int(state.data.decode('utf-8')) if state.data else 0
+            operations.append(TransactionalStateOperation(key=state.key, data=str(available + returned[state.key]),
+                                                          etag=state.etag or None))
+        try:
+            d.execute_state_transaction(STATESTORE_NAME, operations)
+        except grpc.RpcError as err:
+            if not is_etag_conflict(err):
+                raise
+            backoff_ms = min(RESERVE_BACKOFF_MAX_MS, RESERVE_BACKOFF_BASE_MS * 2 ** attempt)
+            time.sleep(random.uniform(0, backoff_ms) / 1000.0)
+            continue
+
+        released = sum(1 for _, hold in expired if hold["status"] == HELD)
+        return released, len(expired) - released
+
+    raise ReservationConflictError(f"Gave up expiring {len(keys)} holds after {RESERVE_MAX_RETRIES} conflicts")
+
+
+def sweep_expired_holds(now: float):
+    """Reclaim the holds that expired in every index bucket that has ended since the last sweep.
+
+    The last bucket swept is saved in the state store, so the next sweep of any process picks
+    up where this one stopped.
+    """
+    released = forgotten = 0
+    last_bucket = hold_index.bucket_of(now) - 1
+    with dapr_client() as d:
+        swept, etag = hold_index.swept(d)
+        if swept is None:
+            return 0, 0
+
+        for bucket in range(swept + 1, min(last_bucket, swept + HOLD_SWEEP_MAX_BUCKETS) + 1):
+            keys = hold_index.bucket(d, bucket)
+            for chunk in chunks(keys):
+                bucket_released, bucket_forgotten = expire_holds(d, chunk, now)
+                released += bucket_released
+                forgotten += bucket_forgotten
+            hold_index.drop(d, bucket)
+
+            etag = hold_index.advance(d, bucket, etag)
+            if etag is None:
+                # Another process is sweeping too and has moved the cursor, leave the rest to it
+                break
+
+    if released or forgotten:
+        HOLDS_EXPIRED.inc(amount=released)
+        HOLDS_FORGOTTEN.inc(amount=forgotten)
+        inventory_cache.invalidate()
+        logger.info(f"Released {released} expired holds and deleted {forgotten} committed holds")
+    return released, forgotten
+
+
+hold_sweeper = HoldSweeper(sweep_expired_holds)
+
+
+# Sweeps expired holds right away instead of waiting for the background sweeper
+@app.route('/api/v1/inventory/holds/sweep', methods=['POST'])
+def sweep_holds():
+    try:
+        released, forgotten = sweep_expired_holds(time.time())
+        return jsonify({"released": released, "deleted": forgotten})
+
+    except (grpc.RpcError, ReservationConflictError) as err:
+        logger.error(f'Error sweeping expired holds: {str(err)}')
+        return make_response(
+            jsonify({"error": "Internal Server Error", "message": "Failed to sweep expired holds"}),
+            500
+        )
+
+
+@app.route('/api/v1/inventory/holds/<order_id>/<item>', methods=['GET'])
+def get_hold(order_id, item):
+    with dapr_client() as d:
+        resp = d.get_state(STATESTORE_NAME, hold_key(order_id, item.lower()))
+    if not resp.data:
+        return make_response(
+            jsonify({"error": "Not Found", "message": f"No hold on {item} for order {order_id}"}),
+            404
+        )
+    return jsonify(json.loads(resp.data))
+
+
+@app.route('/api/v1/inventory/reserve/stats', methods=['GET'])
+def reservation_statistics():
+    return jsonify(reservation_stats.to_dict())
+
+
 @app.route('/health', methods=['GET'])
 @app.route('/healthz', methods=['GET'])
 def health_check():
@@ -185,9 +785,15 @@ def health_check():
     })
 
 
+def stop_worker():
+    hold_sweeper.stop()
+    # Export the spans still queued
+    tracer.close()
+
+
 def main():
     # Start the Flask app server
-    app.run(host='0.0.0.0', port=APP_PORT, debug=False)
+    serve(app, host='0.0.0.0', port=APP_PORT, post_worker_init=hold_sweeper.start, worker_exit=stop_worker)
 
 
 if __name__ == "__main__":
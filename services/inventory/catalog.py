@@ -0,0 +1,190 @@
+import bisect
+import json
+import logging
+import os
+import random
+import threading
+import time
+import zlib
+
+import grpc
+from dapr.clients.grpc._state import Concurrency, Consistency, StateOptions
+
+STATESTORE_NAME = os.getenv("STATESTORE_NAME", "statestore")
+CATALOG_KEY_PREFIX = os.getenv("CATALOG_KEY_PREFIX", "inventory||catalog||")
+CATALOG_SHARDS = int(os.getenv("CATALOG_SHARDS", 64))
+CATALOG_CACHE_TTL_SECONDS = float(os.getenv("CATALOG_CACHE_TTL_SECONDS", 5.0))
+CATALOG_MAX_RETRIES = int(os.getenv("CATALOG_MAX_RETRIES", 10))
+CATALOG_BULK_PARALLELISM = int(os.getenv("CATALOG_BULK_PARALLELISM", 8))
+# Shards read per call while filling a page
+CATALOG_PAGE_SHARDS_PER_CALL = int(os.getenv("CATALOG_PAGE_SHARDS_PER_CALL", 8))
+
+# Only the first writer holding the current ETag succeeds, and without an ETag only a new key can be written
+SHARD_STATE_OPTIONS = StateOptions(concurrency=Concurrency.first_write, consistency=Consistency.strong)
+
+# gRPC codes returned by the sidecar when a first write loses
+CONFLICT_CODES = (grpc.StatusCode.ABORTED, grpc.StatusCode.FAILED_PRECONDITION)
+
+logger = logging.getLogger("catalog")
+
+
+class CatalogConflictError(Exception):
+    pass
+
+
+class Catalog:
+    """The set of SKUs that are stocked, kept in the state store so it can be listed.
+
+    State stores cannot list their keys, so the SKUs are indexed in `shards` keys, each holding
+    the sorted SKUs that hash to it. Adding or removing SKUs only rewrites the shards they hash
+    to, with compare-and-swap so concurrent writers never lose each other's SKUs. Reads merge all
+    shards in one bulk call into a sorted list, which each process caches for `cache_ttl` seconds.
+    Pages walk the shards in turn, so a page only reads the shards it covers.
+    """
+
+    def __init__(self, client_factory, store_name=STATESTORE_NAME, prefix=CATALOG_KEY_PREFIX, shards=CATALOG_SHARDS,
+                 cache_ttl=CATALOG_CACHE_TTL_SECONDS, max_retries=CATALOG_MAX_RETRIES):
+        self._client_factory = client_factory
+        self._store_name = store_name
+        self._prefix = prefix
+        self._shards = shards
+        self._cache_ttl = cache_ttl
+        self._max_retries = max_retries
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._skus = None
+        # The cached SKUs of each shard, sorted
+        self._shard_skus = None
+        self._expires_at = 0.0
+        self._generation = 0
+
+    def skus(self):
+        """Every SKU in the catalog, sorted."""
+        with self._lock:
+            if self._skus is not None and time.monotonic() < self._expires_at:
+                return self._skus
+
+        # Only one request reloads the index at a time, the others wait for its result
+        with self._load_lock:
+            with self._lock:
+                if self._skus is not None and time.monotonic() < self._expires_at:
+                    return self._skus
+                generation = self._generation
+
+            shard_skus = self._read_shards(range(self._shards))
+            skus = sorted(sku for shard in shard_skus for sku in shard)
+
+            with self._lock:
+                if generation == self._generation:
+                    self._skus = skus
+                    self._shard_skus = shard_skus
+                    self._expires_at = time.monotonic() + self._cache_ttl
+            return skus
+
+    def page(self, cursor=None, limit=100):
+        """Return up to `limit` SKUs after `cursor`, and the cursor of the next page or None.
+
+        SKUs come shard by shard, and sorted within each shard. Raises ValueError if the cursor is malformed.
+        """
+        first_shard, after = self.parse_cursor(cursor) if cursor else (0, None)
+        page = []
+        for start in range(first_shard, self._shards, CATALOG_PAGE_SHARDS_PER_CALL):
+            shards = range(start, min(start + CATALOG_PAGE_SHARDS_PER_CALL, self._shards))
+            for shard, skus in zip(shards, self._cached_shards(shards) or self._read_shards(shards)):
+                if shard == first_shard and after is not None:
+                    skus = skus[bisect.bisect_right(skus, after):]
+                wanted = limit - len(page)
+                page.extend(skus[:wanted])
+                if len(page) == limit:
+                    more = len(skus) > wanted or shard < self._shards - 1
+                    return page, f"{shard}:{page[-1]}" if more else None
+        return page, None
+
+    @staticmethod
+    def parse_cursor(cursor: str):
+        """Split a cursor into its shard and the last SKU before it, raising ValueError if it is malformed."""
+        shard, separator, sku = cursor.partition(":")
+        if not separator or not sku or not shard.isdigit():
+            raise ValueError(f"Invalid cursor: {cursor}")
+        return int(shard), sku
+
+    def add(self, skus):
+        """Add SKUs to the catalog. SKUs already in it are left alone."""
+        self._update(skus, lambda shard, changes: shard | changes)
+
+    def remove(self, skus):
+        """Remove SKUs from the catalog. Unknown SKUs are ignored."""
+        self._update(skus, lambda shard, changes: shard - changes)
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._skus = None
+            self._shard_skus = None
+
+    def _cached_shards(self, shards):
+        with self._lock:
+            if self._shard_skus is not None and time.monotonic() < self._expires_at:
+                return [self._shard_skus[shard] for shard in shards]
+        return None
+
+    def _read_shards(self, shards):
+        """Read the sorted SKUs of some shards in one bulk call."""
+        keys = [self._shard_key(shard) for shard in shards]
+        with self._client_factory() as d:
+            resp = d.get_bulk_state(self._store_name, keys, parallelism=CATALOG_BULK_PARALLELISM)
+        by_key = {}
+        for state in resp.items:
+            if state.error:
+                raise Exception(f"Error retrieving catalog shard {state.key}: {state.error}")
+            by_key[state.key] = sorted(json.loads(state.data)) if state.data else []
+        return [by_key.get(key, []) for key in keys]
+
+    def _update(self, skus, apply):
+        by_shard = {}
+        for sku in skus:
+            by_shard.setdefault(self._shard_of(sku), set()).add(sku)
+        if not by_shard:
+            return
+
+        try:
+            with self._client_factory() as d:
+                resp = d.get_bulk_state(self._store_name, [self._shard_key(i) for i in by_shard],
+                                        parallelism=CATALOG_BULK_PARALLELISM)
+                states = {state.key: state for state in resp.items}
+                for shard, changes in by_shard.items():
+                    self._update_shard(d, shard, changes, apply, states.get(self._shard_key(shard)))
+        finally:
+            self.invalidate()
+
+    def _update_shard(self, d, shard, changes, apply, state):
+        key = self._shard_key(shard)
+        for attempt in range(self._max_retries + 1):
+            if state is None:
+                state = d.get_state(self._store_name, key)
+            if getattr(state, "error", None):
+                raise Exception(f"Error retrieving catalog shard {key}: {state.error}")
+
+            current = set(json.loads(state.data)) if state.data else set()
+            updated = apply(current, changes)
+            if updated == current:
+                return
+            try:
+                d.save_state(self._store_name, key, json.dumps(sorted(updated)),
+                             etag=state.etag or None, options=SHARD_STATE_OPTIONS)
+                return
+            except grpc.RpcError as err:
+                if err.code() not in CONFLICT_CODES:
+                    raise
+                # Another writer changed this shard, so read it again
+                state = None
+                time.sleep(random.uniform(0, min(0.2, 0.005 * 2 ** attempt)))
+
+        raise CatalogConflictError(f"Gave up updating catalog shard {key} after {self._max_retries} conflicts")
+
+    def _shard_of(self, sku: str) -> int:
+        # crc32 rather than hash(), which differs between processes
+        return zlib.crc32(sku.encode("utf-8")) % self._shards
+
+    def _shard_key(self, shard: int) -> str:
+        return f"{self._prefix}shard||{shard}"
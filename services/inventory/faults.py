@@ -0,0 +1,199 @@
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import time
+
+from flask import Response, request
+
+from metrics import Counter, registry
+
+# Off unless asked for, so the admin endpoint is never exposed by accident
+FAULT_INJECTION_ENABLED = os.getenv("FAULT_INJECTION_ENABLED", "false").lower() == "true"
+# Initial rules as JSON, e.g. {"/api/v1/payments": {"latency": {"type": "fixed", "ms": 100}}}
+FAULT_RULES = os.getenv("FAULT_RULES", "")
+FAULT_RULES_MAX_BYTES = int(os.getenv("FAULT_RULES_MAX_BYTES", 64 * 1024))
+
+ADMIN_ROUTE = "/admin/faults"
+# Never slowed or failed, so faults can always be inspected and cleared
+EXEMPT_ROUTES = (ADMIN_ROUTE, "/metrics")
+LATENCY_TYPES = ("fixed", "uniform", "lognormal")
+RULE_KEYS = ("latency", "error_rate", "error_status", "burst", "drip")
+
+FAULTS_INJECTED = Counter(registry, "faults_injected_total", "Faults injected into responses.", ("route", "kind"))
+
+logger = logging.getLogger("faults")
+
+
+def validate_rules(rules):
+    """Return an error message if fault rules are malformed, or None.
+
+    Rules map a route (as registered with Flask, or "*" for every route) to its faults:
+
+        {"/api/v1/payments": {
+            "latency": {"type": "lognormal", "median_ms": 50, "sigma": 1.0, "max_ms": 5000},
+            "error_rate": 0.05, "error_status": 500,
+            "burst": {"every_s": 60, "duration_s": 5, "status": 503},
+            "drip": {"rate": 0.1, "chunk_bytes": 16, "interval_ms": 200}}}
+    """
+    if not isinstance(rules, dict):
+        return "Rules must be an object keyed by route"
+    for route, rule in rules.items():
+        if not isinstance(rule, dict):
+            return f"Rule for {route} must be an object"
+        unknown = set(rule) - set(RULE_KEYS)
+        if unknown:
+            return f"Unknown fault for {route}: {', '.join(sorted(unknown))}"
+        latency = rule.get("latency")
+        if latency is not None and (not isinstance(latency, dict) or latency.get("type") not in LATENCY_TYPES):
+            return f"Latency for {route} needs a type of {', '.join(LATENCY_TYPES)}"
+        error_rate = rule.get("error_rate", 0)
+        if not isinstance(error_rate, (int, float)) or not 0 <= error_rate <= 1:
+            return f"Error rate for {route} must be between 0 and 1"
+        burst = rule.get("burst")
+        if burst is not None and (not isinstance(burst, dict) or not burst.get("every_s", 0) > 0):
+            return f"Burst for {route} needs a positive every_s"
+        drip = rule.get("drip")
+        if drip is not None and (not isinstance(drip, dict) or not 0 <= drip.get("rate", 1) <= 1):
+            return f"Drip rate for {route} must be between 0 and 1"
+    return None
+
+
+def sample_latency(latency) -> float:
+    """Draw a delay in seconds from a latency distribution."""
+    kind = latency["type"]
+    if kind == "fixed":
+        ms = latency.get("ms", 0)
+    elif kind == "uniform":
+        ms = random.uniform(latency.get("min_ms", 0), latency.get("max_ms", 0))
+    else:
+        # Long tail: most requests near the median, a few orders of magnitude slower
+        ms = random.lognormvariate(math.log(max(latency.get("median_ms", 1), 1e-3)), latency.get("sigma", 1.0))
+    return min(ms, latency.get("max_ms", ms)) / 1000.0
+
+
+class FaultInjector:
+    """Applies fault rules to a Flask app's requests.
+
+    The rules live in shared memory created before the server forks its workers, so changing
+    them through the admin endpoint on one worker changes them for every worker.
+    """
+
+    def __init__(self, rules=None, max_bytes=FAULT_RULES_MAX_BYTES):
+        self._buffer = multiprocessing.Array('c', max_bytes)
+        self._version = multiprocessing.Value('L', 0)
+        self._local_version = -1
+        self._rules = {}
+        self.set_rules(rules or {})
+
+    def rules(self):
+        with self._version.get_lock():
+            version = self._version.value
+            if version != self._local_version:
+                self._rules = json.loads(self._buffer.value.decode("utf-8") or "{}")
+                self._local_version = version
+            return self._rules
+
+    def set_rules(self, rules):
+        data = json.dumps(rules).encode("utf-8")
+        if len(data) >= len(self._buffer):
+            raise ValueError(f"Fault rules are larger than {len(self._buffer)} bytes")
+        with self._version.get_lock():
+            self._buffer.value = data
+            self._version.value += 1
+
+    def rule_for(self, route):
+        rules = self.rules()
+        return rules.get(route) or rules.get("*")
+
+    def before_request(self):
+        route = request.url_rule.rule if request.url_rule else None
+        if route is None or route in EXEMPT_ROUTES:
+            return None
+        rule = self.rule_for(route)
+        if not rule:
+            return None
+
+        burst = rule.get("burst")
+        if burst and time.time() % burst["every_s"] < burst.get("duration_s", 0):
+            # Bursts follow the wall clock, so every worker fails together
+            FAULTS_INJECTED.inc(route, "burst")
+            retry_after = math.ceil(burst.get("duration_s", 0) - time.time() % burst["every_s"])
+            return Response("Injected fault: service unavailable", burst.get("status", 503),
+                            {"Retry-After": str(max(retry_after, 1))})
+
+        latency = rule.get("latency")
+        if latency:
+            FAULTS_INJECTED.inc(route, "latency")
+            time.sleep(sample_latency(latency))
+
+        if random.random() < rule.get("error_rate", 0):
+            FAULTS_INJECTED.inc(route, "error")
+            return Response("Injected fault: internal error", rule.get("error_status", 500))
+        return None
+
+    def after_request(self, response):
+        route = request.url_rule.rule if request.url_rule else None
+        rule = self.rule_for(route) if route and route not in EXEMPT_ROUTES else None
+        drip = rule.get("drip") if rule else None
+        if not drip or response.is_streamed or random.random() >= drip.get("rate", 1):
+            return response
+
+        FAULTS_INJECTED.inc(route, "drip")
+        data = response.get_data()
+        chunk_bytes = max(int(drip.get("chunk_bytes", 1)), 1)
+        interval = drip.get("interval_ms", 100) / 1000.0
+
+        def dripping():
+            for i in range(0, len(data), chunk_bytes):
+                if i:
+                    time.sleep(interval)
+                yield data[i:i + chunk_bytes]
+
+        response.response = dripping()
+        return response
+
+
+def install_faults(app):
+    """Inject the configured faults into an app's routes and serve the rules on /admin/faults.
+
+    Does nothing unless FAULT_INJECTION_ENABLED is true.
+    """
+    if not FAULT_INJECTION_ENABLED:
+        return None
+
+    rules = json.loads(FAULT_RULES) if FAULT_RULES else {}
+    error = validate_rules(rules)
+    if error:
+        raise ValueError(f"Invalid FAULT_RULES: {error}")
+    injector = FaultInjector(rules)
+    app.before_request(injector.before_request)
+    app.after_request(injector.after_request)
+
+    @app.route(ADMIN_ROUTE, methods=["GET"])
+    def get_faults():
+        return injector.rules(), 200
+
+    @app.route(ADMIN_ROUTE, methods=["PUT"])
+    def put_faults():
+        new_rules = request.get_json(silent=True)
+        error = validate_rules(new_rules)
+        if error:
+            return error, 400
+        try:
+            injector.set_rules(new_rules)
+        except ValueError as err:
+            return str(err), 413
+        logger.warning(f"Fault rules changed: {new_rules}")
+        return injector.rules(), 200
+
+    @app.route(ADMIN_ROUTE, methods=["DELETE"])
+    def clear_faults():
+        injector.set_rules({})
+        logger.info("Fault rules cleared")
+        return '', 204
+
+    logger.warning(f"Fault injection enabled with rules: {rules}")
+    return injector
@@ -0,0 +1,170 @@
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import zlib
+
+import grpc
+from dapr.clients.grpc._state import Concurrency, Consistency, StateOptions
+
+STATESTORE_NAME = os.getenv("STATESTORE_NAME", "statestore")
+HOLD_KEY_PREFIX = os.getenv("HOLD_KEY_PREFIX", "inventory||hold||")
+HOLD_INDEX_KEY_PREFIX = os.getenv("HOLD_INDEX_KEY_PREFIX", "inventory||holds||expiry||")
+HOLD_SWEEP_CURSOR_KEY = os.getenv("HOLD_SWEEP_CURSOR_KEY", "inventory||holds||swept")
+# Holds expiring within the same bucket are indexed together, spread over this many keys
+HOLD_INDEX_BUCKET_SECONDS = int(os.getenv("HOLD_INDEX_BUCKET_SECONDS", 60))
+HOLD_INDEX_SHARDS = int(os.getenv("HOLD_INDEX_SHARDS", 32))
+HOLD_SWEEP_INTERVAL_SECONDS = float(os.getenv("HOLD_SWEEP_INTERVAL_SECONDS", 30))
+HOLD_MAX_RETRIES = int(os.getenv("HOLD_MAX_RETRIES", 10))
+HOLD_BULK_PARALLELISM = int(os.getenv("HOLD_BULK_PARALLELISM", 8))
+# Index keys outlive the holds they list by this long, in case no sweeper ever gets to them
+HOLD_INDEX_TTL_SECONDS = int(os.getenv("HOLD_INDEX_TTL_SECONDS", 30 * 24 * 60 * 60))
+
+# Only the first writer holding the current ETag succeeds, and without an ETag only a new key can be written
+INDEX_STATE_OPTIONS = StateOptions(concurrency=Concurrency.first_write, consistency=Consistency.strong)
+
+# gRPC codes returned by the sidecar when a first write loses
+CONFLICT_CODES = (grpc.StatusCode.ABORTED, grpc.StatusCode.FAILED_PRECONDITION)
+
+HELD = "held"
+COMMITTED = "committed"
+
+logger = logging.getLogger("holds")
+
+
+class HoldIndexConflictError(Exception):
+    pass
+
+
+def hold_key(order_id: str, sku: str) -> str:
+    return f"{HOLD_KEY_PREFIX}{order_id}||{sku}"
+
+
+class HoldIndex:
+    """Finds holds by the time they expire, because a state store cannot list its keys.
+
+    Hold keys are appended to the index before the holds are written, so every hold is indexed
+    even if writing it fails half way. The sweeper skips keys whose holds were never written or
+    are gone already. Each bucket of `bucket_seconds` is spread over `shards` keys, so orders
+    reserved at the same moment rarely contend for the same key.
+    """
+
+    def __init__(self, client_factory, store_name=STATESTORE_NAME, prefix=HOLD_INDEX_KEY_PREFIX,
+                 cursor_key=HOLD_SWEEP_CURSOR_KEY, bucket_seconds=HOLD_INDEX_BUCKET_SECONDS, shards=HOLD_INDEX_SHARDS,
+                 max_retries=HOLD_MAX_RETRIES):
+        self._client_factory = client_factory
+        self._store_name = store_name
+        self._prefix = prefix
+        self._cursor_key = cursor_key
+        self.bucket_seconds = bucket_seconds
+        self._shards = shards
+        self._max_retries = max_retries
+        self._cursor_exists = False
+
+    def bucket_of(self, expires_at: float) -> int:
+        return math.floor(expires_at / self.bucket_seconds)
+
+    def add(self, d, order_id: str, keys, expires_at: float):
+        """Index hold keys under the bucket in which they expire."""
+        if not self._cursor_exists:
+            self._start_cursor(d)
+        key = self._shard_key(self.bucket_of(expires_at), zlib.crc32(order_id.encode("utf-8")) % self._shards)
+        for attempt in range(self._max_retries + 1):
+            state = d.get_state(self._store_name, key)
+            indexed = json.loads(state.data) if state.data else []
+            missing = [k for k in keys if k not in indexed]
+            if not missing:
+                return
+            try:
+                d.save_state(self._store_name, key, json.dumps(indexed + missing), etag=state.etag or None,
+                             options=INDEX_STATE_OPTIONS, state_metadata={"ttlInSeconds": str(HOLD_INDEX_TTL_SECONDS)})
+                return
+            except grpc.RpcError as err:
+                if err.code() not in CONFLICT_CODES:
+                    raise
+                time.sleep(random.uniform(0, min(0.2, 0.005 * 2 ** attempt)))
+
+        raise HoldIndexConflictError(f"Gave up indexing holds of order {order_id} after {self._max_retries} conflicts")
+
+    def bucket(self, d, bucket: int):
+        """Return the hold keys indexed under a bucket."""
+        resp = d.get_bulk_state(self._store_name, [self._shard_key(bucket, shard) for shard in range(self._shards)],
+                                parallelism=HOLD_BULK_PARALLELISM)
+        keys = []
+        for state in resp.items:
+            if state.error:
+                raise Exception(f"Error retrieving hold index {state.key}: {state.error}")
+            if state.data:
+                keys.extend(json.loads(state.data))
+        return keys
+
+    def drop(self, d, bucket: int):
+        for shard in range(self._shards):
+            d.delete_state(self._store_name, self._shard_key(bucket, shard))
+
+    def swept(self, d):
+        """Return the last bucket swept and the cursor's ETag, or (None, None) if no hold was ever indexed."""
+        state = d.get_state(self._store_name, self._cursor_key)
+        return (int(state.data), state.etag) if state.data else (None, None)
+
+    def advance(self, d, bucket: int, etag: str):
+        """Move the cursor to `bucket` and return its new ETag, or None if another sweeper moved it first."""
+        try:
+            d.save_state(self._store_name, self._cursor_key, str(bucket), etag=etag, options=INDEX_STATE_OPTIONS)
+        except grpc.RpcError as err:
+            if err.code() not in CONFLICT_CODES:
+                raise
+            return None
+        return d.get_state(self._store_name, self._cursor_key).etag
+
+    def _start_cursor(self, d):
+        # Every hold expires after it is indexed, so sweeping can start from the bucket before the first one
+        try:
+            d.save_state(self._store_name, self._cursor_key, str(self.bucket_of(time.time()) - 1),
+                         options=INDEX_STATE_OPTIONS)
+        except grpc.RpcError as err:
+            if err.code() not in CONFLICT_CODES:
+                raise
+        self._cursor_exists = True
+
+    def _shard_key(self, bucket: int, shard: int) -> str:
+        return f"{self._prefix}{bucket}||{shard}"
+
+
+class HoldSweeper:
+    """Periodically reclaims expired holds with `sweep(now)` on a background thread.
+
+    Every server worker runs a sweeper. They may sweep the same bucket at the same time, which
+    only wastes work, because expiring a hold is a compare-and-swap of the hold and its stock.
+    """
+
+    def __init__(self, sweep, interval=HOLD_SWEEP_INTERVAL_SECONDS):
+        self._sweep = sweep
+        self._interval = interval
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread or self._interval <= 0:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="hold-sweeper", daemon=True)
+        self._thread.start()
+        logger.info(f"Sweeping expired holds every {self._interval:.0f}s")
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        # Jittered, so the workers do not all sweep in step
+        while not self._stopping.wait(self._interval * random.uniform(0.5, 1.5)):
+            try:
+                self._sweep(time.time())
+            except Exception as e:
+                logger.warning(f"Sweeping expired holds failed: {str(e)}")
@@ -0,0 +1,386 @@
+import contextvars
+import functools
+import hashlib
+import logging
+import os
+import re
+
+import orjson
+from flask import g, request
+from opentelemetry import context as otel_context
+from opentelemetry import trace
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+from opentelemetry.sdk.trace.id_generator import RandomIdGenerator
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.trace import NonRecordingSpan, SpanKind, Status, StatusCode, TraceFlags
+
+from metrics import Counter, registry
+
+# "file" appends spans to TRACE_FILE as JSON lines, "otlp" posts them to an OpenTelemetry
+# collector's OTLP/HTTP endpoint, "none" records nothing and propagates no trace context
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+# Share of new traces that are recorded. Requests that carry a traceparent keep its decision.
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", 0.1))
+# Dapr sets APP_ID for the apps it runs
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME") or os.getenv("APP_ID") or os.path.basename(os.getcwd())
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", 512))
+TRACE_FLUSH_INTERVAL_SECONDS = float(os.getenv("TRACE_FLUSH_INTERVAL_SECONDS", 1))
+# Finished spans waiting to be exported. Spans beyond this are dropped rather than slowing requests.
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", 10000))
+
+# Health checks and scrapes would only bury the spans of orders
+UNTRACED_ROUTES = ("/", "/health", "/healthz", "/metrics")
+
+INTERNAL = SpanKind.INTERNAL
+SERVER = SpanKind.SERVER
+CLIENT = SpanKind.CLIENT
+PRODUCER = SpanKind.PRODUCER
+
+TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$")
+
+SPANS = Counter(registry, "trace_spans_total", "Sampled spans, by whether they were exported.", ("outcome",))
+
+logger = logging.getLogger("tracing")
+
+
+class SpanContext:
+    """The part of a span that travels with the calls it makes: its trace, its ID and whether it is recorded."""
+
+    __slots__ = ("trace_id", "span_id", "sampled")
+
+    def __init__(self, trace_id: str, span_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    @property
+    def traceparent(self) -> str:
+        """The context as a W3C traceparent header."""
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def remote(self):
+        """The context as the OpenTelemetry context of a parent in another process."""
+        flags = TraceFlags(TraceFlags.SAMPLED if self.sampled else TraceFlags.DEFAULT)
+        parent = trace.SpanContext(int(self.trace_id, 16), int(self.span_id, 16), is_remote=True, trace_flags=flags)
+        return trace.set_span_in_context(NonRecordingSpan(parent))
+
+
+def parse_traceparent(value):
+    """Return the SpanContext of a W3C traceparent header, or None if it is missing or malformed."""
+    match = TRACEPARENT.match(value.strip().lower()) if value else None
+    if not match:
+        return None
+    version, trace_id, span_id, flags, rest = match.groups()
+    if version == "ff" or (version == "00" and rest) or not int(trace_id, 16) or not int(span_id, 16):
+        return None
+    return SpanContext(trace_id, span_id, bool(int(flags, 16) & 1))
+
+
+def derived_traceparent(traceparent: str, key: str) -> str:
+    """The traceparent of a child of `traceparent` whose span ID derives from `key`, or "" without a parent.
+
+    Code that cannot keep state between runs, such as a replaying workflow, gets the same
+    child every time.
+    """
+    parent = parse_traceparent(traceparent)
+    if not parent:
+        return ""
+    span_id = hashlib.sha256(f"{parent.trace_id}:{key}".encode("utf-8")).hexdigest()[:16]
+    return SpanContext(parent.trace_id, span_id, parent.sampled).traceparent
+
+
+class Span:
+    """An OpenTelemetry span and its context, or no span at all."""
+
+    __slots__ = ("context", "_span")
+
+    def __init__(self, span):
+        self._span = span
+        context = span.get_span_context()
+        self.context = SpanContext(trace.format_trace_id(context.trace_id), trace.format_span_id(context.span_id),
+                                   context.trace_flags.sampled) if context.is_valid else None
+
+    def set_attribute(self, key: str, value):
+        self._span.set_attribute(key, value)
+
+    def record_error(self, error):
+        self._span.set_status(Status(StatusCode.ERROR, str(error) or type(error).__name__))
+
+    def end(self, end_ns=None):
+        self._span.end(end_ns)
+
+
+# Stands in for a span when there is nothing to trace, so callers need not check
+NO_SPAN = Span(trace.INVALID_SPAN)
+
+
+class FileExporter(SpanExporter):
+    """Appends spans to a file as JSON lines. Every batch is one append, so processes can share the file."""
+
+    def __init__(self, path=TRACE_FILE):
+        self._path = path
+
+    def export(self, spans):
+        data = b"".join(orjson.dumps(self._record(span)) + b"\n" for span in spans)
+        fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        return SpanExportResult.SUCCESS
+
+    @staticmethod
+    def _record(span) -> dict:
+        error = None
+        if span.status.status_code is StatusCode.ERROR:
+            error = span.status.description or "error"
+        return {
+            "service": span.resource.attributes.get("service.name"),
+            "trace_id": trace.format_trace_id(span.context.trace_id),
+            "span_id": trace.format_span_id(span.context.span_id),
+            "parent_span_id": trace.format_span_id(span.parent.span_id) if span.parent else None,
+            "name": span.name,
+            "kind": span.kind.name.lower(),
+            "start_time_unix_nano": span.start_time,
+            "end_time_unix_nano": span.end_time,
+            "duration_ms": round((span.end_time - span.start_time) / 1e6, 3),
+            "attributes": dict(span.attributes),
+            "error": error,
+        }
+
+
+class CountingExporter(SpanExporter):
+    """Counts the spans another exporter exported or failed to export."""
+
+    def __init__(self, exporter: SpanExporter):
+        self._exporter = exporter
+
+    def export(self, spans):
+        try:
+            result = self._exporter.export(spans)
+        except Exception as e:
+            logger.warning(f"Failed to export {len(spans)} spans: {str(e)}")
+            result = SpanExportResult.FAILURE
+        SPANS.inc("exported" if result is SpanExportResult.SUCCESS else "failed", amount=len(spans))
+        return result
+
+    def shutdown(self):
+        self._exporter.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self._exporter.force_flush(timeout_millis)
+
+
+EXPORTERS = {"file": FileExporter, "otlp": lambda: OTLPSpanExporter(endpoint=TRACE_OTLP_ENDPOINT)}
+
+
+class _IdGenerator(RandomIdGenerator):
+    """Random IDs, except for the span ID a recorded span was given in advance."""
+
+    def __init__(self):
+        self.preset_span_id = contextvars.ContextVar("preset_span_id", default=None)
+
+    def generate_span_id(self) -> int:
+        return self.preset_span_id.get() or super().generate_span_id()
+
+
+class Tracer:
+    """Starts spans through the OpenTelemetry SDK and tracks the current one per thread or request.
+
+    The SDK's batch processor queues finished spans and exports them on a background thread
+    every `flush_interval` seconds or `batch_size` spans, so a slow exporter never holds up a
+    request. Spans that do not fit in the queue are dropped.
+    """
+
+    def __init__(self, service_name=TRACE_SERVICE_NAME, exporter=None, sample_ratio=TRACE_SAMPLE_RATIO,
+                 batch_size=TRACE_BATCH_SIZE, flush_interval=TRACE_FLUSH_INTERVAL_SECONDS,
+                 queue_size=TRACE_QUEUE_SIZE):
+        self._ids = _IdGenerator()
+        self._provider = None
+        self._tracer = None
+        if exporter is None:
+            return
+        # A provider of its own rather than the global one, as the load test runs every service in one process
+        self._provider = TracerProvider(resource=Resource.create({"service.name": service_name}),
+                                        sampler=ParentBased(TraceIdRatioBased(sample_ratio)), id_generator=self._ids)
+        self._provider.add_span_processor(BatchSpanProcessor(
+            CountingExporter(exporter), max_queue_size=queue_size, max_export_batch_size=min(batch_size, queue_size),
+            schedule_delay_millis=flush_interval * 1000))
+        self._tracer = self._provider.get_tracer("catalyst-order-workflow")
+
+    @property
+    def enabled(self) -> bool:
+        return self._provider is not None
+
+    def current(self):
+        """The span of the current request or activity, or None."""
+        if not self.enabled:
+            return None
+        span = trace.get_current_span()
+        return Span(span) if span.get_span_context().is_valid else None
+
+    def traceparent(self) -> str:
+        """The traceparent of the current span, or "" outside of one."""
+        span = self.current()
+        return span.context.traceparent if span else ""
+
+    def start_span(self, name: str, kind=INTERNAL, parent=None, attributes=None, new_trace=True, start_ns=None):
+        """Start a span as a child of `parent`, a SpanContext, or else of the current span.
+
+        Without either it starts a new trace, sampled at the tracer's ratio, unless `new_trace`
+        is false, in which case there is nothing to trace and NO_SPAN is returned.
+        """
+        if not self.enabled:
+            return NO_SPAN
+        if parent is not None:
+            context = parent.remote()
+        elif new_trace or self.current():
+            context = None
+        else:
+            return NO_SPAN
+        return Span(self._tracer.start_span(name, context, kind, attributes, start_time=start_ns))
+
+    def activate(self, span: Span):
+        """Make a span the current one until `deactivate` is called with the returned token."""
+        return otel_context.attach(trace.set_span_in_context(span._span))
+
+    def deactivate(self, token):
+        otel_context.detach(token)
+
+    def span(self, name: str, kind=INTERNAL, parent=None, attributes=None, new_trace=True):
+        """Time the body of a `with` block as the current span, recording any error it raises."""
+        return _ActiveSpan(self, self.start_span(name, kind, parent, attributes, new_trace))
+
+    def record(self, name: str, traceparent: str, parent: str, start_ns: int, end_ns: int, attributes=None,
+               error=None):
+        """Export a span timed elsewhere under a known traceparent, such as a workflow's, as a child of `parent`."""
+        context = parse_traceparent(traceparent)
+        parent_context = parse_traceparent(parent)
+        if not self.enabled or not context or not context.sampled or not parent_context:
+            return
+        token = self._ids.preset_span_id.set(int(context.span_id, 16))
+        try:
+            span = Span(self._tracer.start_span(name, parent_context.remote(), attributes=attributes,
+                                                start_time=start_ns))
+        finally:
+            self._ids.preset_span_id.reset(token)
+        if error:
+            span.record_error(error)
+        span.end(end_ns)
+
+    def close(self):
+        """Export whatever is still queued and stop the exporter thread."""
+        if self._provider:
+            self._provider.shutdown()
+
+
+class _ActiveSpan:
+    def __init__(self, tracer: Tracer, span: Span):
+        self._tracer = tracer
+        self._span = span
+        self._token = None
+
+    def __enter__(self):
+        self._token = self._tracer.activate(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        self._tracer.deactivate(self._token)
+        if exc is not None:
+            self._span.record_error(exc)
+        self._span.end()
+
+
+def install_tracing(app):
+    """Record a server span for every request, continuing the trace of its traceparent header.
+
+    Install before anything that can answer a request early, such as injected faults, so
+    those responses are traced too.
+    """
+    if not tracer.enabled:
+        return
+
+    @app.before_request
+    def _start_span():
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        if route in UNTRACED_ROUTES:
+            return
+        span = tracer.start_span(f"{request.method} {route}", SERVER,
+                                 parse_traceparent(request.headers.get("traceparent")),
+                                 {"http.request.method": request.method, "http.route": route})
+        g.trace_span = span
+        g.trace_token = tracer.activate(span)
+
+    @app.after_request
+    def _record_status(response):
+        span = g.get("trace_span")
+        if span:
+            span.set_attribute("http.response.status_code", response.status_code)
+            if response.status_code >= 500:
+                span.record_error(response.status)
+            # Tells clients which trace their request went into
+            response.headers["traceresponse"] = span.context.traceparent
+        return response
+
+    @app.teardown_request
+    def _end_span(exc):
+        span = g.pop("trace_span", None)
+        if not span:
+            return
+        tracer.deactivate(g.pop("trace_token"))
+        if exc is not None:
+            span.record_error(exc)
+        span.end()
+
+
+class TracedDaprClient:
+    """Wraps a DaprClient and records a client span for every API call made within a traced operation.
+
+    Service invocations also carry the span's traceparent, which the sidecar passes on to the
+    called app as a header.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __enter__(self):
+        self._client.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._client.__exit__(*args)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name.startswith("_") or not tracer.enabled:
+            return attr
+
+        @functools.wraps(attr)
+        def traced(*args, **kwargs):
+            current = tracer.current()
+            # Calls of unsampled traces are not timed, but invocations still pass the trace on
+            if current is None or not current.context.sampled and name != "invoke_method":
+                return attr(*args, **kwargs)
+            target = args[0] if args else next(iter(kwargs.values()), "")
+            if name == "invoke_method":
+                method = args[1] if len(args) > 1 else kwargs.get("method_name", "")
+                target = f"{target}/{method}"
+            with tracer.span(f"{name} {target}", CLIENT, attributes={"dapr.api": name, "dapr.target": str(target)}) as span:
+                if name == "invoke_method":
+                    kwargs["metadata"] = tuple(kwargs.get("metadata") or ()) + (("traceparent", span.context.traceparent),)
+                result = attr(*args, **kwargs)
+                status = getattr(result, "status_code", None)
+                if isinstance(status, int):
+                    span.set_attribute("http.response.status_code", status)
+                return result
+
+        return traced
+
+
+# Process-wide tracer
+tracer = Tracer(exporter=EXPORTERS[TRACE_EXPORTER]() if TRACE_EXPORTER in EXPORTERS else None)
@@ -0,0 +1,219 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import Counter, Gauge, registry
+from serving import SERVER_MODE, SERVER_WORKERS
+
+# Orders admitted per second across all customers, and how many may arrive at once. 0 disables the limit.
+ORDER_ADMISSION_RATE = float(os.getenv("ORDER_ADMISSION_RATE", 200))
+ORDER_ADMISSION_BURST = float(os.getenv("ORDER_ADMISSION_BURST", 400))
+# The same for each customer
+ORDER_ADMISSION_CUSTOMER_RATE = float(os.getenv("ORDER_ADMISSION_CUSTOMER_RATE", 5))
+ORDER_ADMISSION_CUSTOMER_BURST = float(os.getenv("ORDER_ADMISSION_CUSTOMER_BURST", 20))
+# Customers whose buckets are kept, least recently seen are forgotten first
+ORDER_ADMISSION_MAX_CUSTOMERS = int(os.getenv("ORDER_ADMISSION_MAX_CUSTOMERS", 100000))
+# Workflows scheduled here that may run at once. 0 disables the limit.
+ORDER_ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ORDER_ADMISSION_MAX_IN_FLIGHT", 5000))
+# A workflow stops counting once its last notification arrives. One that has not sent it this long after it
+# was admitted, or was last checked, is looked up and stops counting if it finished or does not exist.
+ORDER_ADMISSION_CHECK_AFTER_SECONDS = float(os.getenv("ORDER_ADMISSION_CHECK_AFTER_SECONDS", 300))
+# How often to look for workflows to check
+ORDER_ADMISSION_CHECK_INTERVAL_SECONDS = float(os.getenv("ORDER_ADMISSION_CHECK_INTERVAL_SECONDS", 60))
+# Retry-After of orders refused because too many workflows are in flight
+ORDER_ADMISSION_RETRY_AFTER_SECONDS = float(os.getenv("ORDER_ADMISSION_RETRY_AFTER_SECONDS", 5))
+
+ADMITTED = "admitted"
+RATE_LIMITED = "rate_limited"
+CUSTOMER_RATE_LIMITED = "customer_rate_limited"
+IN_FLIGHT_LIMITED = "in_flight_limited"
+
+ADMISSIONS = Counter(registry, "order_admissions_total", "Orders submitted, by whether they were admitted or why not.",
+                     ("outcome",))
+IN_FLIGHT = Gauge(registry, "orders_in_flight", "Workflows scheduled by this process that have not finished.")
+
+logger = logging.getLogger("admission")
+
+
+class OrderRejectedError(Exception):
+    def __init__(self, message: str, reason: str, retry_after: float):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Holds up to `burst` tokens and gains `rate` tokens a second. Each admitted order takes one."""
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, rate: float, burst: float, now: float) -> float:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return self.tokens
+
+
+class AdmissionController:
+    """Decides whether to accept an order before its workflow is scheduled, so a spike is refused instead of queued.
+
+    An order needs a token from the bucket shared by all customers and one from its customer's
+    bucket, and fewer than `max_in_flight` workflows scheduled here may be unfinished. Tokens
+    are only taken when the order passes every check. Limits hold per process, like the
+    circuit breakers.
+
+    Once started, a background thread looks up the workflows whose last notification is
+    overdue, so a lost notification does not hold a place for good. A workflow still counted
+    after `in_flight_ttl` seconds, longer than any order can run, stops counting unchecked.
+    """
+
+    def __init__(self, rate=ORDER_ADMISSION_RATE, burst=ORDER_ADMISSION_BURST,
+                 customer_rate=ORDER_ADMISSION_CUSTOMER_RATE, customer_burst=ORDER_ADMISSION_CUSTOMER_BURST,
+                 max_customers=ORDER_ADMISSION_MAX_CUSTOMERS, max_in_flight=ORDER_ADMISSION_MAX_IN_FLIGHT,
+                 retry_after=ORDER_ADMISSION_RETRY_AFTER_SECONDS, check_after=ORDER_ADMISSION_CHECK_AFTER_SECONDS,
+                 check_interval=ORDER_ADMISSION_CHECK_INTERVAL_SECONDS):
+        self._rate = rate
+        self._burst = max(burst, 1)
+        self._customer_rate = customer_rate
+        self._customer_burst = max(customer_burst, 1)
+        self._max_customers = max_customers
+        self._max_in_flight = max_in_flight
+        self._in_flight_ttl = None
+        self._retry_after = retry_after
+        self._check_after = check_after
+        self._check_interval = check_interval
+        self._bucket = TokenBucket(self._burst, time.monotonic())
+        self._customers = OrderedDict()
+        # Unfinished workflows by instance ID, oldest first, with the times each was admitted and last checked
+        self._in_flight = OrderedDict()
+        self._lock = threading.Lock()
+        self._workflow_finished = None
+        self._stopping = threading.Event()
+        self._checker = None
+
+    def admit(self, customer: str, order_id: str):
+        """Admit an order and count its workflow as in flight, or raise OrderRejectedError with when to retry."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if self._max_in_flight > 0 and len(self._in_flight) >= self._max_in_flight:
+                self._reject(IN_FLIGHT_LIMITED, "Too many orders in progress, try again later", self._retry_after)
+
+            if self._rate > 0 and self._bucket.refill(self._rate, self._burst, now) < 1:
+                self._reject(RATE_LIMITED, "Too many orders, try again later",
+                             (1 - self._bucket.tokens) / self._rate)
+
+            bucket = None
+            if self._customer_rate > 0:
+                bucket = self._customers.get(customer)
+                if bucket is None:
+                    bucket = self._customers[customer] = TokenBucket(self._customer_burst, now)
+                    if len(self._customers) > self._max_customers:
+                        self._customers.popitem(last=False)
+                self._customers.move_to_end(customer)
+                if bucket.refill(self._customer_rate, self._customer_burst, now) < 1:
+                    self._reject(CUSTOMER_RATE_LIMITED, "Too many orders from this customer, try again later",
+                                 (1 - bucket.tokens) / self._customer_rate)
+
+            if self._rate > 0:
+                self._bucket.tokens -= 1
+            if bucket:
+                bucket.tokens -= 1
+            self._in_flight[order_id] = [now, now]
+        ADMISSIONS.inc(ADMITTED)
+        IN_FLIGHT.inc()
+
+    def finished(self, order_id: str, *_):
+        """Stop counting a workflow, because it finished or was never scheduled."""
+        with self._lock:
+            found = self._in_flight.pop(order_id, None) is not None
+        if found:
+            IN_FLIGHT.dec()
+
+    def start(self, workflow_finished, in_flight_ttl: float):
+        """Look up overdue workflows in the background, and stop counting any after `in_flight_ttl` seconds.
+
+        `workflow_finished` takes an instance ID and returns whether its workflow finished or does not exist.
+        """
+        if self._checker:
+            return
+        self._workflow_finished = workflow_finished
+        self._in_flight_ttl = in_flight_ttl
+        self._stopping.clear()
+        self._checker = threading.Thread(target=self._run, name="admission-checker", daemon=True)
+        self._checker.start()
+
+    def close(self):
+        self._stopping.set()
+        if self._checker:
+            self._checker.join()
+            self._checker = None
+
+    def check(self):
+        """Stop counting the overdue workflows that finished without their last notification arriving."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            overdue = []
+            for order_id, times in self._in_flight.items():
+                admitted, checked = times
+                if now - admitted < self._check_after:
+                    # The rest were admitted later still
+                    break
+                if now - checked >= self._check_after:
+                    times[1] = now
+                    overdue.append(order_id)
+
+        released = 0
+        for order_id in overdue:
+            if self._stopping.is_set():
+                break
+            try:
+                finished = self._workflow_finished(order_id)
+            except Exception as e:
+                logger.warning(f"Error checking whether workflow {order_id} finished: {str(e)}")
+                continue
+            if finished:
+                self.finished(order_id)
+                released += 1
+        if released:
+            logger.warning(f"Stopped counting {released} finished workflows whose last notification never arrived")
+
+    def _run(self):
+        while not self._stopping.wait(self._check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.warning(f"Error checking workflows in flight: {str(e)}")
+
+    def _expire(self, now: float):
+        # Called with the lock held
+        if self._in_flight_ttl is None:
+            return
+        expired = 0
+        while self._in_flight and now - next(iter(self._in_flight.values()))[0] >= self._in_flight_ttl:
+            self._in_flight.popitem(last=False)
+            expired += 1
+        if expired:
+            IN_FLIGHT.dec(amount=expired)
+            logger.warning(f"Stopped counting {expired} workflows that did not report finishing "
+                           f"within {self._in_flight_ttl:.0f}s")
+
+    @staticmethod
+    def _reject(reason: str, message: str, retry_after: float):
+        ADMISSIONS.inc(reason)
+        raise OrderRejectedError(message, reason, retry_after)
+
+
+# The overall limits are shared out between the server's worker processes, which each admit their own orders
+_processes = SERVER_WORKERS if SERVER_MODE == "prod" else 1
+
+# Process-wide admission control shared by all requests
+order_admission = AdmissionController(
+    rate=ORDER_ADMISSION_RATE / _processes, burst=ORDER_ADMISSION_BURST / _processes,
+    max_in_flight=-(-ORDER_ADMISSION_MAX_IN_FLIGHT // _processes))
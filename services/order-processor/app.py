@@ -1,173 +1,679 @@
 import json
 import logging
+import math
 import os
-import random
-import string
+import functools
+import hashlib
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 import dapr.ext.workflow as wf
-from dapr.clients import DaprClient
-from flask import Flask, request, url_for
+from flask import Flask, Response, request, url_for
 from markupsafe import escape
 from dataclasses import dataclass
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
+from typing import List
+from admission import OrderRejectedError, order_admission
+from approval_queue import approval_queue
+from caches import LRUCache
+from circuit_breaker import circuit_breakers
+from codec import CODECS, JSON, codec_for, to_primitive
+from dapr_pool import dapr_pool, get_workflow_client
+from idempotency import IDEMPOTENCY_KEY_MAX_LENGTH, idempotency_store
+from metrics import Counter, Gauge, Histogram, instrument_app, registry
+from notification_publisher import notification_publisher
+from order_events import TooManyWatchersError, order_events
+from order_index import as_utc, order_index
+from runtime_lock import ProcessGroupLock
+from serving import SERVER_MODE, serve
+from tracing import CLIENT, derived_traceparent, install_tracing, parse_traceparent, tracer
+from workflow_concurrency import configure_concurrency, io_activity_slots
 
 APP_PORT = os.getenv("APP_PORT", "3006")
-PUBSUB_NAME = os.getenv("PUBSUB_NAME", "pubsub")
-TOPIC_NAME = os.getenv("TOPIC_NAME", "notifications")
+
+# Set to "false" to serve only the HTTP API and leave workflows to separate worker.py processes
+WORKFLOW_WORKER_ENABLED = os.getenv("WORKFLOW_WORKER_ENABLED", "true").lower() == "true"
 
 APPROVAL_THRESHOLD = 1000.0
 APPROVAL_TIMEOUT = timedelta(hours=24)
 
+ORDER_MAX_LINE_ITEMS = int(os.getenv("ORDER_MAX_LINE_ITEMS", 100))
+ORDER_BATCH_MAX_SIZE = int(os.getenv("ORDER_BATCH_MAX_SIZE", 10000))
+ORDER_BATCH_WORKERS = int(os.getenv("ORDER_BATCH_WORKERS", 32))
+ORDER_APPROVAL_BATCH_MAX_SIZE = int(os.getenv("ORDER_APPROVAL_BATCH_MAX_SIZE", 1000))
+ORDER_STATUS_BATCH_MAX_SIZE = int(os.getenv("ORDER_STATUS_BATCH_MAX_SIZE", 1000))
+ORDER_STATUS_CACHE_SIZE = int(os.getenv("ORDER_STATUS_CACHE_SIZE", 10000))
+ORDER_STATUS_CACHE_TTL_SECONDS = float(os.getenv("ORDER_STATUS_CACHE_TTL_SECONDS", 300))
+ORDER_LIST_PAGE_SIZE = int(os.getenv("ORDER_LIST_PAGE_SIZE", 100))
+ORDER_LIST_MAX_PAGE_SIZE = int(os.getenv("ORDER_LIST_MAX_PAGE_SIZE", 1000))
+# Longest a long-poll for order events waits, and an event stream stays open before the client reconnects
+ORDER_EVENTS_POLL_TIMEOUT_SECONDS = float(os.getenv("ORDER_EVENTS_POLL_TIMEOUT_SECONDS", 30))
+ORDER_EVENTS_STREAM_SECONDS = float(os.getenv("ORDER_EVENTS_STREAM_SECONDS", 300))
+ORDER_EVENTS_KEEPALIVE_SECONDS = float(os.getenv("ORDER_EVENTS_KEEPALIVE_SECONDS", 15))
+# Content type of the payloads sent to inventory, payments and shipping: application/msgpack or application/json
+SERVICE_CONTENT_TYPE = os.getenv("SERVICE_CONTENT_TYPE", "application/msgpack")
+# Shipping books the carrier in waves after accepting a shipment. The workflow checks on it after
+# the first interval, doubling the wait up to the longest, and fails the order if it is not shipped in time.
+SHIPMENT_CHECK_FIRST_INTERVAL_SECONDS = float(os.getenv("SHIPMENT_CHECK_FIRST_INTERVAL_SECONDS", 30))
+SHIPMENT_CHECK_MAX_INTERVAL_SECONDS = float(os.getenv("SHIPMENT_CHECK_MAX_INTERVAL_SECONDS", 300))
+SHIPMENT_TIMEOUT = timedelta(seconds=float(os.getenv("SHIPMENT_TIMEOUT_SECONDS", 60 * 60)))
+# An admitted workflow stops counting against the in-flight limit after this long even if it was never seen to
+# finish. Longer than an order can run: the approval and shipping waits, and an hour for its activities.
+ORDER_ADMISSION_IN_FLIGHT_TTL_SECONDS = float(os.getenv(
+    "ORDER_ADMISSION_IN_FLIGHT_TTL_SECONDS", (APPROVAL_TIMEOUT + SHIPMENT_TIMEOUT + timedelta(hours=1)).total_seconds()))
+
+
+def retry_policy(target: str, max_attempts: int, first_retry_seconds: float, max_retry_seconds: float) -> wf.RetryPolicy:
+    """Exponential backoff for activities that call `target`, overridable with <TARGET>_RETRY_* variables."""
+    prefix = f"{target.upper()}_RETRY_"
+    return wf.RetryPolicy(
+        first_retry_interval=timedelta(seconds=float(os.getenv(prefix + "FIRST_INTERVAL_SECONDS", first_retry_seconds))),
+        max_number_of_attempts=int(os.getenv(prefix + "MAX_ATTEMPTS", max_attempts)),
+        backoff_coefficient=float(os.getenv(prefix + "BACKOFF_COEFFICIENT", 2.0)),
+        max_retry_interval=timedelta(seconds=float(os.getenv(prefix + "MAX_INTERVAL_SECONDS", max_retry_seconds))))
+
+
+# Long enough to ride out a circuit breaker opening once, so a brief outage delays orders instead of failing them
+INVENTORY_RETRY_POLICY = retry_policy("inventory", 4, 0.5, 10)
+PAYMENTS_RETRY_POLICY = retry_policy("payments", 6, 1, 30)
+SHIPPING_RETRY_POLICY = retry_policy("shipping", 6, 1, 30)
+# Refunds compensate for a charge that already happened, so they keep trying for longer
+REFUND_RETRY_POLICY = retry_policy("refund", 10, 1, 60)
+ORDER_INDEX_RETRY_POLICY = retry_policy("order_index", 5, 0.5, 10)
+# Every waiting order updates the same approval queue key, so a write can fail on a busy store
+APPROVAL_QUEUE_RETRY_POLICY = retry_policy("approval_queue", 5, 0.5, 10)
+
+# Workflows in these states never change again, so their status can be served from cache
+TERMINAL_STATUSES = {"COMPLETED", "FAILED", "TERMINATED"}
+# Runtime statuses orders can be listed by, the only ones the workflow writes to the order index
+ORDER_STATUSES = {"RUNNING", "COMPLETED", "FAILED"}
+
 app = Flask(__name__)
+instrument_app(app)
+install_tracing(app)
 
+# Bounded pool shared by all batch requests for scheduling workflows concurrently
+batch_executor = ThreadPoolExecutor(max_workers=ORDER_BATCH_WORKERS, thread_name_prefix="order-batch")
 
-@dataclass
+# Elects the worker process that runs the workflow runtime when serving with multiple workers
+process_group_lock = ProcessGroupLock(os.getenv("WORKFLOW_RUNTIME_LOCK_FILE"))
+
+# Status of orders that have reached a terminal state, keyed by instance ID
+terminal_status_cache = LRUCache(ORDER_STATUS_CACHE_SIZE, ORDER_STATUS_CACHE_TTL_SECONDS)
+
+# Workflows stop counting against admission once their final notification arrives
+order_events.on_finished(order_admission.finished)
+
+
+@dataclass(slots=True)
 class Order:
     id: str
     customer: str
-    item: str
+    items: List[dict]  # line items of the form {"item": "orange", "quantity": 2}
     total: float
+    traceparent: str = ""  # trace context the order's activities continue, empty when not traced
 
-@dataclass
+@dataclass(slots=True)
 class Approval:
     approver: str
     approved: bool
 
-@dataclass
+@dataclass(slots=True)
+class ApprovalRequest:
+    customer: str
+    items: List[dict]
+    total: float
+    deadline: str
+    since: str
+
+@dataclass(slots=True)
 class OrderResult:
     id: str
     success: bool
     message: str
 
-@dataclass
+@dataclass(slots=True)
+class LineItemReservation:
+    id: str
+    item: str
+    quantity: int
+    traceparent: str = ""
+
+@dataclass(slots=True)
+class InventoryLines:
+    id: str
+    items: List[dict]
+    traceparent: str = ""
+
+@dataclass(slots=True)
 class InventoryResult:
     id: str
     success: bool
     message: str
 
-@dataclass
+@dataclass(slots=True)
 class PaymentResult:
     id: str
     success: bool
     message: str
 
+@dataclass(slots=True)
+class OrderIndexUpdate:
+    id: str
+    customer: str
+    total: float
+    status: str
+    created_at: str
+    traceparent: str = ""
+
+ACTIVITY_SECONDS = Histogram(registry, "workflow_activity_duration_seconds", "Workflow activity latency.",
+                             ("activity", "outcome"))
+ACTIVITIES_IN_FLIGHT = Gauge(registry, "workflow_activities_in_flight", "Workflow activities currently running.",
+                             ("activity",))
+ACTIVITY_ERRORS = Counter(registry, "workflow_activity_errors_total", "Workflow activities that raised an error.",
+                          ("activity",))
+
+
+def instrument_activity(activity):
+    """Record latency, in-flight and error metrics for a workflow activity, and a span if its input is traced."""
+    name = activity.__name__
+
+    @functools.wraps(activity)
+    def instrumented(ctx, activity_input=None):
+        ACTIVITIES_IN_FLIGHT.inc(name)
+        start = time.perf_counter()
+        outcome = "error"
+        parent = parse_traceparent(getattr(activity_input, "traceparent", None))
+        try:
+            with tracer.span(f"activity {name}", parent=parent, attributes={"workflow.instance_id": ctx.workflow_id},
+                             new_trace=False):
+                result = activity(ctx, activity_input)
+            outcome = "success"
+            return result
+        except Exception:
+            ACTIVITY_ERRORS.inc(name)
+            raise
+        finally:
+            ACTIVITIES_IN_FLIGHT.dec(name)
+            ACTIVITY_SECONDS.observe(time.perf_counter() - start, name, outcome)
+
+    return instrumented
+
+
+def io_activity(activity):
+    """Run an activity that waits on a slow service in one of the limited slow I/O slots."""
+
+    @functools.wraps(activity)
+    def limited(ctx, activity_input=None):
+        with io_activity_slots:
+            return activity(ctx, activity_input)
+
+    return limited
+
+
+def format_line_items(items) -> str:
+    return ", ".join(f"{line['quantity']} x {line['item']}" for line in items)
+
+
 # Dapr Workflow Definition for Order Processing
 
 def process_order_workflow(ctx: wf.DaprWorkflowContext, order: Order):
-    yield ctx.call_activity(notify, input=f"Processing order for {order.customer}. Item: {order.item}, Total: {order.total}")
+    started = as_utc(ctx.current_utc_datetime)
+    created_at = started.isoformat()
+    # The activities of a traced order are children of a span for the whole workflow, recorded
+    # once it finishes. Its ID derives from the instance ID, so it is the same on every replay.
+    submitted_by = getattr(order, "traceparent", "")
+    order = Order(order.id, order.customer, order.items, order.total,
+                  derived_traceparent(submitted_by, ctx.instance_id))
+    workflow_traces[ctx] = order.traceparent
 
-    # Call into the inventory service to reserve the items in this order
-    result = yield ctx.call_activity(reserve_inventory, input=order)
-    
-    if not result.success:
-        yield ctx.call_activity(notify, input=f"Failed to reserve inventory: {result.message}")
-        return OrderResult(order.id, False, result.message)
+    # Indexed alongside reserving the inventory rather than before it
+    indexed = ctx.call_activity(index_order, input=OrderIndexUpdate(
+        order.id, order.customer, order.total, "RUNNING", created_at, order.traceparent),
+        retry_policy=ORDER_INDEX_RETRY_POLICY)
+
+    try:
+        result = yield from process_order(ctx, order)
+    except Exception as e:
+        yield from update_order_index(ctx, indexed, OrderIndexUpdate(
+            order.id, order.customer, order.total, "FAILED", created_at, order.traceparent))
+        notify_finished(ctx, "FAILED", str(e))
+        trace_workflow(ctx, submitted_by, started, "FAILED", str(e))
+        raise
+    yield from update_order_index(ctx, indexed, OrderIndexUpdate(
+        order.id, order.customer, order.total, "COMPLETED", created_at, order.traceparent))
+    notify_finished(ctx, "COMPLETED", result.message)
+    trace_workflow(ctx, submitted_by, started, "COMPLETED")
+    return result
+
+def process_order(ctx: wf.DaprWorkflowContext, order: Order):
+    notify(ctx, f"Processing order for {order.customer}. Items: {format_line_items(order.items)}, Total: {order.total}")
+
+    # Call into the inventory service to reserve all line items of this order in parallel
+    reservations = [
+        ctx.call_activity(reserve_inventory,
+                          input=LineItemReservation(order.id, line["item"], line["quantity"], order.traceparent),
+                          retry_policy=INVENTORY_RETRY_POLICY)
+        for line in order.items]
+
+    # Collected one by one rather than with when_all, which fails as soon as one line runs out
+    # of retries and would no longer tell which other lines to roll back
+    results = []
+    for line, reservation in zip(order.items, reservations):
+        try:
+            results.append((yield reservation))
+        except Exception as e:
+            results.append(InventoryResult(order.id, False, f"Error reserving {line['item']}: {str(e)}"))
+
+    failures = [result.message for result in results if not result.success]
+    if failures:
+        # Put back the lines that were reserved before failing the order
+        reserved = [line for line, result in zip(order.items, results) if result.success]
+        if reserved:
+            yield from release_order_inventory(ctx, order, reserved)
 
-    yield ctx.call_activity(notify, input=f"Reserved inventory: {order.item}")
+        message = "; ".join(failures)
+        notify(ctx, f"Failed to reserve inventory: {message}")
+        return OrderResult(order.id, False, message)
+
+    notify(ctx, f"Reserved inventory: {format_line_items(order.items)}")
 
     # Orders over $1,000 require human approval
     if order.total >= APPROVAL_THRESHOLD:
         approval_deadline = ctx.current_utc_datetime + APPROVAL_TIMEOUT
-        yield ctx.call_activity(notify, input=f"Waiting for approval since order >= {APPROVAL_THRESHOLD}. Deadline = {approval_deadline}.")
+        notify(ctx, f"Waiting for approval since order >= {APPROVAL_THRESHOLD}. Deadline = {approval_deadline}.")
+
+        # List the order in the approval queue so approvers can find it
+        yield ctx.call_activity(add_to_approval_queue, input=ApprovalRequest(
+            order.customer, order.items, order.total, approval_deadline.isoformat(),
+            ctx.current_utc_datetime.isoformat()), retry_policy=APPROVAL_QUEUE_RETRY_POLICY)
 
         # Block the workflow on either an approval event or a timeout
         approval_task = ctx.wait_for_external_event("approval")
         timeout_expired_task = ctx.create_timer(approval_deadline)
         winner = yield wf.when_any([approval_task, timeout_expired_task])
 
+        yield ctx.call_activity(remove_from_approval_queue, input=order.id, retry_policy=APPROVAL_QUEUE_RETRY_POLICY)
+
         if winner == timeout_expired_task:
             message = "Approval deadline expired."
-            yield ctx.call_activity(notify, input=message)
+            notify(ctx, message)
+            yield from release_order_inventory(ctx, order)
             return OrderResult(order.id, False, message)
 
         # Check the approval result
         approval: Approval = yield approval_task
         if not approval.approved:
             message = f"Order was rejected by {approval.approver}."
-            yield ctx.call_activity(notify, input=message)
+            notify(ctx, message)
+            yield from release_order_inventory(ctx, order)
             return OrderResult(order.id, False, message)
 
-        yield ctx.call_activity(notify, input=f"Order was approved by {approval.approver}.")
+        notify(ctx, f"Order was approved by {approval.approver}.")
 
-    yield ctx.call_activity(notify, input="Attempting to take payment")
+    # Keep the reserved stock for good now that the order goes ahead. Holds that expired while
+    # waiting for approval are taken again if the stock is still there.
+    try:
+        result = yield ctx.call_activity(commit_inventory, input=InventoryLines(order.id, order.items, order.traceparent),
+                                         retry_policy=INVENTORY_RETRY_POLICY)
+    except Exception as e:
+        notify(ctx, f"Error committing inventory: {str(e)}")
+        yield from release_order_inventory(ctx, order)
+        raise
+    if not result.success:
+        notify(ctx, f"Failed to reserve inventory: {result.message}")
+        yield from release_order_inventory(ctx, order)
+        return OrderResult(order.id, False, result.message)
+
+    notify(ctx, "Attempting to take payment")
 
     # Submit the order to the payment service
     try:
-        result = yield ctx.call_activity(submit_payment, input=order)
-        if not result.success:
-            yield ctx.call_activity(notify, input=f"Payment failed for order: {result.message}")
-            return OrderResult(order.id, False, result.message)
+        result = yield ctx.call_activity(submit_payment, input=order, retry_policy=PAYMENTS_RETRY_POLICY)
     except Exception as e:
-        yield ctx.call_activity(notify, input=f"Error taking payment: {str(e)}")
+        notify(ctx, f"Error taking payment: {str(e)}")
+        yield from release_order_inventory(ctx, order)
         raise
+    if not result.success:
+        notify(ctx, f"Payment failed for order: {result.message}")
+        yield from release_order_inventory(ctx, order)
+        return OrderResult(order.id, False, result.message)
 
-    yield ctx.call_activity(notify, input="Payment processed")
+    notify(ctx, "Payment processed")
 
-    yield ctx.call_activity(notify, input="Order submitted for shipping")
+    notify(ctx, "Order submitted for shipping")
 
-    # Submit the order for shipping
+    # Submit the order for shipping and wait for its wave to reach the carrier
     try:
-        yield ctx.call_activity(submit_order_to_shipping, input=order)
+        yield ctx.call_activity(submit_order_to_shipping, input=order, retry_policy=SHIPPING_RETRY_POLICY)
+        status = yield from wait_for_shipment(ctx, order)
+        if status != "shipped":
+            raise Exception(f"Shipment {status}")
     except Exception as e:
         # Shipping failed, so we need to refund the payment
-        yield ctx.call_activity(notify, input=f"Error submitting order for shipping: {str(e)}")
-        yield ctx.call_activity(refund_payment, input=order)
-        yield ctx.call_activity(notify, input="Payment refunded")
+        notify(ctx, f"Error submitting order for shipping: {str(e)}")
+        yield ctx.call_activity(refund_payment, input=order, retry_policy=REFUND_RETRY_POLICY)
+        notify(ctx, "Payment refunded")
+        yield from release_order_inventory(ctx, order)
 
         # Allow the workflow to fail with the original failure details
         raise
 
-    yield ctx.call_activity(notify, input="Shipment scheduled")
+    notify(ctx, "Order shipped")
 
-    yield ctx.call_activity(notify, input=f"Order processed for {order.customer}. Item: {order.item}, Total: {order.total}")
+    notify(ctx, f"Order processed for {order.customer}. Items: {format_line_items(order.items)}, Total: {order.total}")
 
     return OrderResult(order.id, True, "Order processed")
 
-def notify(ctx: wf.WorkflowActivityContext, message: str):
-    logging.info(f"Sending notification: {message}")
-    with DaprClient() as d:
-        d.publish_event(PUBSUB_NAME, TOPIC_NAME, json.dumps({
-            "order_id": ctx.workflow_id,
-            "message": message,
-            "data-content-type": "application/json"
-        }))
-
-
-def reserve_inventory(_, order: Order) -> InventoryResult:
-    logging.info(f"Reserving inventory for order: {order}")
-    with DaprClient() as d:
-        resp = d.invoke_method("inventory", "api/v1/inventory/reserve",  http_verb="POST",  data=json.dumps(order.__dict__))
-        if resp.status_code != 200:
-            raise Exception(f"Error calling inventory service: {resp.status_code}")
-        inventory_result = InventoryResult(**json.loads(resp.data.decode("utf-8")))
-        logging.info(f"Inventory result: {inventory_result}")
-        return inventory_result
+def wait_for_shipment(ctx: wf.DaprWorkflowContext, order: Order):
+    """Wait until the shipment of an order was shipped or failed, and return its status.
+
+    Shipping raises a "shipment" event once the order's wave has finished. In case that event
+    is lost, the workflow asks shipping itself whenever it has heard nothing for a while.
+    """
+    deadline = ctx.current_utc_datetime + SHIPMENT_TIMEOUT
+    shipment_task = ctx.wait_for_external_event("shipment")
+    interval = SHIPMENT_CHECK_FIRST_INTERVAL_SECONDS
+    while ctx.current_utc_datetime < deadline:
+        check_task = ctx.create_timer(min(ctx.current_utc_datetime + timedelta(seconds=interval), deadline))
+        winner = yield wf.when_any([shipment_task, check_task])
+        if winner == shipment_task:
+            return shipment_task.get_result()["status"]
+        status = yield ctx.call_activity(check_shipment, input=order, retry_policy=SHIPPING_RETRY_POLICY)
+        if status in ("shipped", "failed"):
+            return status
+        interval = min(interval * 2, SHIPMENT_CHECK_MAX_INTERVAL_SECONDS)
+    return "timed out"
+
+def release_order_inventory(ctx: wf.DaprWorkflowContext, order: Order, lines=None):
+    """Put back the stock held for an order that will not go ahead.
+
+    A failed release does not fail the order: inventory releases uncommitted holds by itself
+    once they expire.
+    """
+    lines = order.items if lines is None else lines
+    try:
+        yield ctx.call_activity(release_inventory, input=InventoryLines(order.id, lines, order.traceparent),
+                                retry_policy=INVENTORY_RETRY_POLICY)
+        notify(ctx, f"Released inventory: {format_line_items(lines)}")
+    except Exception as e:
+        notify(ctx, f"Error releasing inventory: {str(e)}")
+
+def update_order_index(ctx: wf.DaprWorkflowContext, indexed, update: OrderIndexUpdate):
+    """Wait for the order to be indexed as running, then index the status it finished with.
+
+    A failed index update does not fail the order, it only leaves the order listed under its
+    previous status.
+    """
+    try:
+        yield indexed
+    except Exception as e:
+        if not ctx.is_replaying:
+            logging.warning(f"Error indexing order {update.id} as running: {str(e)}")
+    try:
+        yield ctx.call_activity(index_order, input=update, retry_policy=ORDER_INDEX_RETRY_POLICY)
+    except Exception as e:
+        if not ctx.is_replaying:
+            logging.warning(f"Error indexing order {update.id} as {update.status.lower()}: {str(e)}")
+
+def trace_workflow(ctx: wf.DaprWorkflowContext, submitted_by: str, started: datetime, status: str, error=None):
+    """Record the span of a traced workflow, from when it started until now, as it finishes."""
+    if ctx.is_replaying:
+        return
+    tracer.record("workflow process_order_workflow", workflow_traces.get(ctx, ""), submitted_by,
+                  int(started.timestamp() * 1e9), int(as_utc(ctx.current_utc_datetime).timestamp() * 1e9),
+                  {"workflow.instance_id": ctx.instance_id, "workflow.status": status}, error)
+
+# Trace context of each workflow context, for the notifications it sends
+workflow_traces = weakref.WeakKeyDictionary()
+
+# Notifications sent so far by each workflow context. A context lasts one replay and a workflow
+# sends its notifications in the same order on every replay, so the count numbers them stably.
+notification_counts = weakref.WeakKeyDictionary()
+
+
+def next_notification(ctx: wf.DaprWorkflowContext) -> int:
+    sequence = notification_counts[ctx] = notification_counts.get(ctx, 0) + 1
+    return sequence
+
+def notify(ctx: wf.DaprWorkflowContext, message: str):
+    """Report the progress of an order without adding to its workflow history.
+
+    The message becomes the workflow's custom status, which GET /orders/<id> returns, and is
+    published to the notifications topic fire-and-forget. Replays skip the publish, so each
+    message normally goes out once; it is repeated only if a worker dies mid-step, with the same
+    sequence number, so watchers of the order can ignore it.
+    """
+    sequence = next_notification(ctx)
+    ctx.set_custom_status(message)
+    if not ctx.is_replaying:
+        logging.info(f"Sending notification: {message}")
+        notification_publisher.publish(ctx.instance_id, message, sequence, traceparent=workflow_traces.get(ctx, ""))
+
+def notify_finished(ctx: wf.DaprWorkflowContext, status: str, message: str):
+    """Publish the runtime status an order finishes with, as its last notification."""
+    sequence = next_notification(ctx)
+    if not ctx.is_replaying:
+        notification_publisher.publish(ctx.instance_id, message, sequence, status, workflow_traces.get(ctx, ""))
+
+
+@instrument_activity
+def add_to_approval_queue(ctx: wf.WorkflowActivityContext, request: ApprovalRequest):
+    logging.info(f"Adding order {ctx.workflow_id} to the approval queue")
+    approval_queue.add(ctx.workflow_id, to_primitive(request))
 
+
+@instrument_activity
+def remove_from_approval_queue(ctx: wf.WorkflowActivityContext, _=None):
+    logging.info(f"Removing order {ctx.workflow_id} from the approval queue")
+    approval_queue.remove(ctx.workflow_id)
+
+
+@instrument_activity
+def index_order(_, update: OrderIndexUpdate):
+    logging.info(f"Indexing order {update.id} as {update.status}")
+    order_index.update({
+        "id": update.id,
+        "customer": update.customer,
+        "total": update.total,
+        "status": update.status,
+        "created_at": update.created_at,
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    })
+
+
+def invoke_service(app_id: str, method_name: str, payload=None, http_verb="POST"):
+    """Call a downstream service through its circuit breaker, with a payload encoded as SERVICE_CONTENT_TYPE.
+
+    Connection errors and 5xx responses count as failures of the service. Any other response,
+    including a declined payment or missing stock, shows that the service is up.
+    """
+    codec = codec_for(SERVICE_CONTENT_TYPE)
+    # The trace context travels in the traceparent header, which the pooled clients add
+    body = None if payload is None else \
+        codec.encode({key: value for key, value in to_primitive(payload).items() if key != "traceparent"})
+
+    breaker = circuit_breakers.get(app_id)
+    breaker.before_call()
+    resp = None
+    try:
+        with dapr_pool.client() as d:
+            resp = d.invoke_method(app_id, method_name, http_verb=http_verb, data=body,
+                                   content_type=codec.content_type)
+    finally:
+        # Always settled, so a half-open breaker never keeps a probe that ended
+        if resp is None or resp.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    return resp
+
+
+def decode_response(resp):
+    """Decode a service's response body by its content type."""
+    return codec_for(resp.content_type).decode(resp.data)
+
+
+@instrument_activity
+def reserve_inventory(_, reservation: LineItemReservation) -> InventoryResult:
+    logging.info(f"Reserving inventory for order: {reservation}")
+    resp = invoke_service("inventory", "api/v1/inventory/reserve", reservation)
+    # Raised so the retry policy tries again; a rejected reservation is a result, not an error
+    if resp.status_code >= 500:
+        raise Exception(f"Error calling inventory service: {resp.status_code}: {resp.text()}")
+    if resp.status_code != 200:
+        return InventoryResult(reservation.id, False, f"Error calling inventory service: {resp.status_code}")
+    inventory_result = InventoryResult(**decode_response(resp))
+    logging.info(f"Inventory result: {inventory_result}")
+    return inventory_result
+
+@instrument_activity
+def commit_inventory(_, commit: InventoryLines) -> InventoryResult:
+    logging.info(f"Committing inventory for order: {commit}")
+    resp = invoke_service("inventory", "api/v1/inventory/commit", commit)
+    if resp.status_code >= 500:
+        raise Exception(f"Error calling inventory service: {resp.status_code}: {resp.text()}")
+    if resp.status_code != 200:
+        return InventoryResult(commit.id, False, f"Error calling inventory service: {resp.status_code}")
+    return InventoryResult(**decode_response(resp))
+
+@instrument_activity
+def release_inventory(_, release: InventoryLines):
+    logging.info(f"Releasing inventory for order: {release}")
+    resp = invoke_service("inventory", "api/v1/inventory/release", release)
+    if resp.status_code != 200:
+        raise Exception(f"Error calling inventory service: {resp.status_code}: {resp.text()}")
+
+@instrument_activity
+@io_activity
 def submit_order_to_shipping(_, order: Order):
     logging.info(f"Submitting order to shipping: {order}")
-    with DaprClient() as d:
-        resp = d.invoke_method("shipping", "shipping/ship",  http_verb="POST",  data=json.dumps(order.__dict__))
-        if resp.status_code != 200:
-            raise Exception(f"Error calling shipping service: {resp.status_code}: {resp.text()}")
+    resp = invoke_service("shipping", "shipping/ship", order)
+    if resp.status_code not in (200, 202):
+        raise Exception(f"Error calling shipping service: {resp.status_code}: {resp.text()}")
+    # The shipment is booked with the carrier in a later wave
+    if resp.status_code == 202:
+        logging.info(f"Order {order.id} scheduled for shipping: {decode_response(resp)}")
+
+@instrument_activity
+@io_activity
+def check_shipment(_, order: Order) -> str:
+    resp = invoke_service("shipping", f"shipping/shipments/{order.id}", http_verb="GET")
+    if resp.status_code != 200:
+        raise Exception(f"Error calling shipping service: {resp.status_code}: {resp.text()}")
+    return decode_response(resp)["status"]
 
+@instrument_activity
+@io_activity
 def submit_payment(_, order: Order) -> PaymentResult:
     logging.info(f"Submitting payment for order: {order}")
-    with DaprClient() as d:
-        resp = d.invoke_method("payments", "api/v1/payments",  http_verb="POST",  data=json.dumps(order.__dict__))
-        payment_result = PaymentResult(**json.loads(resp.data.decode("utf-8")))
-
-        if resp._status_code != 201:
-            if 'declined' not in payment_result.message:
-                raise Exception(f"Error calling payment service: {resp.status_code}: {resp.text()}")
+    resp = invoke_service("payments", "api/v1/payments", order)
+    # Raised so the retry policy tries again; a rejected charge is a result, not an error
+    if resp.status_code >= 500:
+        raise Exception(f"Error calling payment service: {resp.status_code}: {resp.text()}")
+    try:
+        body = decode_response(resp)
+    except Exception:
+        body = None
+    if resp.status_code == 201 or (isinstance(body, dict) and "success" in body):
+        payment_result = PaymentResult(**body)
+    else:
+        # An invalid charge, or one that conflicts with an earlier charge of the order
+        message = body.get("message") if isinstance(body, dict) else None
+        payment_result = PaymentResult(order.id, False,
+                                       f"Payment rejected: {resp.status_code}: {message or resp.text()}")
 
-        logging.info(f"Payment result: {payment_result}")
-        return payment_result
+    logging.info(f"Payment result: {payment_result}")
+    return payment_result
 
+@instrument_activity
+@io_activity
 def refund_payment(_, order: Order):
     logging.info(f"Refunding payment for order: {order}")
-    with DaprClient() as d:
-        resp = d.invoke_method("payments", f"api/v1/payments/{order.id}/refunds",  http_verb="POST",  data=json.dumps(order.__dict__))
-        if resp.status_code != 200:
-            raise Exception(f"Error calling payment service: {resp.status_code}: {resp.text()}")
+    resp = invoke_service("payments", f"api/v1/payments/{order.id}/refunds", order)
+    if resp.status_code != 200:
+        raise Exception(f"Error calling payment service: {resp.status_code}: {resp.text()}")
+
+
+def validate_order(request_data):
+    """Return an error message for an invalid order payload, or None if it is valid."""
+    if not request_data or not isinstance(request_data, dict):
+        return """Invalid request. Should be in the form of {
+            \"customer\": \"joe\", \"items\": [{\"item\": \"apples\", \"quantity\": 2}], \"total\": 100.0}"""
+    if not request_data.get("customer"):
+        return "Missing customer name"
+    if "items" in request_data:
+        items = request_data.get("items")
+        if not isinstance(items, list) or not items:
+            return "Missing items"
+        if len(items) > ORDER_MAX_LINE_ITEMS:
+            return f"Too many line items: {len(items)} > {ORDER_MAX_LINE_ITEMS}"
+        for line in items:
+            if not isinstance(line, dict) or not line.get("item"):
+                return "Missing item in line item"
+            quantity = line.get("quantity", 1)
+            if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity <= 0:
+                return f"Invalid quantity for item {escape(line['item'])}"
+    elif not request_data.get("item"):
+        return "Missing item"
+    total = request_data.get("total")
+    if total is None:
+        return "Missing total"
+    # The same rule as the payments service, which refuses to charge any other total
+    if not isinstance(total, (int, float)) or isinstance(total, bool) or not math.isfinite(total) or total <= 0:
+        return "Invalid total"
+    return None
+
+
+def line_items(request_data) -> List[dict]:
+    """The line items of an order payload. A single "item" is shorthand for one line with quantity 1.
+
+    Lines for the same item are merged, because inventory holds stock per order and item.
+    """
+    if "items" not in request_data:
+        return [{"item": request_data.get("item"), "quantity": 1}]
+    quantities = {}
+    for line in request_data["items"]:
+        quantities[line["item"]] = quantities.get(line["item"], 0) + line.get("quantity", 1)
+    return [{"item": item, "quantity": quantity} for item, quantity in quantities.items()]
+
+
+# Crockford's base32 alphabet, which is in ASCII order so IDs sort like the timestamps they start with
+ORDER_ID_ALPHABET = "0123456789abcdefghjkmnpqrstvwxyz"
+
+
+def new_order_id() -> str:
+    """Generate a ULID-style order ID: a millisecond timestamp followed by 80 random bits.
+
+    IDs sort by the time they were created, and the random part makes collisions negligible
+    even when many orders are submitted in the same millisecond.
+    """
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), "big")
+    chars = []
+    for _ in range(26):
+        chars.append(ORDER_ID_ALPHABET[value & 31])
+        value >>= 5
+    return "order_" + "".join(reversed(chars))
+
+
+def new_order(request_data) -> Order:
+    return Order(
+        new_order_id(),
+        request_data.get("customer"),
+        line_items(request_data),
+        request_data.get("total"),
+        # The workflow continues the trace of the request that submitted the order
+        tracer.traceparent())
+
+
+def schedule_order(order: Order) -> str:
+    with tracer.span("schedule_new_workflow process_order_workflow", CLIENT, parse_traceparent(order.traceparent),
+                     {"workflow.instance_id": order.id}, new_trace=False):
+        return get_workflow_client().schedule_new_workflow(
+            process_order_workflow,
+            input=order,
+            instance_id=order.id)
 
 
 # API to submit a new order
@@ -175,68 +681,159 @@ def refund_payment(_, order: Order):
 def submit_order():
 
     request_data = request.get_json()
-    if not request_data:
-        return """Invalid request. Should be in the form of {
-            \"customer\": \"joe\", \"item\": \"apples\", \"total\": 100.0}""", 400
-    if not request_data.get("customer"):
-        return "Missing customer name", 400
-    if not request_data.get("item"):
-        return "Missing item", 400
-    if not request_data.get("total"):
-        return "Missing total", 400
+    error = validate_order(request_data)
+    if error:
+        return error, 400
 
-    order = Order(
-        None,
-        request_data.get("customer"),
-        request_data.get("item"),
-        request_data.get("total"))
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key is not None and not 0 < len(idempotency_key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        return f"Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters", 400
+
+    order = new_order(request_data)
 
-    # Generate a unique ID for this order
-    random_suffix = ''.join(random.choices(string.ascii_lowercase + string.digits, k=5))
-    order.id = f"order_{order.customer.lower()}_{random_suffix}"
+    if idempotency_key:
+        # A retry of an earlier submission gets the original order back instead of a new workflow
+        fingerprint = hashlib.sha256(json.dumps(request_data, sort_keys=True).encode("utf-8")).hexdigest()
+        record = idempotency_store.claim(idempotency_key, {"instance_id": order.id, "fingerprint": fingerprint})
+        if record["fingerprint"] != fingerprint:
+            return "Idempotency-Key was already used for a different order", 422
+        if record["instance_id"] != order.id:
+            logging.info(f"Order with Idempotency-Key {idempotency_key} was already submitted as {record['instance_id']}")
+            return order_accepted(record["instance_id"], {'Idempotent-Replayed': 'true'})
 
-    wf_client = wf.DaprWorkflowClient()
-    instance_id = wf_client.schedule_new_workflow(
-        process_order_workflow,
-        input=order,
-        instance_id=order.id)
+    # Admitted after the claim, so a retry of an admitted order is never refused
+    try:
+        order_admission.admit(order.customer, order.id)
+    except OrderRejectedError as e:
+        if idempotency_key:
+            idempotency_store.release(idempotency_key)
+        return order_rejected(e)
+
+    try:
+        instance_id = schedule_order(order)
+    except Exception:
+        order_admission.finished(order.id)
+        if idempotency_key:
+            idempotency_store.release(idempotency_key)
+        raise
 
     logging.info(f"Started workflow instance: {instance_id}")
-    
+
+    return order_accepted(instance_id)
+
+
+def order_accepted(instance_id, headers=None):
     return json.dumps({"instance_id": instance_id}), 202, {
         'Content-Type': 'application/json',
-        'Location': url_for('check_order_status', order_id=instance_id, _external=True)
+        'Location': url_for('check_order_status', order_id=instance_id, _external=True),
+        **(headers or {})
     }
 
 
-@app.route("/orders/<order_id>", methods=["GET"])
-def check_order_status(order_id):
-    wf_client = wf.DaprWorkflowClient()
-    state = wf_client.get_workflow_state(order_id)
+def order_rejected(e: OrderRejectedError):
+    return str(e), 429, {'Retry-After': retry_after_header(e.retry_after)}
+
+
+def retry_after_header(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
+
+
+# API to submit many orders at once
+@app.route("/orders/batch", methods=["POST"])
+def submit_order_batch():
+    request_data = request.get_json(silent=True)
+    orders_data = request_data.get("orders") if isinstance(request_data, dict) else None
+    if not isinstance(orders_data, list) or not orders_data:
+        return """Invalid request. Should be in the form of { \"orders\": [
+            { \"customer\": \"joe\", \"items\": [{\"item\": \"apples\", \"quantity\": 2}], \"total\": 100.0 }, ... ] }""", 400
+    if len(orders_data) > ORDER_BATCH_MAX_SIZE:
+        return f"Too many orders in one batch: {len(orders_data)} > {ORDER_BATCH_MAX_SIZE}", 413
+
+    # Validate the whole batch up front, then only schedule the valid orders
+    errors = [validate_order(order_data) for order_data in orders_data]
+    results = [{"index": i, "error": error} for i, error in enumerate(errors)]
+    pending = []
+    retry_after = None
+    for i, error in enumerate(errors):
+        if error:
+            continue
+        order = new_order(orders_data[i])
+        # Each order is admitted on its own, so a batch cannot get past the limits of single orders
+        try:
+            order_admission.admit(order.customer, order.id)
+        except OrderRejectedError as e:
+            results[i] = {"index": i, "error": str(e), "retry_after": retry_after_header(e.retry_after)}
+            retry_after = e.retry_after if retry_after is None else min(retry_after, e.retry_after)
+            continue
+        pending.append((i, order))
+
+    futures = [(i, order, batch_executor.submit(schedule_order, order)) for i, order in pending]
+    for i, order, future in futures:
+        try:
+            results[i] = {"index": i, "instance_id": future.result()}
+        except Exception as e:
+            order_admission.finished(order.id)
+            logging.error(f"Failed to schedule order {i} of batch: {str(e)}")
+            results[i] = {"index": i, "error": f"Failed to schedule workflow: {str(e)}"}
+
+    accepted = sum(1 for result in results if "instance_id" in result)
+    logging.info(f"Started {accepted} of {len(results)} workflow instances from batch")
+
+    body = {
+        "accepted": accepted,
+        "rejected": len(results) - accepted,
+        "results": results,
+    }
+    if not accepted and retry_after is not None:
+        # Nothing was accepted and some orders only need to be sent again later
+        return body, 429, {'Retry-After': retry_after_header(retry_after)}
+    return body, 202
+
+
+def workflow_finished(order_id: str) -> bool:
+    """Whether the workflow of an order reached a terminal state or does not exist."""
+    state = get_workflow_client().get_workflow_state(order_id, fetch_payloads=False)
+    return not state or state.runtime_status.name in TERMINAL_STATUSES
+
+
+def get_order_status(order_id):
+    """Return the status of an order as a dict, or None if there is no such workflow."""
+    resp = terminal_status_cache.get(order_id)
+    if resp:
+        return resp
+
+    state = get_workflow_client().get_workflow_state(order_id)
     if not state:
-        return f"Order not found: {escape(order_id)}", 404
+        return None
 
-    order_info = json.loads(state.serialized_input)
+    # orjson, which parses the workflow's JSON payloads faster than the json module
+    json_codec = CODECS[JSON]
+    order_info = json_codec.decode(state.serialized_input)
     order = Order(
         order_info.get('id'),
         order_info.get('customer'),
-        order_info.get('item'),
-        order_info.get('total'))
+        order_info.get('items'),
+        order_info.get('total'),
+        order_info.get('traceparent', ""))
     resp = {
         "id": state.instance_id,
-        "details": order.__dict__,
+        "details": to_primitive(order),
         "status": state.runtime_status.name,
         "created_time": state.created_at.isoformat(),
         "last_updated_time": state.last_updated_at.isoformat(),
     }
 
+    if state.serialized_custom_status:
+        # The SDK keeps a string custom status as it is, not as JSON
+        resp["progress"] = state.serialized_custom_status
+
     if state.serialized_output:
-        order_result_details = json.loads(state.serialized_output)
+        order_result_details = json_codec.decode(state.serialized_output)
         order_result = OrderResult(
             order_result_details.get('id'),
             order_result_details.get('success'),
             order_result_details.get('message'))
-        resp["order_result"] = order_result.__dict__
+        resp["order_result"] = to_primitive(order_result)
 
     if state.failure_details:
         resp["failure_details"] = {
@@ -245,52 +842,307 @@ def check_order_status(order_id):
             "stack_trace": state.failure_details.stack_trace
         }
 
+    if resp["status"] in TERMINAL_STATUSES:
+        terminal_status_cache.put(order_id, resp)
+
+    return resp
+
+
+# API to list orders by customer, status and creation time
+@app.route("/orders", methods=["GET"])
+def list_orders():
+    customer = request.args.get("customer") or None
+    status = request.args.get("status", "").upper() or None
+    if status and status not in ORDER_STATUSES:
+        return f"Cannot list orders by status {escape(status)}. Should be one of {', '.join(sorted(ORDER_STATUSES))}", 400
+    try:
+        since = datetime.fromisoformat(request.args["since"]) if request.args.get("since") else None
+    except ValueError:
+        return "Invalid since. Should be an ISO 8601 time such as 2025-01-31T12:00:00Z", 400
+    cursor = request.args.get("cursor") or None
+    try:
+        if cursor:
+            order_index.parse_cursor(cursor)
+    except ValueError:
+        return f"Invalid cursor: {escape(cursor)}", 400
+    limit = request.args.get("limit", ORDER_LIST_PAGE_SIZE, type=int)
+    if not 0 < limit <= ORDER_LIST_MAX_PAGE_SIZE:
+        return f"limit must be between 1 and {ORDER_LIST_MAX_PAGE_SIZE}", 400
+
+    orders, next_cursor = order_index.list(customer, status, since, cursor, limit)
+    resp = {"orders": orders, "next_cursor": next_cursor}
+    if not next_cursor:
+        return resp, 200
+    next_args = {**request.args.to_dict(), "cursor": next_cursor, "limit": limit}
+    return resp, 200, {'Link': f'<{url_for("list_orders", _external=True, **next_args)}>; rel="next"'}
+
+
+@app.route("/orders/<order_id>", methods=["GET"])
+def check_order_status(order_id):
+    resp = get_order_status(order_id)
+    if not resp:
+        return f"Order not found: {escape(order_id)}", 404
+
     return resp, 200
 
 
-@app.route("/orders/<order_id>/approve", methods=["POST"])
-def approve_order(order_id):
-    request_data = request.get_json()
-    if not request_data:
-        return """Invalid request. Should be in the form of { \"approver\": \"joe\", \"approved\": true }""", 400
+def server_sent_event(data, event=None, event_id=None) -> str:
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+# API to follow an order: a Server-Sent Events stream, or a long-poll for clients that ask for JSON
+@app.route("/orders/<order_id>/events", methods=["GET"])
+def follow_order(order_id):
+    if not order_events.subscribed:
+        return "Order events are not available yet", 503, {'Retry-After': '5'}
+    after = request.headers.get("Last-Event-ID") or request.args.get("after") or "0"
+    if not after.isdigit():
+        return "Invalid event ID. Should be the sequence number of the last event received", 400
+    after = int(after)
+
+    # A new watcher gets the order's current status first, later requests only what changed since
+    status = None
+    if not after:
+        status = get_order_status(order_id)
+        if not status:
+            return f"Order not found: {escape(order_id)}", 404
+
+    try:
+        watch = order_events.watch(order_id)
+    except TooManyWatchersError:
+        return "Too many watchers, try again later", 503, {'Retry-After': '5'}
+
+    if request.accept_mimetypes.best_match(["application/json", "text/event-stream"]) != "text/event-stream":
+        with watch:
+            if status and status["status"] in TERMINAL_STATUSES:
+                events, finished = [], True
+            else:
+                timeout = min(request.args.get("timeout", ORDER_EVENTS_POLL_TIMEOUT_SECONDS, type=float),
+                              ORDER_EVENTS_POLL_TIMEOUT_SECONDS)
+                events, finished = watch.wait(after, 0 if status else max(timeout, 0))
+        resp = {"events": events, "last_event_id": events[-1]["sequence"] if events else after, "finished": finished}
+        if status:
+            resp["status"] = status
+        return resp, 200
+
+    def stream():
+        last = after
+        if status:
+            yield server_sent_event(status, "status")
+            if status["status"] in TERMINAL_STATUSES:
+                return
+        # Streams end after a while, and the client reconnects with the ID of the last event it got
+        deadline = time.monotonic() + ORDER_EVENTS_STREAM_SECONDS
+        while time.monotonic() < deadline:
+            events, finished = watch.wait(last, min(ORDER_EVENTS_KEEPALIVE_SECONDS, deadline - time.monotonic()))
+            for event in events:
+                last = event["sequence"]
+                yield server_sent_event(event, "finished" if event.get("status") else "progress", last)
+            if finished:
+                return
+            if not events:
+                yield ": keepalive\n\n"
+
+    response = Response(stream(), content_type="text/event-stream", headers={'Cache-Control': 'no-cache'})
+    response.call_on_close(watch.close)
+    return response
+
+
+# API to look up the status of many orders at once
+@app.route("/orders/status", methods=["POST"])
+def check_order_status_batch():
+    request_data = request.get_json(silent=True)
+    order_ids = request_data.get("instance_ids") if isinstance(request_data, dict) else None
+    if not isinstance(order_ids, list) or not order_ids or not all(isinstance(i, str) for i in order_ids):
+        return """Invalid request. Should be in the form of { \"instance_ids\": [\"order_01jb3k5m8f9w2x7r4t6y0z1c2d\", ...] }""", 400
+    if len(order_ids) > ORDER_STATUS_BATCH_MAX_SIZE:
+        return f"Too many orders in one lookup: {len(order_ids)} > {ORDER_STATUS_BATCH_MAX_SIZE}", 413
+
+    futures = [(order_id, batch_executor.submit(get_order_status, order_id)) for order_id in order_ids]
+    results = []
+    for order_id, future in futures:
+        try:
+            resp = future.result()
+            results.append(resp if resp else {"id": order_id, "error": "Order not found"})
+        except Exception as e:
+            logging.error(f"Failed to get status of order {order_id}: {str(e)}")
+            results.append({"id": order_id, "error": f"Failed to get order status: {str(e)}"})
+
+    return {"results": results}, 200
+
+
+def parse_approval(request_data):
+    """Return an (Approval, error message) pair for an approval payload."""
+    if not request_data or not isinstance(request_data, dict):
+        return None, """Invalid request. Should be in the form of { \"approver\": \"joe\", \"approved\": true }"""
     if not request_data.get("approver"):
-        return "Missing approver name", 400
+        return None, "Missing approver name"
     if "approved" not in request_data:
-        return "Missing approved flag", 400
+        return None, "Missing approved flag"
 
     approval = Approval(
         request_data.get("approver"),
         request_data.get("approved"))
+    return approval, None
 
-    wf_client = wf.DaprWorkflowClient()
-    wf_client.raise_workflow_event(order_id, "approval", data=approval)
+
+@app.route("/orders/<order_id>/approve", methods=["POST"])
+def approve_order(order_id):
+    approval, error = parse_approval(request.get_json())
+    if error:
+        return error, 400
+
+    get_workflow_client().raise_workflow_event(order_id, "approval", data=approval)
 
     return f"Approval sent for order: {escape(order_id)}", 200
 
 
+# Called by shipping once the waves of some orders have finished
+@app.route("/orders/shipments", methods=["POST"])
+def report_shipments():
+    request_data = request.get_json(silent=True)
+    shipments = request_data.get("shipments") if isinstance(request_data, dict) else None
+    if not isinstance(shipments, list) or not all(
+            isinstance(shipment, dict) and isinstance(shipment.get("order_id"), str)
+            and shipment.get("status") in ("shipped", "failed") for shipment in shipments):
+        return """Invalid request. Should be in the form of { \"shipments\": [{ \"order_id\": \"order_01jb3k5m8f9w2x7r4t6y0z1c2d\", \"status\": \"shipped\" }, ...] }""", 400
+
+    def report(shipment):
+        try:
+            get_workflow_client().raise_workflow_event(shipment["order_id"], "shipment", data=shipment)
+            return True
+        except Exception as e:
+            # The workflow asks shipping itself once it has waited long enough
+            logging.warning(f"Failed to report the shipment of order {shipment['order_id']}: {str(e)}")
+            return False
+
+    reported = sum(batch_executor.map(report, shipments))
+    return {"reported": reported, "failed": len(shipments) - reported}, 200
+
+
+# API to list the orders waiting for approval
+@app.route("/orders/approvals", methods=["GET"])
+def list_pending_approvals():
+    return {"orders": approval_queue.list()}, 200
+
+
+# API to approve or reject many orders at once
+@app.route("/orders/approvals", methods=["POST"])
+def approve_order_batch():
+    request_data = request.get_json(silent=True)
+    approval, error = parse_approval(request_data)
+    if error:
+        return error, 400
+
+    order_ids = request_data.get("instance_ids")
+    if not isinstance(order_ids, list) or not order_ids or not all(isinstance(i, str) for i in order_ids):
+        return "Missing instance_ids", 400
+    if len(order_ids) > ORDER_APPROVAL_BATCH_MAX_SIZE:
+        return f"Too many orders in one approval: {len(order_ids)} > {ORDER_APPROVAL_BATCH_MAX_SIZE}", 413
+
+    wf_client = get_workflow_client()
+    futures = [(order_id, batch_executor.submit(wf_client.raise_workflow_event, order_id, "approval", data=approval))
+               for order_id in order_ids]
+    results = []
+    for order_id, future in futures:
+        try:
+            future.result()
+            results.append({"id": order_id, "sent": True})
+        except Exception as e:
+            logging.error(f"Failed to send approval for order {order_id}: {str(e)}")
+            results.append({"id": order_id, "sent": False, "error": str(e)})
+
+    sent = sum(1 for result in results if result["sent"])
+    logging.info(f"{approval.approver} {'approved' if approval.approved else 'rejected'} {sent} orders")
+
+    return {"sent": sent, "failed": len(results) - sent, "results": results}, 200
+
+
 @app.route("/", methods=["GET"])
 @app.route("/healthz", methods=["GET"])
 def hello():
     return f"Hello from {__name__}", 200
 
 
-def main():
-    # Start the workflow runtime
-    logging.info("Starting workflow runtime...")
-    wf_runtime = wf.WorkflowRuntime()  # host/port comes from env vars
-    wf_runtime.register_workflow(process_order_workflow)
-    wf_runtime.register_activity(notify)
-    wf_runtime.register_activity(reserve_inventory)
-    wf_runtime.register_activity(submit_payment)
-    wf_runtime.register_activity(submit_order_to_shipping)
-    wf_runtime.register_activity(refund_payment)
-    wf_runtime.start()  # non-blocking
+wf_runtime = None
+wf_runtime_lock = threading.Lock()
 
-    # Start the Flask app server
-    app.run(host='0.0.0.0', port=APP_PORT, debug=False, use_reloader=False)
 
-    # Stop the workflow runtime to allow the process to terminate
-    wf_runtime.shutdown()
+def start_workflow_runtime():
+    global wf_runtime
+    with wf_runtime_lock:
+        # Start the workflow runtime
+        logging.info("Starting workflow runtime...")
+        wf_runtime = wf.WorkflowRuntime()  # host/port comes from env vars
+        configure_concurrency(wf_runtime)
+        wf_runtime.register_workflow(process_order_workflow)
+        wf_runtime.register_activity(add_to_approval_queue)
+        wf_runtime.register_activity(remove_from_approval_queue)
+        wf_runtime.register_activity(index_order)
+        wf_runtime.register_activity(reserve_inventory)
+        wf_runtime.register_activity(commit_inventory)
+        wf_runtime.register_activity(release_inventory)
+        wf_runtime.register_activity(submit_payment)
+        wf_runtime.register_activity(submit_order_to_shipping)
+        wf_runtime.register_activity(check_shipment)
+        wf_runtime.register_activity(refund_payment)
+        # Workflows publish notifications as soon as the runtime starts
+        notification_publisher.start()
+        wf_runtime.start()  # non-blocking
+
+
+def stop_workflow_runtime():
+    global wf_runtime
+    with wf_runtime_lock:
+        if not wf_runtime:
+            return
+
+        # Stop the workflow runtime to allow the process to terminate
+        wf_runtime.shutdown()
+        wf_runtime = None
+
+        # Flush any buffered notifications
+        notification_publisher.close()
+
+
+def start_worker():
+    # Every process serving the API follows order events, whether or not it runs workflows
+    order_events.start()
+    # and looks up the workflows it admitted whose final notification is overdue
+    order_admission.start(workflow_finished, ORDER_ADMISSION_IN_FLIGHT_TTL_SECONDS)
+
+    if not WORKFLOW_WORKER_ENABLED:
+        logging.info("Workflow worker disabled, serving the HTTP API only")
+        return
+
+    if SERVER_MODE == "prod":
+        # Only one of the server's worker processes may run the workflow runtime
+        process_group_lock.acquire_in_background(start_workflow_runtime)
+    else:
+        start_workflow_runtime()
+
+
+def stop_worker():
+    order_events.close()
+    order_admission.close()
+    batch_executor.shutdown(wait=True)
+    stop_workflow_runtime()
+    process_group_lock.release()
+
+    # Close the pooled Dapr clients once no more activities can run
+    dapr_pool.close()
+
+    # Export the spans still queued
+    tracer.close()
+
+
+def main():
+    # Start the Flask app server
+    serve(app, host='0.0.0.0', port=APP_PORT, post_worker_init=start_worker, worker_exit=stop_worker)
 
 
 if __name__ == "__main__":
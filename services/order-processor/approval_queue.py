@@ -0,0 +1,85 @@
+import json
+import logging
+import os
+import random
+import time
+import zlib
+
+import grpc
+from dapr.clients.grpc._state import Concurrency, Consistency, StateOptions
+
+from dapr_pool import dapr_pool
+
+STATESTORE_NAME = os.getenv("STATESTORE_NAME", "statestore")
+APPROVAL_QUEUE_KEY = os.getenv("APPROVAL_QUEUE_KEY", "order-processor||approval-queue")
+APPROVAL_QUEUE_MAX_RETRIES = int(os.getenv("APPROVAL_QUEUE_MAX_RETRIES", 20))
+# Keys the queue is spread over, so concurrent workflows rarely update the same one
+APPROVAL_QUEUE_SHARDS = int(os.getenv("APPROVAL_QUEUE_SHARDS", 16))
+APPROVAL_QUEUE_BULK_PARALLELISM = int(os.getenv("APPROVAL_QUEUE_BULK_PARALLELISM", 4))
+
+# gRPC codes returned by the sidecar when an ETag no longer matches
+ETAG_CONFLICT_CODES = (grpc.StatusCode.ABORTED, grpc.StatusCode.FAILED_PRECONDITION)
+
+logger = logging.getLogger("approval_queue")
+
+
+class ApprovalQueue:
+    """The set of orders currently waiting for approval, spread over `shards` state store keys.
+
+    Dapr workflows cannot be queried across instances, so workflows add themselves before they
+    wait for an approval and remove themselves once it arrives or times out. Each order lives in
+    the shard its instance ID hashes to, and updates use ETag compare-and-swap on that shard so
+    concurrent workflows never lose each other's entries. Listing reads all shards in one bulk call.
+    """
+
+    def __init__(self, pool=dapr_pool, store_name=STATESTORE_NAME, key=APPROVAL_QUEUE_KEY,
+                 shards=APPROVAL_QUEUE_SHARDS, max_retries=APPROVAL_QUEUE_MAX_RETRIES):
+        self._pool = pool
+        self._store_name = store_name
+        self._key = key
+        self._shards = max(shards, 1)
+        self._max_retries = max_retries
+        self._options = StateOptions(concurrency=Concurrency.first_write, consistency=Consistency.strong)
+
+    def list(self):
+        with self._pool.client() as d:
+            resp = d.get_bulk_state(self._store_name, [self._shard_key(shard) for shard in range(self._shards)],
+                                    parallelism=APPROVAL_QUEUE_BULK_PARALLELISM)
+        entries = []
+        for state in resp.items:
+            if state.error:
+                raise Exception(f"Error retrieving approval queue shard {state.key}: {state.error}")
+            if state.data:
+                entries.extend(json.loads(state.data).values())
+        return sorted(entries, key=lambda entry: entry["since"])
+
+    def add(self, instance_id: str, entry: dict):
+        self._update(instance_id,
+                     lambda entries: entries.__setitem__(instance_id, {**entry, "instance_id": instance_id}))
+
+    def remove(self, instance_id: str):
+        self._update(instance_id, lambda entries: entries.pop(instance_id, None))
+
+    def _update(self, instance_id: str, mutate):
+        # crc32 rather than hash(), which differs between processes
+        key = self._shard_key(zlib.crc32(instance_id.encode("utf-8")) % self._shards)
+        for attempt in range(self._max_retries + 1):
+            with self._pool.client() as d:
+                resp = d.get_state(self._store_name, key)
+                entries = json.loads(resp.data) if resp.data else {}
+                mutate(entries)
+                try:
+                    d.save_state(self._store_name, key, json.dumps(entries), etag=resp.etag or None,
+                                 options=self._options)
+                    return
+                except grpc.RpcError as err:
+                    if err.code() not in ETAG_CONFLICT_CODES:
+                        raise
+            time.sleep(random.uniform(0, min(0.2, 0.005 * 2 ** attempt)))
+        raise Exception(f"Gave up updating the approval queue after {self._max_retries} conflicts")
+
+    def _shard_key(self, shard: int) -> str:
+        return f"{self._key}||{shard}"
+
+
+approval_queue = ApprovalQueue()
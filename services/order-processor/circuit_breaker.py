@@ -0,0 +1,117 @@
+import logging
+import os
+import threading
+import time
+
+from metrics import Counter, Gauge, registry
+
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", 5))
+CIRCUIT_BREAKER_RESET_TIMEOUT_SECONDS = float(os.getenv("CIRCUIT_BREAKER_RESET_TIMEOUT_SECONDS", 10))
+CIRCUIT_BREAKER_HALF_OPEN_CALLS = int(os.getenv("CIRCUIT_BREAKER_HALF_OPEN_CALLS", 1))
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+# Exported as a number so dashboards can graph it: 0 closed, 1 half-open, 2 open
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BREAKER_STATE = Gauge(registry, "circuit_breaker_state",
+                      "State of the circuit breaker of a downstream app: 0 closed, 1 half-open, 2 open.", ("target",),
+                      aggregate="max")
+BREAKER_TRANSITIONS = Counter(registry, "circuit_breaker_transitions_total",
+                              "Circuit breaker state changes, by the state entered.", ("target", "state"))
+BREAKER_REJECTED = Counter(registry, "circuit_breaker_rejected_calls_total",
+                           "Calls failed fast because the circuit breaker was open.", ("target",))
+
+logger = logging.getLogger("circuit_breaker")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Fails calls to a downstream app fast while it keeps failing.
+
+    After `failure_threshold` consecutive failures the breaker opens and rejects every call for
+    `reset_timeout` seconds. It then lets up to `half_open_calls` probes through: one success
+    closes it again, one failure opens it for another `reset_timeout`.
+    """
+
+    def __init__(self, target: str, failure_threshold=CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout=CIRCUIT_BREAKER_RESET_TIMEOUT_SECONDS, half_open_calls=CIRCUIT_BREAKER_HALF_OPEN_CALLS):
+        self.target = target
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._half_open_calls = half_open_calls
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go through now."""
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self._reset_timeout:
+                    BREAKER_REJECTED.inc(self.target)
+                    raise CircuitOpenError(f"Circuit breaker for {self.target} is open")
+                self._transition(HALF_OPEN)
+            if self._state == HALF_OPEN:
+                if self._probes >= self._half_open_calls:
+                    BREAKER_REJECTED.inc(self.target)
+                    raise CircuitOpenError(f"Circuit breaker for {self.target} is half-open and probing")
+                self._probes += 1
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self._state != CLOSED:
+                self._transition(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self._failure_threshold):
+                self._opened_at = time.monotonic()
+                self._transition(OPEN)
+
+    def _transition(self, state: str):
+        # Called with the lock held
+        BREAKER_STATE.inc(self.target, amount=STATE_VALUES[state] - STATE_VALUES[self._state])
+        BREAKER_TRANSITIONS.inc(self.target, state)
+        if state == OPEN:
+            logger.warning(f"Circuit breaker for {self.target} opened after {self._failures} failures")
+        else:
+            logger.info(f"Circuit breaker for {self.target} is {state.replace('_', '-')}")
+        self._state = state
+        self._probes = 0
+
+
+class CircuitBreakers:
+    """One circuit breaker per downstream app ID, shared by every activity in the process."""
+
+    def __init__(self):
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, target: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(target)
+            if breaker is None:
+                breaker = self._breakers[target] = CircuitBreaker(target)
+            return breaker
+
+    def states(self):
+        with self._lock:
+            return {target: breaker.state for target, breaker in self._breakers.items()}
+
+
+circuit_breakers = CircuitBreakers()
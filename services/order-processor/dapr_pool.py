@@ -0,0 +1,152 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import dapr.ext.workflow as wf
+import grpc
+from dapr.clients import DaprClient
+from metrics import InstrumentedDaprClient
+from tracing import TracedDaprClient
+
+DAPR_CLIENT_POOL_SIZE = int(os.getenv("DAPR_CLIENT_POOL_SIZE", 8))
+DAPR_CLIENT_ACQUIRE_TIMEOUT = float(os.getenv("DAPR_CLIENT_ACQUIRE_TIMEOUT", 10.0))
+DAPR_CLIENT_HEALTH_CHECK_INTERVAL = float(os.getenv("DAPR_CLIENT_HEALTH_CHECK_INTERVAL", 30.0))
+
+logger = logging.getLogger("dapr_pool")
+
+
+class DaprClientPool:
+    """A bounded, thread-safe pool of DaprClient instances.
+
+    Creating a DaprClient waits for the sidecar to report healthy and opens a new gRPC
+    channel, so activities borrow an already connected client instead of building one per call.
+    """
+
+    def __init__(self, size=DAPR_CLIENT_POOL_SIZE, acquire_timeout=DAPR_CLIENT_ACQUIRE_TIMEOUT,
+                 health_check_interval=DAPR_CLIENT_HEALTH_CHECK_INTERVAL, factory=DaprClient):
+        self._size = size
+        self._acquire_timeout = acquire_timeout
+        self._health_check_interval = health_check_interval
+        self._factory = factory
+        # Idle clients, the most recently returned last
+        self._idle = []
+        self._last_used = {}
+        self._created = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        # Signalled whenever a client is returned or discarded, so a waiter can take or create one
+        self._available = threading.Condition(self._lock)
+
+    @contextmanager
+    def client(self):
+        """Borrow a client for the duration of a `with` block."""
+        client = self._acquire()
+        healthy = True
+        try:
+            yield client
+        except grpc.RpcError as err:
+            # A dead channel should not go back into the pool
+            if err.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.CANCELLED):
+                healthy = False
+            raise
+        finally:
+            self._release(client, healthy)
+
+    def close(self):
+        """Close every idle client. Clients still in use are closed when they are returned."""
+        with self._available:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._available.notify_all()
+        for client in idle:
+            self._discard(client)
+        logger.info("Dapr client pool closed")
+
+    def _acquire(self):
+        deadline = time.monotonic() + self._acquire_timeout
+        while True:
+            client = self._take_or_create(deadline)
+            if self._is_healthy(client):
+                return client
+            self._discard(client)
+
+    def _take_or_create(self, deadline):
+        """Take an idle client, or create one if the pool has room, waiting until `deadline` for either."""
+        with self._available:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Dapr client pool is closed")
+                if self._idle:
+                    return self._idle.pop()
+                if self._created < self._size:
+                    self._created += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"Timed out waiting {self._acquire_timeout}s for a Dapr client")
+                self._available.wait(remaining)
+
+        try:
+            client = self._factory()
+        except Exception:
+            with self._available:
+                self._created -= 1
+                self._available.notify()
+            raise
+        self._last_used[id(client)] = time.monotonic()
+        return client
+
+    def _is_healthy(self, client):
+        # Only probe clients that have been sitting idle for a while
+        idle_for = time.monotonic() - self._last_used.get(id(client), 0)
+        if idle_for < self._health_check_interval:
+            return True
+        try:
+            client.get_metadata()
+            return True
+        except grpc.RpcError as err:
+            logger.warning(f"Discarding unhealthy Dapr client: {err.code()}")
+            return False
+
+    def _release(self, client, healthy):
+        with self._available:
+            if healthy and not self._closed:
+                self._last_used[id(client)] = time.monotonic()
+                self._idle.append(client)
+                self._available.notify()
+                return
+        self._discard(client)
+
+    def _discard(self, client):
+        with self._available:
+            self._created -= 1
+            self._last_used.pop(id(client), None)
+            # The freed slot lets a waiter create a new client
+            self._available.notify()
+        try:
+            client.close()
+        except Exception as e:
+            logger.warning(f"Error closing Dapr client: {str(e)}")
+
+
+# Process-wide pool shared by all workflow activities
+dapr_pool = DaprClientPool(factory=lambda: InstrumentedDaprClient(TracedDaprClient(DaprClient())))
+
+
+_workflow_client = None
+_workflow_client_lock = threading.Lock()
+
+
+def get_workflow_client():
+    """Return the process-wide DaprWorkflowClient.
+
+    The client wraps a single gRPC channel, which is safe to share between request threads.
+    """
+    global _workflow_client
+    if _workflow_client is None:
+        with _workflow_client_lock:
+            if _workflow_client is None:
+                _workflow_client = wf.DaprWorkflowClient()
+    return _workflow_client
@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+
+import grpc
+from dapr.clients.grpc._state import Concurrency, Consistency, StateOptions
+
+from caches import LRUCache
+from dapr_pool import dapr_pool
+
+STATESTORE_NAME = os.getenv("STATESTORE_NAME", "statestore")
+IDEMPOTENCY_KEY_PREFIX = os.getenv("IDEMPOTENCY_KEY_PREFIX", "order-processor||idempotency||")
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", 24 * 60 * 60))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 10000))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+# gRPC codes returned by the sidecar when a first write loses to an existing record
+CONFLICT_CODES = (grpc.StatusCode.ABORTED, grpc.StatusCode.FAILED_PRECONDITION)
+
+logger = logging.getLogger("idempotency")
+
+
+class IdempotencyStore:
+    """Remembers which order each Idempotency-Key created, so retried submissions are not scheduled twice.
+
+    Records live in the state store for `ttl_seconds`, written with first-write-wins so only one
+    of several concurrent submissions with the same key can claim it. Recently seen keys are also
+    kept in a bounded in-process LRU, which answers most client retries without a sidecar call.
+    """
+
+    def __init__(self, pool=dapr_pool, store_name=STATESTORE_NAME, prefix=IDEMPOTENCY_KEY_PREFIX,
+                 ttl_seconds=IDEMPOTENCY_TTL_SECONDS, cache_size=IDEMPOTENCY_CACHE_SIZE):
+        self._pool = pool
+        self._store_name = store_name
+        self._prefix = prefix
+        self._ttl = ttl_seconds
+        self._cache = LRUCache(cache_size, ttl_seconds)
+        self._options = StateOptions(concurrency=Concurrency.first_write, consistency=Consistency.strong)
+
+    def get(self, key: str):
+        """Return the record claimed for a key, or None if the key has not been used."""
+        record = self._cache.get(key)
+        if record:
+            return record
+
+        with self._pool.client() as d:
+            resp = d.get_state(self._store_name, self._prefix + key)
+        if not resp.data:
+            return None
+        record = json.loads(resp.data)
+        self._cache.put(key, record)
+        return record
+
+    def claim(self, key: str, record: dict):
+        """Store a record for a key unless one exists already. Returns the record that owns the key."""
+        existing = self.get(key)
+        if existing:
+            return existing
+
+        try:
+            with self._pool.client() as d:
+                d.save_state(self._store_name, self._prefix + key, json.dumps(record), options=self._options,
+                             state_metadata={"ttlInSeconds": str(self._ttl)})
+        except grpc.RpcError as err:
+            if err.code() not in CONFLICT_CODES:
+                raise
+            # A concurrent submission with the same key got there first
+            self._cache.pop(key)
+            existing = self.get(key)
+            if existing:
+                return existing
+            raise
+
+        self._cache.put(key, record)
+        return record
+
+    def release(self, key: str):
+        """Forget a key whose order could not be scheduled, so the client can retry it."""
+        self._cache.pop(key)
+        with self._pool.client() as d:
+            d.delete_state(self._store_name, self._prefix + key)
+
+
+idempotency_store = IdempotencyStore()
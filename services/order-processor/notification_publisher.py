@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from dapr.proto import api_v1
+from dapr_pool import dapr_pool
+from metrics import SIDECAR_CALL_SECONDS
+from tracing import PRODUCER, parse_traceparent, tracer
+
+PUBSUB_NAME = os.getenv("PUBSUB_NAME", "pubsub")
+TOPIC_NAME = os.getenv("TOPIC_NAME", "notifications")
+
+# "batch" buffers notifications and bulk publishes them, "sync" publishes each one immediately
+NOTIFY_PUBLISH_MODE = os.getenv("NOTIFY_PUBLISH_MODE", "batch")
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", 100))
+NOTIFY_BATCH_WINDOW_MS = float(os.getenv("NOTIFY_BATCH_WINDOW_MS", 20))
+
+logger = logging.getLogger("notification_publisher")
+
+
+class NotificationPublisher:
+    """Coalesces notifications from concurrent workflows into bulk publish calls.
+
+    A batch is flushed when it reaches `batch_size` messages or when its oldest message has
+    waited `batch_window_ms`. `publish` is fire-and-forget: it only appends to the buffer, and
+    the buffer is flushed in order, so messages for the same order keep the order they were
+    published in. If part of a bulk publish fails, each affected order's messages are published
+    again from its first failed one, in order. Watchers drop the repeats by their sequence
+    number. Messages that cannot be published are logged and dropped. Each message of a
+    traced order gets a span from when it is queued until it is published.
+    """
+
+    def __init__(self, pool=dapr_pool, pubsub_name=PUBSUB_NAME, topic_name=TOPIC_NAME, mode=NOTIFY_PUBLISH_MODE,
+                 batch_size=NOTIFY_BATCH_SIZE, batch_window_ms=NOTIFY_BATCH_WINDOW_MS):
+        self._pool = pool
+        self._pubsub_name = pubsub_name
+        self._topic_name = topic_name
+        self._mode = mode
+        self._batch_size = batch_size
+        self._batch_window = batch_window_ms / 1000.0
+        self._pending = []
+        self._oldest = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._flusher = None
+
+    def start(self):
+        if self._mode != "batch" or self._flusher:
+            return
+        self._flusher = threading.Thread(target=self._run, name="notification-flusher", daemon=True)
+        self._flusher.start()
+        logger.info(f"Batching notifications: size={self._batch_size}, window={self._batch_window * 1000:.0f}ms")
+
+    def publish(self, order_id: str, message: str, sequence=None, status=None, traceparent=""):
+        """Queue a notification. `sequence` numbers the notifications of an order, `status` marks its last one."""
+        notification = {
+            "order_id": order_id,
+            "message": message,
+            "data-content-type": "application/json"
+        }
+        if sequence is not None:
+            notification["sequence"] = sequence
+        if status is not None:
+            notification["status"] = status
+        payload = json.dumps(notification)
+        span = tracer.start_span(f"publish {self._topic_name}", PRODUCER, parse_traceparent(traceparent),
+                                 {"messaging.destination.name": self._topic_name}, new_trace=False)
+
+        with self._cond:
+            batching = self._flusher is not None and not self._closed
+            if batching:
+                if not self._pending:
+                    self._oldest = time.monotonic()
+                self._pending.append((order_id, payload, span))
+                # Wake the flusher to start the window timer or to flush a full batch
+                if len(self._pending) == 1 or len(self._pending) >= self._batch_size:
+                    self._cond.notify()
+
+        if not batching:
+            try:
+                self._publish_one(payload)
+            except Exception as err:
+                span.record_error(err)
+                logger.warning(f"Failed to publish notification for order {order_id}: {str(err)}")
+            span.end()
+
+    def close(self):
+        """Flush whatever is still buffered and stop the flusher thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._flusher:
+            self._flusher.join()
+            self._flusher = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready():
+                    timeout = None
+                    if self._pending:
+                        timeout = max(0.0, self._oldest + self._batch_window - time.monotonic())
+                    self._cond.wait(timeout)
+                batch = self._pending[:self._batch_size]
+                del self._pending[:self._batch_size]
+                self._oldest = time.monotonic() if self._pending else None
+                done = self._closed and not self._pending
+
+            if batch:
+                self._flush(batch)
+            if done:
+                return
+
+    def _ready(self):
+        if self._closed or len(self._pending) >= self._batch_size:
+            return True
+        return bool(self._pending) and time.monotonic() - self._oldest >= self._batch_window
+
+    def _flush(self, batch):
+        payloads = [payload for _, payload, _ in batch]
+        try:
+            failed = self._bulk_publish(payloads)
+        except Exception as e:
+            logger.warning(f"Bulk publish of {len(batch)} notifications failed, publishing individually: {str(e)}")
+            failed = range(len(batch))
+
+        # A later message of an order may have gone out before one that failed, so publish the
+        # order's messages again one at a time from the first that failed, in the original order
+        first_failed = {}
+        for index in sorted(failed):
+            first_failed.setdefault(batch[index][0], index)
+        for index, (order_id, payload, span) in enumerate(batch):
+            if index < first_failed.get(order_id, len(batch)):
+                continue
+            try:
+                self._publish_one(payload)
+            except Exception as err:
+                span.record_error(err)
+                logger.warning(f"Dropped notification that failed to publish: {str(err)}")
+
+        for _, _, span in batch:
+            span.set_attribute("messaging.batch.message_count", len(batch))
+            span.end()
+
+    def _bulk_publish(self, payloads):
+        """Publish all payloads in one BulkPublishEventAlpha1 call and return the indexes that failed."""
+        # The 1.15 Python SDK has no bulk publish method, so call the sidecar's gRPC API directly
+        req = api_v1.BulkPublishRequest(
+            pubsub_name=self._pubsub_name,
+            topic=self._topic_name,
+            entries=[
+                api_v1.BulkPublishRequestEntry(entry_id=str(i), event=payload.encode("utf-8"),
+                                               content_type="application/json")
+                for i, payload in enumerate(payloads)
+            ])
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            with self._pool.client() as d:
+                resp = d._stub.BulkPublishEventAlpha1(req)
+            outcome = "partial" if resp.failedEntries else "ok"
+        finally:
+            SIDECAR_CALL_SECONDS.observe(time.perf_counter() - start, "bulk_publish_event", self._pubsub_name, outcome)
+        if resp.failedEntries:
+            logger.warning(f"{len(resp.failedEntries)} of {len(payloads)} notifications failed to publish: "
+                           f"{resp.failedEntries[0].error}")
+        return [int(entry.entry_id) for entry in resp.failedEntries]
+
+    def _publish_one(self, payload):
+        with self._pool.client() as d:
+            d.publish_event(self._pubsub_name, self._topic_name, payload)
+
+
+# Process-wide publisher shared by all workflows
+notification_publisher = NotificationPublisher()
@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from dapr.clients import DaprClient
+from dapr.clients.grpc._response import TopicEventResponse
+
+from metrics import Counter, Gauge, registry
+from serving import SERVER_MODE, SERVER_THREADS
+
+# A pub/sub component that gives every process its own consumer of the notifications topic,
+# so each process sees every notification. See resources/order-events.yaml.
+ORDER_EVENTS_PUBSUB_NAME = os.getenv("ORDER_EVENTS_PUBSUB_NAME", "order-events")
+TOPIC_NAME = os.getenv("TOPIC_NAME", "notifications")
+# Recent events kept per order, and orders kept, for watchers that resume after an event
+ORDER_EVENTS_PER_ORDER = int(os.getenv("ORDER_EVENTS_PER_ORDER", 100))
+ORDER_EVENTS_MAX_ORDERS = int(os.getenv("ORDER_EVENTS_MAX_ORDERS", 10000))
+# Every watcher holds a server thread while it waits. A prod worker has SERVER_THREADS of them, so
+# watchers may use all but ORDER_EVENTS_RESERVED_THREADS, which are left for the other requests.
+ORDER_EVENTS_MAX_WATCHERS = int(os.getenv("ORDER_EVENTS_MAX_WATCHERS", 1000))
+ORDER_EVENTS_RESERVED_THREADS = int(os.getenv("ORDER_EVENTS_RESERVED_THREADS", 4))
+if SERVER_MODE == "prod":
+    ORDER_EVENTS_MAX_WATCHERS = max(0, min(ORDER_EVENTS_MAX_WATCHERS, SERVER_THREADS - ORDER_EVENTS_RESERVED_THREADS))
+ORDER_EVENTS_SUBSCRIBE_RETRY_SECONDS = float(os.getenv("ORDER_EVENTS_SUBSCRIBE_RETRY_SECONDS", 5))
+
+WATCHERS = Gauge(registry, "order_event_watchers", "Requests waiting for the events of an order.")
+EVENTS_RECEIVED = Counter(registry, "order_events_received_total",
+                          "Order notifications received from the subscription, by whether they were new.",
+                          ("outcome",))
+
+logger = logging.getLogger("order_events")
+
+
+class TooManyWatchersError(Exception):
+    pass
+
+
+class _Timeline:
+    """The recent events of one order, by sequence number."""
+
+    def __init__(self):
+        self.events = OrderedDict()
+        self.finished = False
+        # Watchers waiting on this timeline, counted under the hub's lock
+        self.watchers = 0
+        self.changed = threading.Condition()
+
+
+class OrderEventHub:
+    """Fans the notifications of orders out to the requests watching them.
+
+    Each process opens one subscription to the notifications topic and hands every message to
+    the watchers of its order in memory, so watching costs the sidecar nothing. Workflows number
+    their notifications, which lets a watcher resume after the last event it saw and lets the hub
+    drop notifications that are delivered twice.
+    """
+
+    def __init__(self, client_factory=DaprClient, pubsub_name=ORDER_EVENTS_PUBSUB_NAME, topic_name=TOPIC_NAME,
+                 per_order=ORDER_EVENTS_PER_ORDER, max_orders=ORDER_EVENTS_MAX_ORDERS,
+                 max_watchers=ORDER_EVENTS_MAX_WATCHERS):
+        self._client_factory = client_factory
+        self._pubsub_name = pubsub_name
+        self._topic_name = topic_name
+        self._per_order = per_order
+        self._max_orders = max_orders
+        self._max_watchers = max_watchers
+        self._timelines = OrderedDict()
+        self._watchers = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._client = None
+        self._close_subscription = None
+        self._finished_listeners = []
+
+    @property
+    def subscribed(self) -> bool:
+        return self._close_subscription is not None
+
+    def start(self):
+        """Subscribe in the background, retrying until the sidecar accepts the subscription."""
+        if self._thread:
+            return
+        if self._max_watchers <= 0:
+            logger.warning("No server threads are left for order event watchers, raise SERVER_THREADS to serve them")
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._subscribe, name="order-events", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._close_subscription:
+            self._close_subscription()
+            self._close_subscription = None
+        if self._client:
+            self._client.close()
+            self._client = None
+        # Wake every watcher so its request can finish
+        with self._lock:
+            timelines = list(self._timelines.values())
+        for timeline in timelines:
+            with timeline.changed:
+                timeline.changed.notify_all()
+
+    def on_finished(self, listener):
+        """Call `listener(order_id, status)` once for every order whose final notification arrives."""
+        self._finished_listeners.append(listener)
+
+    def handle(self, message) -> TopicEventResponse:
+        """Take one message of the subscription."""
+        event = message.data()
+        if isinstance(event, (str, bytes)):
+            try:
+                event = json.loads(event)
+            except ValueError:
+                event = None
+        if isinstance(event, dict) and event.get("order_id"):
+            self.publish(event)
+        else:
+            logger.warning(f"Dropped malformed notification: {message.raw_data()!r}")
+        return TopicEventResponse("success")
+
+    def publish(self, event: dict):
+        """Record an event of an order and wake its watchers. Events seen before are ignored."""
+        timeline = self._timeline(event["order_id"])
+        with timeline.changed:
+            sequence = event.get("sequence")
+            if not isinstance(sequence, int):
+                # Sent by a workflow that did not number its notifications
+                sequence = event["sequence"] = next(reversed(timeline.events), 0) + 1
+            if sequence in timeline.events:
+                EVENTS_RECEIVED.inc("duplicate")
+                return
+            EVENTS_RECEIVED.inc("new")
+            timeline.events[sequence] = event
+            if len(timeline.events) > 1 and sequence < next(reversed(timeline.events)):
+                # Arrived out of order, so sort it into place
+                timeline.events = OrderedDict(sorted(timeline.events.items()))
+            while len(timeline.events) > self._per_order:
+                timeline.events.popitem(last=False)
+            finishing = not timeline.finished and event.get("status") not in (None, "RUNNING")
+            timeline.finished = timeline.finished or finishing
+            timeline.changed.notify_all()
+        if finishing:
+            for listener in self._finished_listeners:
+                listener(event["order_id"], event["status"])
+
+    def watch(self, order_id: str) -> "Watch":
+        """Start watching an order until the returned watch is closed.
+
+        Raises TooManyWatchersError if the process is already serving as many watchers as it may.
+        """
+        return Watch(self._timeline(order_id, watching=True), self._stopping, self._unwatch)
+
+    def _unwatch(self, timeline: _Timeline):
+        WATCHERS.dec()
+        with self._lock:
+            timeline.watchers -= 1
+            self._watchers -= 1
+
+    def _timeline(self, order_id: str, watching=False) -> _Timeline:
+        with self._lock:
+            if watching:
+                if self._watchers >= self._max_watchers:
+                    raise TooManyWatchersError(f"Already serving {self._watchers} watchers")
+                self._watchers += 1
+            timeline = self._timelines.get(order_id)
+            if timeline is None:
+                timeline = self._timelines[order_id] = _Timeline()
+                self._evict()
+            self._timelines.move_to_end(order_id)
+            if watching:
+                timeline.watchers += 1
+                WATCHERS.inc()
+            return timeline
+
+    def _evict(self):
+        # Called with the lock held. Orders someone is watching are kept whatever their age.
+        excess = len(self._timelines) - self._max_orders
+        if excess <= 0:
+            return
+        evicted = []
+        for order_id, timeline in self._timelines.items():
+            if len(evicted) >= excess:
+                break
+            if not timeline.watchers:
+                evicted.append(order_id)
+        for order_id in evicted:
+            del self._timelines[order_id]
+
+    def _subscribe(self):
+        while not self._stopping.is_set():
+            try:
+                self._client = self._client_factory()
+                # The SDK reads the stream on its own thread and reconnects if the sidecar restarts
+                self._close_subscription = self._client.subscribe_with_handler(self._pubsub_name, self._topic_name,
+                                                                               self.handle)
+                logger.info(f"Subscribed to {self._topic_name} on {self._pubsub_name} for order events")
+                return
+            except Exception as e:
+                logger.warning(f"Subscribing to {self._topic_name} on {self._pubsub_name} failed, "
+                               f"retrying in {ORDER_EVENTS_SUBSCRIBE_RETRY_SECONDS:.0f}s: {str(e)}")
+                if self._client:
+                    self._client.close()
+                    self._client = None
+                self._stopping.wait(ORDER_EVENTS_SUBSCRIBE_RETRY_SECONDS)
+
+
+class Watch:
+    """One request's view of the events of an order."""
+
+    def __init__(self, timeline: _Timeline, stopping: threading.Event, release):
+        self._timeline = timeline
+        self._stopping = stopping
+        self._release = release
+        self._closed = False
+
+    def wait(self, after: int, timeout: float):
+        """Return the events numbered after `after`, waiting up to `timeout` seconds for one, and whether the order finished."""
+        timeline = self._timeline
+        with timeline.changed:
+            timeline.changed.wait_for(lambda: self._stopping.is_set() or timeline.finished or
+                                      next(reversed(timeline.events), 0) > after, timeout)
+            return [event for sequence, event in timeline.events.items() if sequence > after], timeline.finished
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._release(self._timeline)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Process-wide hub shared by all requests
+order_events = OrderEventHub(client_factory=lambda: DaprClient())
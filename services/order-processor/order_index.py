@@ -0,0 +1,238 @@
+import json
+import logging
+import math
+import os
+import random
+import time
+import zlib
+from datetime import datetime, timezone
+
+import grpc
+from dapr.clients.grpc._state import Concurrency, Consistency, StateOptions
+
+from caches import LRUCache
+from dapr_pool import dapr_pool
+
+STATESTORE_NAME = os.getenv("STATESTORE_NAME", "statestore")
+ORDER_INDEX_KEY_PREFIX = os.getenv("ORDER_INDEX_KEY_PREFIX", "order-processor||orders||")
+# Orders created within the same bucket are indexed together
+ORDER_INDEX_BUCKET_SECONDS = int(os.getenv("ORDER_INDEX_BUCKET_SECONDS", 60))
+# The buckets that hold orders are listed per period, so no directory outgrows a period's buckets
+ORDER_INDEX_DIRECTORY_SECONDS = int(os.getenv("ORDER_INDEX_DIRECTORY_SECONDS", 24 * 60 * 60))
+# Keys each bucket of every created or finished order is spread over, so concurrent orders rarely contend
+ORDER_INDEX_SHARDS = int(os.getenv("ORDER_INDEX_SHARDS", 16))
+ORDER_INDEX_MAX_RETRIES = int(os.getenv("ORDER_INDEX_MAX_RETRIES", 10))
+ORDER_INDEX_BULK_PARALLELISM = int(os.getenv("ORDER_INDEX_BULK_PARALLELISM", 8))
+# Buckets, and summaries of orders, read per sidecar call when listing
+ORDER_INDEX_LIST_BUCKETS_PER_CALL = int(os.getenv("ORDER_INDEX_LIST_BUCKETS_PER_CALL", 8))
+ORDER_INDEX_LIST_SUMMARIES_PER_CALL = int(os.getenv("ORDER_INDEX_LIST_SUMMARIES_PER_CALL", 200))
+
+# Only the first writer holding the current ETag succeeds, and without an ETag only a new key can be written
+INDEX_STATE_OPTIONS = StateOptions(concurrency=Concurrency.first_write, consistency=Consistency.strong)
+
+# gRPC codes returned by the sidecar when a first write loses
+CONFLICT_CODES = (grpc.StatusCode.ABORTED, grpc.StatusCode.FAILED_PRECONDITION)
+
+RUNNING = "RUNNING"
+# Every order, by the time it was created
+CREATED = "created"
+
+logger = logging.getLogger("order_index")
+
+
+class OrderIndexConflictError(Exception):
+    pass
+
+
+def as_utc(value: datetime) -> datetime:
+    """Treat naive datetimes, such as a workflow's current time, as UTC."""
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+def customer_dimension(customer: str) -> str:
+    return f"customer||{customer}"
+
+
+def status_dimension(status: str) -> str:
+    return f"status||{status}"
+
+
+class OrderIndex:
+    """Finds orders by customer, runtime status and creation time, because workflows cannot be queried.
+
+    Each order's summary is kept under its own key. Its ID is also appended to lists per time
+    bucket of its creation: one of every order, one per customer, and once the order finishes
+    one per final status. Each dimension has a directory per `directory_seconds` period of the
+    buckets it has lists for, and a directory of those periods, so listing skips empty stretches
+    of time and no key grows by more than one entry a period. IDs are appended before the summary is written, and
+    listing reads the summaries to check each ID against the filters, so a list can name an
+    order that is not indexed yet, but never leaves one out. Lists are only ever appended to,
+    with compare-and-swap, and those that take every order are spread over `shards` keys.
+    """
+
+    def __init__(self, pool=dapr_pool, store_name=STATESTORE_NAME, prefix=ORDER_INDEX_KEY_PREFIX,
+                 bucket_seconds=ORDER_INDEX_BUCKET_SECONDS, directory_seconds=ORDER_INDEX_DIRECTORY_SECONDS,
+                 shards=ORDER_INDEX_SHARDS, max_retries=ORDER_INDEX_MAX_RETRIES):
+        self._pool = pool
+        self._store_name = store_name
+        self._prefix = prefix
+        self._bucket_seconds = bucket_seconds
+        self._buckets_per_period = max(1, directory_seconds // bucket_seconds)
+        self._shards = shards
+        self._max_retries = max_retries
+        # Directories only ever grow, so a bucket once seen in one stays there
+        self._known_buckets = LRUCache(10000, 24 * 60 * 60)
+
+    def bucket_of(self, created_at: datetime) -> int:
+        return math.floor(as_utc(created_at).timestamp() / self._bucket_seconds)
+
+    def period_of(self, bucket: int) -> int:
+        return bucket // self._buckets_per_period
+
+    def update(self, summary: dict):
+        """Index the summary of an order: its `id`, `customer`, `status` and `created_at`, and any other fields.
+
+        Running orders are listed by creation time and customer, finished orders also by status.
+        """
+        order_id = summary["id"]
+        bucket = self.bucket_of(datetime.fromisoformat(summary["created_at"]))
+        if summary["status"] == RUNNING:
+            dimensions = [CREATED, customer_dimension(summary["customer"])]
+        else:
+            dimensions = [status_dimension(summary["status"])]
+
+        with self._pool.client() as d:
+            for dimension in dimensions:
+                self._add_bucket(d, dimension, bucket)
+                self._append(d, self._list_key(dimension, bucket, order_id), order_id)
+            d.save_state(self._store_name, self._summary_key(order_id), json.dumps(summary))
+
+    def list(self, customer=None, status=None, since=None, cursor=None, limit=100):
+        """Return up to `limit` order summaries in the order they were created, and the cursor of the next page or None.
+
+        Filters by customer and status, and by `since`, the earliest creation time. A cursor
+        from a previous page resumes after the last order it returned.
+        """
+        if customer:
+            dimension = customer_dimension(customer)
+        elif status and status != RUNNING:
+            dimension = status_dimension(status)
+        else:
+            dimension = CREATED
+        after_bucket, after_id = self.parse_cursor(cursor) if cursor else (None, None)
+        since = as_utc(since) if since else None
+        first_bucket = max(self.bucket_of(since) if since else -math.inf,
+                           after_bucket if after_bucket is not None else -math.inf)
+
+        def matches(summary):
+            return (summary and (not customer or summary["customer"] == customer)
+                    and (not status or summary["status"] == status)
+                    and (not since or as_utc(datetime.fromisoformat(summary["created_at"])) >= since))
+
+        orders = []
+        with self._pool.client() as d:
+            for chunk in self._buckets(d, dimension, first_bucket):
+                lists = self._get(d, [key for bucket in chunk for key in self._list_keys(dimension, bucket)])
+
+                for bucket in chunk:
+                    # IDs sort by the time the orders were created
+                    order_ids = sorted({order_id for key in self._list_keys(dimension, bucket)
+                                        for order_id in lists.get(key) or []
+                                        if bucket != after_bucket or order_id > after_id})
+                    for j in range(0, len(order_ids), ORDER_INDEX_LIST_SUMMARIES_PER_CALL):
+                        batch = order_ids[j:j + ORDER_INDEX_LIST_SUMMARIES_PER_CALL]
+                        summaries = self._get(d, [self._summary_key(order_id) for order_id in batch])
+                        for order_id in batch:
+                            summary = summaries.get(self._summary_key(order_id))
+                            if not matches(summary):
+                                continue
+                            orders.append(summary)
+                            if len(orders) == limit:
+                                return orders, f"{bucket}:{order_id}"
+
+        return orders, None
+
+    def _buckets(self, d, dimension: str, first_bucket):
+        """Yield the buckets of a dimension from `first_bucket` on, oldest first, in chunks to read per call."""
+        state = d.get_state(self._store_name, self._periods_key(dimension))
+        first_period = self.period_of(first_bucket) if first_bucket != -math.inf else -math.inf
+        periods = [period for period in (json.loads(state.data) if state.data else []) if period >= first_period]
+        pending = []
+        for i in range(0, len(periods), ORDER_INDEX_LIST_BUCKETS_PER_CALL):
+            keys = [self._directory_key(dimension, period) for period in periods[i:i + ORDER_INDEX_LIST_BUCKETS_PER_CALL]]
+            directories = self._get(d, keys)
+            pending.extend(bucket for key in keys for bucket in directories.get(key) or [] if bucket >= first_bucket)
+            while len(pending) >= ORDER_INDEX_LIST_BUCKETS_PER_CALL:
+                yield pending[:ORDER_INDEX_LIST_BUCKETS_PER_CALL]
+                del pending[:ORDER_INDEX_LIST_BUCKETS_PER_CALL]
+        if pending:
+            yield pending
+
+    @staticmethod
+    def parse_cursor(cursor: str):
+        """Split a cursor into its bucket and order ID, raising ValueError if it is malformed."""
+        bucket, separator, order_id = cursor.partition(":")
+        if not separator or not order_id:
+            raise ValueError(f"Invalid cursor: {cursor}")
+        return int(bucket), order_id
+
+    def _get(self, d, keys):
+        resp = d.get_bulk_state(self._store_name, keys, parallelism=ORDER_INDEX_BULK_PARALLELISM)
+        values = {}
+        for state in resp.items:
+            if state.error:
+                raise Exception(f"Error retrieving order index {state.key}: {state.error}")
+            values[state.key] = json.loads(state.data) if state.data else None
+        return values
+
+    def _add_bucket(self, d, dimension: str, bucket: int):
+        if self._known_buckets.get((dimension, bucket)):
+            return
+        period = self.period_of(bucket)
+        if not self._known_buckets.get((dimension, "period", period)):
+            self._append(d, self._periods_key(dimension), period)
+            self._known_buckets.put((dimension, "period", period), True)
+        self._append(d, self._directory_key(dimension, period), bucket)
+        self._known_buckets.put((dimension, bucket), True)
+
+    def _append(self, d, key: str, value):
+        """Add a value to the sorted list under a key, unless it is there already."""
+        for attempt in range(self._max_retries + 1):
+            state = d.get_state(self._store_name, key)
+            values = json.loads(state.data) if state.data else []
+            if value in values:
+                return
+            try:
+                d.save_state(self._store_name, key, json.dumps(sorted(values + [value])), etag=state.etag or None,
+                             options=INDEX_STATE_OPTIONS)
+                return
+            except grpc.RpcError as err:
+                if err.code() not in CONFLICT_CODES:
+                    raise
+                time.sleep(random.uniform(0, min(0.2, 0.005 * 2 ** attempt)))
+
+        raise OrderIndexConflictError(f"Gave up updating order index {key} after {self._max_retries} conflicts")
+
+    def _shards_of(self, dimension: str) -> int:
+        # A customer's orders arrive one at a time, the other lists take every order
+        return 1 if dimension.startswith("customer||") else self._shards
+
+    def _list_key(self, dimension: str, bucket: int, order_id: str) -> str:
+        # crc32 rather than hash(), which differs between processes
+        shard = zlib.crc32(order_id.encode("utf-8")) % self._shards_of(dimension)
+        return f"{self._prefix}{dimension}||{bucket}||{shard}"
+
+    def _list_keys(self, dimension: str, bucket: int):
+        return [f"{self._prefix}{dimension}||{bucket}||{shard}" for shard in range(self._shards_of(dimension))]
+
+    def _directory_key(self, dimension: str, period: int) -> str:
+        return f"{self._prefix}{dimension}||buckets||{period}"
+
+    def _periods_key(self, dimension: str) -> str:
+        return f"{self._prefix}{dimension}||periods"
+
+    def _summary_key(self, order_id: str) -> str:
+        return f"{self._prefix}order||{order_id}"
+
+
+order_index = OrderIndex()
@@ -0,0 +1,38 @@
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger("runtime_lock")
+
+
+class ProcessGroupLock:
+    """An exclusive file lock that at most one process of a server's process group holds.
+
+    Every server worker waits for the lock on a background thread, and whichever worker gets
+    it runs `on_acquired`. The OS releases the lock when that worker exits, so a replacement
+    worker takes over.
+    """
+
+    def __init__(self, path=None):
+        # Created in the server's master process before it forks workers, so they all share the path
+        self._path = path or os.path.join(tempfile.gettempdir(), f"order-processor-{os.getpid()}.lock")
+        self._fd = None
+
+    def acquire_in_background(self, on_acquired):
+        thread = threading.Thread(target=self._acquire, args=(on_acquired,), name="runtime-lock", daemon=True)
+        thread.start()
+
+    def _acquire(self, on_acquired):
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)  # blocks until no other worker holds the lock
+        self._fd = fd
+        logger.info(f"Process {os.getpid()} acquired {self._path}")
+        on_acquired()
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
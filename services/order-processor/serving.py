@@ -0,0 +1,53 @@
+import logging
+import multiprocessing
+import os
+
+# "dev" runs Flask's built-in server, "prod" runs a pre-forked gunicorn server
+SERVER_MODE = os.getenv("SERVER_MODE", "dev")
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", 4))
+SERVER_KEEPALIVE = int(os.getenv("SERVER_KEEPALIVE", 5))
+SERVER_TIMEOUT = int(os.getenv("SERVER_TIMEOUT", 60))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30))
+SERVER_MAX_REQUESTS = int(os.getenv("SERVER_MAX_REQUESTS", 0))
+
+
+def serve(app, host, port, post_worker_init=None, worker_exit=None):
+    """Serve a Flask app in the mode selected by SERVER_MODE.
+
+    `post_worker_init` and `worker_exit` are called in each worker process after it starts
+    and before it exits. In dev mode there is a single process, so they run around `app.run`.
+    """
+    if SERVER_MODE != "prod":
+        if post_worker_init:
+            post_worker_init()
+        try:
+            app.run(host=host, port=port, debug=False, use_reloader=False)
+        finally:
+            if worker_exit:
+                worker_exit()
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    class GunicornApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", SERVER_WORKERS)
+            self.cfg.set("threads", SERVER_THREADS)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("keepalive", SERVER_KEEPALIVE)
+            self.cfg.set("timeout", SERVER_TIMEOUT)
+            self.cfg.set("graceful_timeout", SERVER_GRACEFUL_TIMEOUT)
+            self.cfg.set("max_requests", SERVER_MAX_REQUESTS)
+            self.cfg.set("max_requests_jitter", SERVER_MAX_REQUESTS // 10)
+            if post_worker_init:
+                self.cfg.set("post_worker_init", lambda worker: post_worker_init())
+            if worker_exit:
+                self.cfg.set("worker_exit", lambda server, worker: worker_exit())
+
+        def load(self):
+            return app
+
+    logging.info(f"Serving on {host}:{port} with {SERVER_WORKERS} workers x {SERVER_THREADS} threads")
+    GunicornApplication().run()
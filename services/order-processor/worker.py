@@ -0,0 +1,32 @@
+"""Runs the order-processor workflows and activities without the HTTP API.
+
+Scale workflow execution separately from the API by running the API with
+WORKFLOW_WORKER_ENABLED=false and as many replicas of this worker as needed, each with its
+own Dapr sidecar and the order-processor app ID.
+"""
+import logging
+import signal
+import threading
+
+from app import start_workflow_runtime, stop_worker
+
+
+def main():
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    start_workflow_runtime()
+    logging.info("Workflow worker started")
+    stopping.wait()
+
+    logging.info("Workflow worker stopping")
+    stop_worker()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s.%(msecs)03d %(levelname)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        level=logging.INFO)
+    main()
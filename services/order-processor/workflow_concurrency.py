@@ -0,0 +1,37 @@
+import logging
+import os
+import threading
+
+from durabletask import worker as durabletask_worker
+
+WORKFLOW_MAX_CONCURRENT_WORKFLOWS = int(os.getenv("WORKFLOW_MAX_CONCURRENT_WORKFLOWS", 50))
+WORKFLOW_MAX_CONCURRENT_ACTIVITIES = int(os.getenv("WORKFLOW_MAX_CONCURRENT_ACTIVITIES", 200))
+WORKFLOW_IO_ACTIVITY_CONCURRENCY = int(os.getenv("WORKFLOW_IO_ACTIVITY_CONCURRENCY", 32))
+
+logger = logging.getLogger("workflow_concurrency")
+
+# Slots for activities that wait on slow calls to other services, such as payments and shipping
+io_activity_slots = threading.BoundedSemaphore(WORKFLOW_IO_ACTIVITY_CONCURRENCY)
+
+
+def configure_concurrency(runtime):
+    """Apply the configured work item limits to a WorkflowRuntime before it starts.
+
+    dapr-ext-workflow 1.15 creates its durabletask worker with default limits and does not
+    expose them: cpu count + 4 threads shared by every workflow and activity. The worker is
+    given a thread per work item it may run at once, so slow activities waiting on the network
+    no longer hold back workflows or fast activities.
+    """
+    worker = getattr(runtime, "_WorkflowRuntime__worker", None)
+    if not hasattr(worker, "_async_worker_manager") or not hasattr(durabletask_worker, "ConcurrencyOptions"):
+        logger.warning("This workflow SDK does not support concurrency limits, running with its defaults")
+        return
+
+    options = durabletask_worker.ConcurrencyOptions(
+        maximum_concurrent_activity_work_items=WORKFLOW_MAX_CONCURRENT_ACTIVITIES,
+        maximum_concurrent_orchestration_work_items=WORKFLOW_MAX_CONCURRENT_WORKFLOWS,
+        maximum_thread_pool_workers=WORKFLOW_MAX_CONCURRENT_ACTIVITIES + WORKFLOW_MAX_CONCURRENT_WORKFLOWS)
+    worker._concurrency_options = options
+    worker._async_worker_manager = durabletask_worker._AsyncWorkerManager(options, worker._logger)
+    logger.info(f"Workflow concurrency: {WORKFLOW_MAX_CONCURRENT_WORKFLOWS} workflows, "
+                f"{WORKFLOW_MAX_CONCURRENT_ACTIVITIES} activities of which {WORKFLOW_IO_ACTIVITY_CONCURRENCY} slow I/O")
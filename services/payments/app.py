@@ -1,57 +1,190 @@
 import logging
+import math
 import os
-from flask import Flask, request, jsonify, make_response
+import grpc
+from dapr.clients import DaprClient
+from flask import Flask, jsonify, make_response
+from codec import decode_request, encode_response
+from ledger import ChargeConflictError, ChargeLedger, RefundError
+from faults import install_faults
+from metrics import InstrumentedDaprClient, instrument_app
+from models import Order
+from serving import serve
+from tracing import TracedDaprClient, install_tracing, tracer
 
 APP_PORT = int(os.getenv("APP_PORT", 3003))
+PAYMENT_BATCH_MAX_SIZE = int(os.getenv("PAYMENT_BATCH_MAX_SIZE", 1000))
 
 app = Flask(__name__)
+instrument_app(app)
+install_tracing(app)
+install_faults(app)
+
+
+def dapr_client():
+    return InstrumentedDaprClient(TracedDaprClient(DaprClient()))
+
+
+ledger = ChargeLedger(dapr_client)
+
+
+def parse_order(order_data):
+    """Return the Order of a charge request, and an error message if it is invalid."""
+    if not order_data or not isinstance(order_data, dict):
+        return None, "Invalid order format"
+    if not isinstance(order_data.get('id'), str) or not order_data['id']:
+        return None, "Missing order id"
+    total = order_data.get('total')
+    if not isinstance(total, (int, float)) or isinstance(total, bool) or not math.isfinite(total) or total <= 0:
+        return None, "Invalid order total"
+    return Order(order_data['id'], order_data.get('customer'), round(float(total), 2)), None
 
 @app.post('/api/v1/payments')
 def create_charge():
-    if not request.is_json:
+    order_data = decode_request()
+    if order_data is None:
         return make_response(
-            jsonify({"error": "Bad Request", "message": "Request must be JSON"}),
+            jsonify({"error": "Bad Request", "message": "Request must be JSON or MessagePack"}),
             400
         )
-    
-    order_data = request.json
 
-    if not order_data or not isinstance(order_data, dict):
+    order, error = parse_order(order_data)
+    if error:
         return make_response(
-            jsonify({"error": "Bad Request", "message": "Invalid order format"}),
+            jsonify({"error": "Bad Request", "message": error}),
             400
         )
-    
-    logging.info(f"Processing payment charge for order: {order_data}")
-    
-    return make_response(
-        jsonify({"id": order_data['id'], "success": True, "message": "Payment processed successfully"}),
-        201
-    )
+
+    logging.info(f"Processing payment charge for order: {order}")
+
+    try:
+        _, created = ledger.charge(order)
+    except ChargeConflictError as err:
+        return make_response(
+            jsonify({"error": "Conflict", "message": str(err)}),
+            409
+        )
+    except grpc.RpcError as err:
+        logging.error(f"Error recording charge for order {order.id}: {err.details()}")
+        return make_response(
+            jsonify({"error": "Internal Server Error", "message": "Failed to record charge"}),
+            500
+        )
+
+    message = "Payment processed successfully" if created else "Payment was already processed"
+    return encode_response({"id": order.id, "success": True, "message": message}, 201)
+
+
+@app.post('/api/v1/payments/batch')
+def create_charge_batch():
+    request_data = decode_request()
+    orders_data = request_data.get("orders") if isinstance(request_data, dict) else None
+    if not isinstance(orders_data, list) or not orders_data:
+        return make_response(
+            jsonify({"error": "Bad Request", "message": "Request should be of the form { \"orders\": [...] }"}),
+            400
+        )
+    if len(orders_data) > PAYMENT_BATCH_MAX_SIZE:
+        return make_response(
+            jsonify({"error": "Payload Too Large",
+                     "message": f"Too many orders in one batch: {len(orders_data)} > {PAYMENT_BATCH_MAX_SIZE}"}),
+            413
+        )
+
+    parsed = [parse_order(order_data) for order_data in orders_data]
+    results = [{"index": i, "success": False, "message": error} for i, (_, error) in enumerate(parsed)]
+    valid = [(i, order) for i, (order, error) in enumerate(parsed) if not error]
+
+    try:
+        charges = ledger.charge_many([order for _, order in valid])
+    except grpc.RpcError as err:
+        logging.error(f"Error recording batch of {len(valid)} charges: {err.details()}")
+        return make_response(
+            jsonify({"error": "Internal Server Error", "message": "Failed to record charges"}),
+            500
+        )
+
+    for (i, order), outcome in zip(valid, charges):
+        if isinstance(outcome, ChargeConflictError):
+            results[i] = {"index": i, "id": order.id, "success": False, "message": str(outcome)}
+        else:
+            message = "Payment processed successfully" if outcome[1] else "Payment was already processed"
+            results[i] = {"index": i, "id": order.id, "success": True, "message": message}
+
+    charged = sum(1 for result in results if result["success"])
+    logging.info(f"Charged {charged} of {len(results)} orders from batch")
+
+    return encode_response({"charged": charged, "failed": len(results) - charged, "results": results}, 201)
+
+
+@app.get('/api/v1/payments/<id>')
+def get_charge(id):
+    charge = ledger.get(id)
+    if not charge:
+        return make_response(
+            jsonify({"error": "Not Found", "message": f"No charge for order {id}"}),
+            404
+        )
+
+    return encode_response({
+        "id": charge.order_id,
+        "customer": charge.customer,
+        "amount": charge.amount,
+        "refunded": charge.refunded,
+        "created_at": charge.created_at,
+    })
 
 
 @app.route('/api/v1/payments/<id>/refunds', methods=['POST'])
 def create_refund(id):
-    if not request.is_json:
+    refund_data = decode_request()
+    if refund_data is None:
         return make_response(
-            jsonify({"error": "Bad Request", "message": "Request must be JSON"}),
+            jsonify({"error": "Bad Request", "message": "Request must be JSON or MessagePack"}),
             400
         )
-    
-    refund_data = request.json
 
-    if not refund_data or not isinstance(refund_data, dict):
+    if not isinstance(refund_data, dict):
         return make_response(
             jsonify({"error": "Bad Request", "message": "Invalid refund format"}),
             400
         )
-    
+
+    # Without an amount, whatever is left of the charge is refunded
+    amount = refund_data.get('amount')
+    if amount is not None and (not isinstance(amount, (int, float)) or isinstance(amount, bool) or amount <= 0):
+        return make_response(
+            jsonify({"error": "Bad Request", "message": "Invalid refund amount"}),
+            400
+        )
+
     logging.info(f"Processing refund for payment: {id}")
-    
-    return make_response(
-        jsonify({"status": "success", "message": "Refund processed successfully"}),
-        200
-    )
+
+    try:
+        charge = ledger.refund(id, None if amount is None else round(float(amount), 2))
+    except KeyError:
+        return make_response(
+            jsonify({"error": "Not Found", "message": f"No charge for order {id}"}),
+            404
+        )
+    except RefundError as err:
+        return make_response(
+            jsonify({"error": "Unprocessable Entity", "message": str(err)}),
+            422
+        )
+    except ChargeConflictError as err:
+        return make_response(
+            jsonify({"error": "Conflict", "message": str(err)}),
+            409
+        )
+    except grpc.RpcError as err:
+        logging.error(f"Error recording refund for order {id}: {err.details()}")
+        return make_response(
+            jsonify({"error": "Internal Server Error", "message": "Failed to record refund"}),
+            500
+        )
+
+    return encode_response({"status": "success", "message": "Refund processed successfully", "refunded": charge.refunded})
 
 # Health check endpoint
 @app.get('/health')
@@ -66,7 +199,7 @@ def health_check():
 
 def main():
     # Start the Flask app server
-    app.run(host='0.0.0.0', port=APP_PORT, debug=False)
+    serve(app, host='0.0.0.0', port=APP_PORT, worker_exit=tracer.close)
 
 
 if __name__ == "__main__":
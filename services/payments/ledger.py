@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict
+from datetime import datetime, timezone
+
+import grpc
+from dapr.clients.grpc._state import Concurrency, Consistency, StateItem, StateOptions
+
+from models import Charge, Order
+
+STATESTORE_NAME = os.getenv("STATESTORE_NAME", "statestore")
+LEDGER_KEY_PREFIX = os.getenv("LEDGER_KEY_PREFIX", "payments||charge||")
+LEDGER_INDEX_SIZE = int(os.getenv("LEDGER_INDEX_SIZE", 100000))
+LEDGER_MAX_RETRIES = int(os.getenv("LEDGER_MAX_RETRIES", 10))
+LEDGER_BULK_PARALLELISM = int(os.getenv("LEDGER_BULK_PARALLELISM", 4))
+
+# Only the first writer holding the current ETag succeeds, and without an ETag only a new key can be written
+FIRST_WRITE = StateOptions(concurrency=Concurrency.first_write, consistency=Consistency.strong)
+
+# gRPC codes returned by the sidecar when a first write loses
+CONFLICT_CODES = (grpc.StatusCode.ABORTED, grpc.StatusCode.FAILED_PRECONDITION)
+
+logger = logging.getLogger("ledger")
+
+
+class ChargeConflictError(Exception):
+    pass
+
+
+class RefundError(Exception):
+    pass
+
+
+class ChargeLedger:
+    """Charges keyed by order ID, stored in the state store and indexed in memory.
+
+    The state store is the source of truth and is shared by every worker process. Each process
+    keeps recently used charges in a bounded index, so repeated charges and lookups are answered
+    without a sidecar call. Charges are created with first-write-wins, so an order is charged at
+    most once. Refunds always compare-and-swap the stored record, so two processes can never
+    refund more than was charged between them.
+    """
+
+    def __init__(self, client_factory, store_name=STATESTORE_NAME, prefix=LEDGER_KEY_PREFIX,
+                 index_size=LEDGER_INDEX_SIZE, max_retries=LEDGER_MAX_RETRIES):
+        self._client_factory = client_factory
+        self._store_name = store_name
+        self._prefix = prefix
+        self._index_size = index_size
+        self._max_retries = max_retries
+        self._index = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, order_id: str):
+        """Return the charge for an order, or None if the order was never charged."""
+        charge = self._indexed(order_id)
+        if charge:
+            return charge
+
+        with self._client_factory() as d:
+            resp = d.get_state(self._store_name, self._prefix + order_id)
+        if not resp.data:
+            return None
+        charge = Charge(**json.loads(resp.data))
+        self._remember(charge)
+        return charge
+
+    def charge(self, order: Order):
+        """Charge an order once. Returns the charge and whether this call created it.
+
+        Charging an order again returns the original charge, unless the amount differs.
+        """
+        existing = self.get(order.id)
+        if existing:
+            return self._repeat(existing, order), False
+
+        charge = Charge(order.id, order.customer, order.total, 0.0, datetime.now(timezone.utc).isoformat())
+        stored, created = self._create(charge)
+        if created:
+            return stored, True
+        # A concurrent call charged the same order first
+        return self._repeat(stored, order), False
+
+    def charge_many(self, orders):
+        """Charge many orders with one bulk read and one bulk write.
+
+        Returns a (charge, created) pair or a ChargeConflictError for each order, in order.
+        """
+        results = [None] * len(orders)
+        missing = {}
+        for i, order in enumerate(orders):
+            existing = self._indexed(order.id)
+            if existing:
+                results[i] = self._checked_repeat(existing, order)
+            else:
+                missing.setdefault(order.id, []).append(i)
+
+        if missing:
+            with self._client_factory() as d:
+                resp = d.get_bulk_state(self._store_name, [self._prefix + order_id for order_id in missing],
+                                        parallelism=LEDGER_BULK_PARALLELISM)
+            for state in resp.items:
+                if state.error:
+                    raise Exception(f"Error retrieving charge {state.key}: {state.error}")
+                if not state.data:
+                    continue
+                charge = Charge(**json.loads(state.data))
+                self._remember(charge)
+                for i in missing.pop(charge.order_id):
+                    results[i] = self._checked_repeat(charge, orders[i])
+
+        created = []
+        for order_id, indexes in missing.items():
+            first = orders[indexes[0]]
+            charge = Charge(first.id, first.customer, first.total, 0.0, datetime.now(timezone.utc).isoformat())
+            created.append(charge)
+            results[indexes[0]] = (charge, True)
+            # The same order listed twice in one batch is charged once
+            for i in indexes[1:]:
+                results[i] = self._checked_repeat(charge, orders[i])
+
+        if created:
+            try:
+                with self._client_factory() as d:
+                    d.save_bulk_state(self._store_name, [
+                        StateItem(key=self._prefix + charge.order_id, value=json.dumps(asdict(charge)),
+                                  options=FIRST_WRITE)
+                        for charge in created])
+            except grpc.RpcError as err:
+                if err.code() not in CONFLICT_CODES:
+                    raise
+                # Some of these orders were charged concurrently, and the bulk write may have saved
+                # some of the others, so save them one at a time and recognise the ones saved already
+                logger.info(f"Concurrent charges in batch, charging {len(created)} orders individually")
+                for charge in created:
+                    indexes = missing[charge.order_id]
+                    try:
+                        stored, own = self._create(charge)
+                    except ChargeConflictError as conflict:
+                        for i in indexes:
+                            results[i] = conflict
+                        continue
+                    results[indexes[0]] = (stored, True) if own else self._checked_repeat(stored, orders[indexes[0]])
+                    for i in indexes[1:]:
+                        results[i] = self._checked_repeat(stored, orders[i])
+                return results
+
+            for charge in created:
+                self._remember(charge)
+
+        return results
+
+    def refund(self, order_id: str, amount=None):
+        """Refund part or all of a charge and return the updated charge.
+
+        Without an amount, whatever has not been refunded yet is refunded, which makes retrying
+        a full refund safe.
+        """
+        # Refunds only ever grow, so the index can only overstate what is left to refund
+        indexed = self._indexed(order_id)
+        if indexed and amount is not None and amount > indexed.refundable:
+            raise RefundError(f"Cannot refund {amount}, only {indexed.refundable} of "
+                              f"{indexed.amount} charged for order {order_id} is refundable")
+        if indexed and amount is None and indexed.refundable == 0:
+            return indexed
+
+        for attempt in range(self._max_retries + 1):
+            with self._client_factory() as d:
+                resp = d.get_state(self._store_name, self._prefix + order_id)
+                if not resp.data:
+                    raise KeyError(order_id)
+                charge = Charge(**json.loads(resp.data))
+
+                refund_amount = charge.refundable if amount is None else amount
+                if refund_amount > charge.refundable:
+                    raise RefundError(f"Cannot refund {refund_amount}, only {charge.refundable} of "
+                                      f"{charge.amount} charged for order {order_id} is refundable")
+                if refund_amount == 0:
+                    self._remember(charge)
+                    return charge
+
+                charge.refunded = round(charge.refunded + refund_amount, 2)
+                try:
+                    d.save_state(self._store_name, self._prefix + order_id, json.dumps(asdict(charge)),
+                                 etag=resp.etag, options=FIRST_WRITE)
+                except grpc.RpcError as err:
+                    if err.code() not in CONFLICT_CODES:
+                        raise
+                    time.sleep(random.uniform(0, min(0.2, 0.005 * 2 ** attempt)))
+                    continue
+
+            self._remember(charge)
+            return charge
+
+        raise ChargeConflictError(f"Gave up refunding order {order_id} after {self._max_retries} conflicts")
+
+    def _create(self, charge: Charge):
+        """Save a new charge unless its order was charged already. Returns the stored charge and whether it is this one."""
+        try:
+            with self._client_factory() as d:
+                d.save_state(self._store_name, self._prefix + charge.order_id, json.dumps(asdict(charge)),
+                             options=FIRST_WRITE)
+        except grpc.RpcError as err:
+            if err.code() not in CONFLICT_CODES:
+                raise
+            stored = self.get(charge.order_id)
+            if stored is None:
+                raise ChargeConflictError(f"Charging order {charge.order_id} conflicted with a charge that no "
+                                          f"longer exists")
+            # The charge itself, if an earlier bulk write saved it before failing
+            return stored, stored.created_at == charge.created_at and stored.customer == charge.customer
+        self._remember(charge)
+        return charge, True
+
+    def _repeat(self, existing: Charge, order: Order) -> Charge:
+        if existing.amount != order.total:
+            raise ChargeConflictError(f"Order {order.id} was already charged {existing.amount}, not {order.total}")
+        return existing
+
+    def _checked_repeat(self, existing: Charge, order: Order):
+        try:
+            return self._repeat(existing, order), False
+        except ChargeConflictError as err:
+            return err
+
+    def _indexed(self, order_id: str):
+        with self._lock:
+            charge = self._index.get(order_id)
+            if charge:
+                self._index.move_to_end(order_id)
+            return charge
+
+    def _remember(self, charge: Charge):
+        if self._index_size <= 0:
+            return
+        with self._lock:
+            self._index[charge.order_id] = charge
+            self._index.move_to_end(charge.order_id)
+            while len(self._index) > self._index_size:
+                self._index.popitem(last=False)
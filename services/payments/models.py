@@ -1,12 +1,21 @@
-from datetime import datetime
-from enum import Enum
-from typing import Optional, List
 from dataclasses import dataclass
-from pydantic import BaseModel
 
-@dataclass
+
+@dataclass(slots=True)
 class Order:
     id: str
     customer: str
-    item: str
     total: float
+
+
+@dataclass(slots=True)
+class Charge:
+    order_id: str
+    customer: str
+    amount: float
+    refunded: float = 0.0
+    created_at: str = ""
+
+    @property
+    def refundable(self) -> float:
+        return round(self.amount - self.refunded, 2)
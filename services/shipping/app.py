@@ -1,40 +1,111 @@
+import json
 import logging
+import multiprocessing
 import os
 import time
 
-from flask import Flask, request
+from dapr.clients import DaprClient
+from flask import Flask, url_for
+from markupsafe import escape
+from codec import decode_request, encode_response
+from faults import install_faults
+from metrics import InstrumentedDaprClient, instrument_app
+from serving import serve
+from shipments import ShipmentStore
+from tracing import TracedDaprClient, install_tracing, tracer
+from waves import WaveScheduler
 
 APP_PORT = os.getenv("APP_PORT", "3004")
 
+# Simulated latency of one carrier call, which books a whole wave of shipments
+CARRIER_LATENCY_MS = float(os.getenv("CARRIER_LATENCY_MS", 0))
+# The app told how the shipments of its orders went
+ORDER_PROCESSOR_APP_ID = os.getenv("ORDER_PROCESSOR_APP_ID", "order-processor")
+
 app = Flask(__name__)
+instrument_app(app)
+install_tracing(app)
+install_faults(app)
+
+# Shared memory, so toggling it in one server worker process affects them all
+is_deactivated = multiprocessing.Value('b', False)
+
+
+def dapr_client():
+    return InstrumentedDaprClient(TracedDaprClient(DaprClient()))
+
+
+def book_carrier(destination, order_ids):
+    logging.info(f"Booking carrier for {len(order_ids)} orders to {destination}")
+
+    # Simulate work
+    if CARRIER_LATENCY_MS > 0:
+        time.sleep(CARRIER_LATENCY_MS / 1000.0)
+
+
+def report_shipments(wave):
+    """Tell the order workflows how the shipments of a finished wave went."""
+    order_ids = shipment_store.in_wave(wave["id"], wave["orders"])
+    if not order_ids:
+        return
+    payload = {"shipments": [
+        {"order_id": order_id, "wave_id": wave["id"], "status": wave["status"]} for order_id in order_ids]}
+    with dapr_client() as d:
+        resp = d.invoke_method(ORDER_PROCESSOR_APP_ID, "orders/shipments", data=json.dumps(payload),
+                               content_type="application/json", http_verb="POST")
+    if resp.status_code != 200:
+        raise Exception(f"{ORDER_PROCESSOR_APP_ID} answered {resp.status_code}: {resp.text()}")
 
-is_deactivated = False
+
+wave_scheduler = WaveScheduler(book_carrier, dapr_client, on_finished=report_shipments)
+shipment_store = ShipmentStore(wave_scheduler, dapr_client)
 
 
 @app.route("/shipping/ship", methods=["POST"])
 def ship():
-    if is_deactivated:
+    if is_deactivated.value:
         return "The shipping service is currently deactivated for routine maintenance.", 503
-    logging.info(f"Shipping order: {request.json}")
 
-    # # Simulate work
-    # time.sleep(1)
+    order = decode_request()
+    if not isinstance(order, dict) or not order.get("id"):
+        return "Invalid order. Should include the order id.", 400
+    logging.info(f"Shipping order: {order}")
 
-    return '', 200
+    # Recorded before replying, so an accepted shipment outlives this worker. Orders without a
+    # destination are grouped by time only.
+    shipment = shipment_store.ship(order["id"], str(order.get("destination") or "default"))
+
+    return encode_response({"shipment_id": shipment["shipment_id"], "wave_id": shipment["wave_id"]}, 202, {
+        'Location': url_for('shipment_status', order_id=order["id"], _external=True)
+    })
+
+
+@app.route("/shipping/shipments/<order_id>", methods=["GET"])
+def shipment_status(order_id):
+    shipment = shipment_store.status(order_id)
+    if not shipment:
+        return f"Shipment not found for order: {escape(order_id)}", 404
+    return encode_response(shipment, 200)
+
+
+@app.route("/shipping/waves/<wave_id>", methods=["GET"])
+def wave_status(wave_id):
+    wave = wave_scheduler.get(wave_id)
+    if not wave:
+        return f"Wave not found: {escape(wave_id)}", 404
+    return wave, 200
 
 
 @app.route("/shipping/deactivate", methods=["POST"])
 def deactivate():
-    global is_deactivated
-    is_deactivated = True
+    is_deactivated.value = True
     logging.warning("The shipping service has been deactivated for routine maintenance.")
     return '', 200
 
 
 @app.route("/shipping/activate", methods=["POST"])
 def activate():
-    global is_deactivated
-    is_deactivated = False
+    is_deactivated.value = False
     logging.info("The shipping service has been (re)activated.")
     return '', 200
 
@@ -45,9 +116,15 @@ def hello():
     return f"Hello from {__name__}", 200
 
 
+def stop_worker():
+    wave_scheduler.close()
+    # Export the spans still queued
+    tracer.close()
+
+
 def main():
     # Start the Flask app server
-    app.run(port=APP_PORT, debug=True, use_reloader=False)
+    serve(app, host='0.0.0.0', port=APP_PORT, worker_exit=stop_worker)
 
 
 if __name__ == "__main__":
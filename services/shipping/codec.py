@@ -0,0 +1,71 @@
+import dataclasses
+import types
+
+import msgpack
+import orjson
+from flask import Response, request
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+
+def to_primitive(obj):
+    """Turn objects the encoders do not know into dicts: dataclasses, with or without slots, and
+    the SimpleNamespace objects the workflow runtime decodes dataclasses into."""
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        # Reads the field names directly, dataclasses.fields() costs more than encoding the payload
+        return {name: getattr(obj, name) for name in obj.__dataclass_fields__}
+    if isinstance(obj, types.SimpleNamespace):
+        return vars(obj)
+    raise TypeError(f"Cannot encode {type(obj).__name__}")
+
+
+class JsonCodec:
+    content_type = JSON
+
+    def encode(self, obj) -> bytes:
+        return orjson.dumps(obj, default=to_primitive)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    """MessagePack: the same data model as JSON in a compact binary form."""
+
+    content_type = MSGPACK
+
+    def encode(self, obj) -> bytes:
+        return msgpack.packb(obj, default=to_primitive)
+
+    def decode(self, data):
+        return msgpack.unpackb(data)
+
+
+CODECS = {JSON: JsonCodec(), MSGPACK: MsgpackCodec()}
+# Other names MessagePack goes by
+CODECS["application/x-msgpack"] = CODECS["application/vnd.msgpack"] = CODECS[MSGPACK]
+
+
+def codec_for(content_type):
+    """The codec for a content type. Anything unknown is treated as JSON."""
+    mimetype = (content_type or "").split(";")[0].strip().lower()
+    return CODECS.get(mimetype, CODECS[JSON])
+
+
+def decode_request():
+    """Decode the body of the current request by its content type, or return None if it cannot be decoded."""
+    data = request.get_data()
+    if not data:
+        return None
+    try:
+        return codec_for(request.content_type).decode(data)
+    except (ValueError, msgpack.UnpackException):
+        return None
+
+
+def encode_response(obj, status=200, headers=None):
+    """Encode a response in the format the client accepts, or else in the format of its request."""
+    accepted = request.accept_mimetypes.best_match(list(CODECS)) if request.accept_mimetypes else None
+    codec = CODECS[accepted] if accepted else codec_for(request.content_type)
+    return Response(codec.encode(obj), status, headers, content_type=codec.content_type)
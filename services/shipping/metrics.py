@@ -0,0 +1,371 @@
+import atexit
+import bisect
+import fcntl
+import functools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+
+from flask import Response, g, request
+
+from serving import SERVER_MODE
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Where the worker processes of a prod server share their metrics. Defaults to a directory of the server's own.
+METRICS_MULTIPROCESS_DIR = os.getenv("METRICS_MULTIPROCESS_DIR", "")
+# How often each worker process writes its metrics for the others to read
+METRICS_SNAPSHOT_INTERVAL_SECONDS = float(os.getenv("METRICS_SNAPSHOT_INTERVAL_SECONDS", 1.0))
+
+
+class Registry:
+    """Holds metrics and renders them in the Prometheus text exposition format.
+
+    Every thread records into its own shard, so recording never takes a lock or contends with
+    other threads. A scrape sums the shards of all threads. When a thread exits its shard is
+    added to the totals of finished threads, so servers that start a thread per request do not
+    accumulate shards.
+
+    Given a `directory`, the worker processes of a server share their metrics through it. Each
+    process writes its totals to a file of its own every `snapshot_interval` seconds and right
+    before a scrape, and a scrape adds up the files of all processes. The counters and histograms
+    of processes that exited are folded into one file, so they never go down. Gauges only count
+    live processes.
+    """
+
+    def __init__(self, directory=None, snapshot_interval=METRICS_SNAPSHOT_INTERVAL_SECONDS):
+        self._metrics = []
+        self._directory = directory
+        self._snapshot_interval = snapshot_interval
+        self._reset()
+        if directory:
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Shards of live threads by id
+        self._shards = {}
+        self._retired = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._writer = None
+
+    def shard(self):
+        try:
+            return self._local.holder.values
+        except AttributeError:
+            holder = _ShardHolder()
+            with self._lock:
+                self._shards[id(holder.values)] = holder.values
+            # The thread's locals, and so the holder, are freed when the thread exits
+            weakref.finalize(holder, self._retire, holder.values)
+            self._local.holder = holder
+            self._start_writer()
+            return holder.values
+
+    def _retire(self, values):
+        with self._lock:
+            if self._shards.pop(id(values), None) is not None:
+                _add_values(self._retired, values)
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def totals(self):
+        """Sum the values of all metrics across the thread shards of this process, keyed by name and label values."""
+        with self._lock:
+            shards = list(self._shards.values())
+            totals = dict((key, list(value) if isinstance(value, list) else value)
+                          for key, value in self._retired.items())
+        for values in shards:
+            _add_values(totals, values)
+        return totals
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        totals = self._shared_totals(metrics) if self._directory else self.totals()
+        by_name = {}
+        for (name, label_values), value in totals.items():
+            by_name.setdefault(name, {})[label_values] = value
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render(by_name.get(metric.name, {})))
+        return "\n".join(lines) + "\n"
+
+    def _start_writer(self):
+        if not self._directory or self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is not None:
+                return
+            self._writer = threading.Thread(target=self._write_periodically, name="metrics-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self._write_snapshot)
+
+    def _write_periodically(self):
+        while True:
+            time.sleep(self._snapshot_interval)
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        _write_json(os.path.join(self._directory, f"{os.getpid()}.json"),
+                    [[name, list(label_values), value] for (name, label_values), value in self.totals().items()])
+
+    def _shared_totals(self, metrics):
+        self._write_snapshot()
+        gauges = {metric.name: metric.aggregate for metric in metrics if metric.type == "gauge"}
+        live = {}
+        with open(os.path.join(self._directory, "lock"), "a") as lock:
+            # Held while folding the files of exited processes, so no scrape counts them twice
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired = _read_values(os.path.join(self._directory, RETIRED_FILE))
+            folded = False
+            for file_name in os.listdir(self._directory):
+                pid = file_name[:-len(".json")]
+                if not file_name.endswith(".json") or not pid.isdigit():
+                    continue
+                path = os.path.join(self._directory, file_name)
+                values = _read_values(path)
+                if _alive(int(pid)):
+                    live[pid] = values
+                    continue
+                _add_values(retired, {key: value for key, value in values.items() if key[0] not in gauges})
+                os.remove(path)
+                folded = True
+            if folded:
+                _write_json(os.path.join(self._directory, RETIRED_FILE),
+                            [[name, list(label_values), value] for (name, label_values), value in retired.items()])
+
+        totals = retired
+        for values in live.values():
+            for key, value in values.items():
+                if gauges.get(key[0]) == "max" and key in totals:
+                    totals[key] = max(totals[key], value)
+                else:
+                    _add_values(totals, {key: value})
+        return totals
+
+
+RETIRED_FILE = "retired.json"
+
+
+class _ShardHolder:
+    __slots__ = ("values", "__weakref__")
+
+    def __init__(self):
+        self.values = {}
+
+
+def _add_values(totals, values):
+    for key, value in list(values.items()):
+        if isinstance(value, list):
+            total = totals.setdefault(key, [0] * len(value))
+            for i, v in enumerate(value):
+                total[i] += v
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def _write_json(path, data):
+    # Readers see either the old file or the new one, never a partly written one
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def _read_values(path):
+    try:
+        with open(path) as f:
+            return {(name, tuple(label_values)): value for name, label_values, value in json.load(f)}
+    except FileNotFoundError:
+        return {}
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, registry, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._registry = registry
+        registry.register(self)
+
+    def inc(self, *label_values, amount=1):
+        values = self._registry.shard()
+        key = (self.name, label_values)
+        values[key] = values.get(key, 0) + amount
+
+    def render(self, totals):
+        for label_values, value in sorted(totals.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, label_values)} {value}"
+
+
+class Gauge(Counter):
+    """A gauge that only moves by increments, so it can be sharded like a counter.
+
+    The gauges of a server's worker processes are summed, or with `aggregate="max"` the highest is reported.
+    """
+
+    type = "gauge"
+
+    def __init__(self, registry, name, help, labelnames=(), aggregate="sum"):
+        self.aggregate = aggregate
+        super().__init__(registry, name, help, labelnames)
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._registry = registry
+        registry.register(self)
+
+    def observe(self, value, *label_values):
+        values = self._registry.shard()
+        key = (self.name, label_values)
+        counts = values.get(key)
+        if counts is None:
+            # One slot per bucket, one for +Inf, then the sum
+            counts = values[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self, totals):
+        for label_values, counts in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, label_values, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, label_values)} {counts[-1]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, label_values)} {cumulative}"
+
+
+def _multiprocess_dir():
+    if SERVER_MODE != "prod":
+        return None
+    if METRICS_MULTIPROCESS_DIR:
+        os.makedirs(METRICS_MULTIPROCESS_DIR, exist_ok=True)
+        # Left by an earlier server
+        for file_name in os.listdir(METRICS_MULTIPROCESS_DIR):
+            if file_name.endswith(".json"):
+                os.remove(os.path.join(METRICS_MULTIPROCESS_DIR, file_name))
+        return METRICS_MULTIPROCESS_DIR
+
+    # Created in the server's master process before it forks workers, so they all share it
+    directory = tempfile.mkdtemp(prefix=f"metrics-{os.getpid()}-")
+    master_pid = os.getpid()
+    atexit.register(lambda: os.getpid() == master_pid and shutil.rmtree(directory, ignore_errors=True))
+    return directory
+
+
+registry = Registry(_multiprocess_dir())
+
+HTTP_REQUEST_SECONDS = Histogram(registry, "http_request_duration_seconds", "HTTP request latency.",
+                                 ("method", "route", "status"))
+HTTP_REQUESTS_IN_FLIGHT = Gauge(registry, "http_requests_in_flight", "HTTP requests currently being served.",
+                                ("route",))
+HTTP_REQUEST_ERRORS = Counter(registry, "http_request_errors_total", "HTTP requests that failed with a 5xx status.",
+                              ("method", "route", "status"))
+SIDECAR_CALL_SECONDS = Histogram(registry, "dapr_sidecar_call_duration_seconds",
+                                 "Latency of calls to the Dapr sidecar.", ("operation", "target", "outcome"))
+
+
+def instrument_app(app):
+    """Record latency, in-flight and error metrics for every route and serve them on /metrics."""
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+        g.metrics_start = time.perf_counter()
+        HTTP_REQUESTS_IN_FLIGHT.inc(g.metrics_route)
+
+    @app.after_request
+    def _record_response(response):
+        g.metrics_status = str(response.status_code)
+        return response
+
+    @app.teardown_request
+    def _stop_timer(exc):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return
+        route = g.metrics_route
+        status = "500" if exc else g.pop("metrics_status", "500")
+        HTTP_REQUESTS_IN_FLIGHT.dec(route)
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, request.method, route, status)
+        if status.startswith("5"):
+            HTTP_REQUEST_ERRORS.inc(request.method, route, status)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(registry.render(), mimetype=None, content_type=CONTENT_TYPE)
+
+
+class InstrumentedDaprClient:
+    """Wraps a DaprClient and times every API call, labelled by the store, pub/sub or app it targets."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __enter__(self):
+        self._client.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._client.__exit__(*args)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name.startswith("_"):
+            return attr
+
+        @functools.wraps(attr)
+        def timed(*args, **kwargs):
+            target = args[0] if args else next(iter(kwargs.values()), "")
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = attr(*args, **kwargs)
+                status = getattr(result, "status_code", None)
+                outcome = f"{status // 100}xx" if isinstance(status, int) else "ok"
+                return result
+            finally:
+                SIDECAR_CALL_SECONDS.observe(time.perf_counter() - start, name, str(target), outcome)
+
+        return timed
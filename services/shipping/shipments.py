@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+import time
+
+import grpc
+from dapr.clients.grpc._state import Concurrency, Consistency, StateOptions
+
+from waves import FINISHED, STATESTORE_NAME, WAVE_TTL_SECONDS
+
+SHIPMENT_KEY_PREFIX = os.getenv("SHIPMENT_KEY_PREFIX", "shipping||shipment||")
+# A shipment whose wave has not finished this long after it was accepted was lost with the worker that held
+# it, and joins a new wave. Keep it well above WAVE_WINDOW_MS plus the time the carrier takes.
+SHIPMENT_RECOVERY_SECONDS = float(os.getenv("SHIPMENT_RECOVERY_SECONDS", 120))
+
+# Without an ETag only a new key can be written, with one only the writer holding the current ETag succeeds
+SHIPMENT_STATE_OPTIONS = StateOptions(concurrency=Concurrency.first_write, consistency=Consistency.strong)
+
+# gRPC codes returned by the sidecar when a first write loses
+CONFLICT_CODES = (grpc.StatusCode.ABORTED, grpc.StatusCode.FAILED_PRECONDITION)
+
+logger = logging.getLogger("shipments")
+
+
+class ShipmentStore:
+    """Records every accepted shipment in the state store before it is acknowledged.
+
+    Open waves only live in the memory of the worker that opened them, so the record of a
+    shipment names its wave, and the status of a shipment is the status of that wave. A shipment
+    is accepted once per order, so retries get the original shipment back. Looking up a
+    shipment whose wave never finished within `recovery_seconds` puts it in a new wave.
+    """
+
+    def __init__(self, scheduler, client_factory, store_name=STATESTORE_NAME, prefix=SHIPMENT_KEY_PREFIX,
+                 recovery_seconds=SHIPMENT_RECOVERY_SECONDS):
+        self._scheduler = scheduler
+        self._client_factory = client_factory
+        self._store_name = store_name
+        self._prefix = prefix
+        self._recovery_seconds = recovery_seconds
+
+    def ship(self, order_id: str, destination: str) -> dict:
+        """Accept the shipment of an order, or return the one already accepted for it."""
+        record, _ = self._load(order_id)
+        if record:
+            return record
+        record = self._submit(order_id, destination)
+        try:
+            self._save(record)
+        except grpc.RpcError as err:
+            self._scheduler.withdraw(order_id, record["wave_id"])
+            if err.code() not in CONFLICT_CODES:
+                raise
+            # Accepted by a concurrent retry
+            record, _ = self._load(order_id)
+        except Exception:
+            self._scheduler.withdraw(order_id, record["wave_id"])
+            raise
+        return record
+
+    def status(self, order_id: str):
+        """Return the shipment of an order with the status of its wave, or None if it was never accepted."""
+        record, etag = self._load(order_id)
+        if not record:
+            return None
+        wave = self._scheduler.get(record["wave_id"])
+        status = wave["status"] if wave else "open"
+
+        if (status not in FINISHED and not self._scheduler.holds(record["wave_id"])
+                and time.time() - record["accepted_at"] > self._recovery_seconds):
+            logger.warning(f"Shipment {record['shipment_id']} of order {order_id} is still {status} after "
+                           f"{self._recovery_seconds:.0f}s, shipping it in a new wave")
+            recovered = self._submit(order_id, record["destination"])
+            try:
+                self._save(recovered, etag)
+                record, status = recovered, "open"
+            except Exception:
+                # Another request recovered it first, or it will be recovered on the next lookup
+                self._scheduler.withdraw(order_id, recovered["wave_id"])
+
+        return {**record, "status": status}
+
+    def in_wave(self, wave_id: str, order_ids) -> list:
+        """Return the IDs of the orders of a wave that are still shipped in it, not recovered into another."""
+        if not order_ids:
+            return []
+        with self._client_factory() as d:
+            resp = d.get_bulk_state(self._store_name, [self._prefix + order_id for order_id in order_ids])
+        shipped = []
+        for order_id, state in zip(order_ids, resp.items):
+            if state.error:
+                raise Exception(f"Error retrieving shipment {state.key}: {state.error}")
+            record = json.loads(state.data) if state.data else None
+            # A full wave may finish before the shipments that filled it were recorded
+            if not record or record["wave_id"] == wave_id:
+                shipped.append(order_id)
+        return shipped
+
+    def _submit(self, order_id: str, destination: str) -> dict:
+        shipment_id, wave_id = self._scheduler.submit(order_id, destination)
+        return {"order_id": order_id, "shipment_id": shipment_id, "wave_id": wave_id, "destination": destination,
+                "accepted_at": time.time()}
+
+    def _load(self, order_id: str):
+        with self._client_factory() as d:
+            resp = d.get_state(self._store_name, self._prefix + order_id)
+        return (json.loads(resp.data) if resp.data else None), resp.etag
+
+    def _save(self, record: dict, etag=None):
+        with self._client_factory() as d:
+            d.save_state(self._store_name, self._prefix + record["order_id"], json.dumps(record),
+                         etag=etag or None, options=SHIPMENT_STATE_OPTIONS,
+                         state_metadata={"ttlInSeconds": str(WAVE_TTL_SECONDS)})
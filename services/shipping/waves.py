@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+STATESTORE_NAME = os.getenv("STATESTORE_NAME", "statestore")
+WAVE_KEY_PREFIX = os.getenv("WAVE_KEY_PREFIX", "shipping||wave||")
+WAVE_MAX_SIZE = int(os.getenv("WAVE_MAX_SIZE", 50))
+WAVE_WINDOW_MS = float(os.getenv("WAVE_WINDOW_MS", 500))
+WAVE_DISPATCH_WORKERS = int(os.getenv("WAVE_DISPATCH_WORKERS", 4))
+WAVE_MAX_ATTEMPTS = int(os.getenv("WAVE_MAX_ATTEMPTS", 3))
+WAVE_RETENTION = int(os.getenv("WAVE_RETENTION", 10000))
+WAVE_TTL_SECONDS = int(os.getenv("WAVE_TTL_SECONDS", 7 * 24 * 60 * 60))
+
+# Statuses of waves that will not change again
+FINISHED = ("shipped", "failed")
+
+logger = logging.getLogger("waves")
+
+
+class Wave:
+    def __init__(self, destination: str, deadline: float):
+        self.id = f"wave_{uuid.uuid4().hex}"
+        self.destination = destination
+        self.order_ids = []
+        # Shipments numbered so far, which withdrawn orders keep counting
+        self.shipments = 0
+        self.status = "open"
+        self.attempts = 0
+        self.error = None
+        self.created_at = datetime.now(timezone.utc).isoformat()
+        self.dispatched_at = None
+        self.completed_at = None
+        self.deadline = deadline
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "destination": self.destination,
+            "status": self.status,
+            "orders": list(self.order_ids),
+            "attempts": self.attempts,
+            "error": self.error,
+            "created_at": self.created_at,
+            "dispatched_at": self.dispatched_at,
+            "completed_at": self.completed_at,
+        }
+
+
+class WaveScheduler:
+    """Groups shipments into waves and hands each wave to the carrier in one call.
+
+    Orders for the same destination join the open wave for that destination. A wave closes when
+    it holds `max_size` orders or `window_ms` after it opened, and is dispatched on a background
+    worker, retrying failed carrier calls up to `max_attempts` times. Every state change of a
+    closed wave is saved to the state store, so any server worker can report on it. Once a wave
+    has shipped or failed it is passed to `on_finished`.
+    """
+
+    def __init__(self, carrier, client_factory, store_name=STATESTORE_NAME, max_size=WAVE_MAX_SIZE,
+                 window_ms=WAVE_WINDOW_MS, dispatch_workers=WAVE_DISPATCH_WORKERS, max_attempts=WAVE_MAX_ATTEMPTS,
+                 retention=WAVE_RETENTION, on_finished=None):
+        self._carrier = carrier
+        self._on_finished = on_finished
+        self._client_factory = client_factory
+        self._store_name = store_name
+        self._max_size = max_size
+        self._window = window_ms / 1000.0
+        self._dispatch_workers = dispatch_workers
+        self._max_attempts = max_attempts
+        self._retention = retention
+        self._open = {}
+        self._waves = OrderedDict()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._flusher = None
+        self._executor = None
+
+    def start(self):
+        with self._cond:
+            if self._flusher:
+                return
+            self._closed = False
+            self._executor = ThreadPoolExecutor(max_workers=self._dispatch_workers, thread_name_prefix="wave-dispatch")
+            self._flusher = threading.Thread(target=self._run, name="wave-flusher", daemon=True)
+            self._flusher.start()
+        logger.info(f"Shipping in waves: size={self._max_size}, window={self._window * 1000:.0f}ms")
+
+    def submit(self, order_id: str, destination: str = "default"):
+        """Add an order to the open wave for its destination and return its (shipment ID, wave ID)."""
+        if not self._flusher:
+            # Started on first use, so the threads belong to the server worker process
+            self.start()
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The wave scheduler is shutting down")
+            wave = self._open.get(destination)
+            if wave is None:
+                wave = self._open[destination] = Wave(destination, time.monotonic() + self._window)
+                self._remember(wave)
+                # Wake the flusher to watch the new wave's window
+                self._cond.notify()
+            wave.order_ids.append(order_id)
+            wave.shipments += 1
+            shipment_id = f"{wave.id}.{wave.shipments}"
+            if len(wave.order_ids) >= self._max_size:
+                self._dispatch(self._open.pop(destination))
+        return shipment_id, wave.id
+
+    def withdraw(self, order_id: str, wave_id: str) -> bool:
+        """Take an order back out of a wave that is still open. Returns whether it was taken out."""
+        with self._cond:
+            wave = self._waves.get(wave_id)
+            if not wave or wave.status != "open" or order_id not in wave.order_ids:
+                return False
+            wave.order_ids.remove(order_id)
+            return True
+
+    def holds(self, wave_id: str) -> bool:
+        """Whether this process is still shipping a wave."""
+        with self._cond:
+            wave = self._waves.get(wave_id)
+            return bool(wave) and wave.status not in FINISHED
+
+    def get(self, wave_id: str):
+        """Return the status of a wave, or None if it is unknown."""
+        with self._cond:
+            wave = self._waves.get(wave_id)
+            if wave:
+                return wave.to_dict()
+
+        # The wave may have been scheduled by another server worker
+        with self._client_factory() as d:
+            resp = d.get_state(self._store_name, WAVE_KEY_PREFIX + wave_id)
+        return json.loads(resp.data) if resp.data else None
+
+    def close(self):
+        """Dispatch every open wave and wait for all waves to finish."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._flusher:
+            self._flusher.join()
+            self._flusher = None
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                due = [destination for destination, wave in self._open.items()
+                       if self._closed or wave.deadline <= now]
+                for destination in due:
+                    self._dispatch(self._open.pop(destination))
+                if self._closed:
+                    return
+                timeout = min((wave.deadline for wave in self._open.values()), default=None)
+                self._cond.wait(None if timeout is None else max(0.0, timeout - now))
+
+    def _dispatch(self, wave: Wave):
+        # Called with the lock held
+        wave.status = "dispatching"
+        self._executor.submit(self._ship, wave)
+
+    def _ship(self, wave: Wave):
+        if not wave.order_ids:
+            # Every order was withdrawn
+            wave.status = "shipped"
+            return
+        wave.dispatched_at = datetime.now(timezone.utc).isoformat()
+        self._save(wave)
+
+        while wave.attempts < self._max_attempts:
+            wave.attempts += 1
+            try:
+                self._carrier(wave.destination, list(wave.order_ids))
+                wave.status = "shipped"
+                wave.error = None
+                break
+            except Exception as e:
+                logger.warning(f"Carrier call for {wave.id} failed (attempt {wave.attempts}): {str(e)}")
+                wave.error = str(e)
+                if wave.attempts < self._max_attempts:
+                    time.sleep(min(5.0, 0.1 * 2 ** wave.attempts))
+        else:
+            wave.status = "failed"
+
+        wave.completed_at = datetime.now(timezone.utc).isoformat()
+        logger.info(f"{wave.id} {wave.status} with {len(wave.order_ids)} orders to {wave.destination}")
+        self._save(wave)
+        if self._on_finished:
+            try:
+                self._on_finished(wave.to_dict())
+            except Exception as e:
+                logger.warning(f"Failed to report that {wave.id} {wave.status}: {str(e)}")
+
+    def _save(self, wave: Wave):
+        try:
+            with self._client_factory() as d:
+                d.save_state(self._store_name, WAVE_KEY_PREFIX + wave.id, json.dumps(wave.to_dict()),
+                             state_metadata={"ttlInSeconds": str(WAVE_TTL_SECONDS)})
+        except Exception as e:
+            logger.warning(f"Failed to save the status of {wave.id}: {str(e)}")
+
+    def _remember(self, wave: Wave):
+        # Called with the lock held
+        self._waves[wave.id] = wave
+        while len(self._waves) > self._retention:
+            self._waves.popitem(last=False)
@@ -0,0 +1,28 @@
+"""Parallel reservations of one SKU never sell more than its stock.
+
+Runs `benchmarks/inventory_reservation_contention.py` against the in-process stand-in for the sidecar.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "benchmarks"))
+
+from inventory_reservation_contention import run  # noqa: E402
+
+
+def test_oversubscribed_stock_is_never_oversold():
+    report = run(stock=300, requests=2000, workers=64)
+
+    assert not report["oversold"]
+    assert report["reserved"] == 300
+    assert report["remaining"] == 0
+    assert report["failed"] == 0
+
+
+def test_every_request_is_served_while_stock_lasts():
+    report = run(stock=1000, requests=500, workers=64)
+
+    assert not report["oversold"]
+    assert report["reserved"] == 500
+    assert report["remaining"] == 500
+    assert report["failed"] == 0
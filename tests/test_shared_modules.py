@@ -0,0 +1,25 @@
+"""Modules every Python service ships a copy of stay identical.
+
+Each service directory is the build context of its image, so shared modules are copied into
+each of them rather than imported from one place. A change to one copy belongs in all of them.
+"""
+import filecmp
+import os
+
+import pytest
+
+SERVICES_DIR = os.path.join(os.path.dirname(__file__), "..", "services")
+
+
+def copies(module):
+    return sorted(os.path.join(SERVICES_DIR, service, module) for service in os.listdir(SERVICES_DIR)
+                  if os.path.isfile(os.path.join(SERVICES_DIR, service, module)))
+
+
+@pytest.mark.parametrize("module", ["codec.py", "faults.py", "metrics.py", "serving.py", "tracing.py"])
+def test_copies_are_identical(module):
+    paths = copies(module)
+
+    assert len(paths) > 1
+    different = [path for path in paths[1:] if not filecmp.cmp(paths[0], path, shallow=False)]
+    assert not different, f"{', '.join(different)} differ from {paths[0]}"